@@ -1,44 +1,405 @@
 # api_client.py
 
-import requests
 import json
+import threading
+import time
+from collections import deque
+from context_store import ContextTokens
+from endpoint_pool import EndpointPool, BackendUnavailable, RETRY_STATUSES
+from endpoint_pool import backoff_delay
+from metrics import get_metrics, log_event
 
+DEFAULT_MODEL_NAME = "hf.co/QuantFactory/Llama-3-ELYZA-JP-8B-GGUF:Q4_K_M"
+DEFAULT_API_URL = "http://localhost:11434/api/generate"
+ERROR_COMMENT = "コメントの取得に失敗しました。"
+# 呼び出しの間隔が空いてもモデルをメモリに載せておく時間（Ollama の keep_alive）
+DEFAULT_KEEP_ALIVE = "30m"
 
-def get_comment_from_llm(
-    prompt,
-    context=None,
-    model_name="hf.co/QuantFactory/Llama-3-ELYZA-JP-8B-GGUF:Q4_K_M",
-    api_url="http://localhost:11434/api/generate",
-):
-    try:
-        payload = {"model": model_name, "prompt": prompt, "stream": False}
-        if context is not None:
-            payload["context"] = context
+_requests = None
+
+
+def load_requests():
+    # requests は読み込みに時間がかかるので、最初に通信するときまで遅らせる
+    global _requests
+    if _requests is None:
+        import requests
+        import requests.adapters
 
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(api_url, json=payload, headers=headers)
+        _requests = requests
+    return _requests
 
-        if response.status_code != 200:
-            print(
-                f"APIリクエストが失敗しました。ステータスコード: {response.status_code}"
+
+def encode_payload(model_name, prompt, stream, context=None, keep_alive=None):
+    """
+    /api/generate に送る JSON のバイト列を作る
+    ContextTokens は変換済みのバイト列をそのまま埋め込み、毎回の変換を省く
+    """
+    payload = {"model": model_name, "prompt": prompt, "stream": stream}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    if isinstance(context, ContextTokens):
+        head = json.dumps(payload).encode("utf-8")
+        return head[:-1] + b', "context": ' + context.to_json_bytes() + b"}"
+    if context is not None:
+        payload["context"] = context
+    return json.dumps(payload).encode("utf-8")
+
+
+class CallStats:
+    """
+    LLM 呼び出しごとのレイテンシと通信量を集計する
+    """
+
+    def __init__(self, recent=100):
+        self.lock = threading.Lock()
+        self.call_count = 0
+        self.error_count = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.recent_calls = deque(maxlen=recent)
+        self.metrics = get_metrics()
+
+    def record(self, latency, sent, received, failed=False, first_chunk=None):
+        # HTTP 呼び出しは秒単位なので、計測値は間引かずに記録する
+        outcome = "error" if failed else "ok"
+        self.metrics.inc("llm_requests_total", outcome=outcome)
+        self.metrics.observe("llm_request_seconds", latency, outcome=outcome)
+        if first_chunk is not None:
+            self.metrics.observe("llm_first_chunk_seconds", first_chunk)
+        with self.lock:
+            self.call_count += 1
+            self.total_latency += latency
+            self.last_latency = latency
+            self.bytes_sent += sent
+            self.bytes_received += received
+            if failed:
+                self.error_count += 1
+            self.recent_calls.append(
+                {
+                    "latency": latency,
+                    "bytes_sent": sent,
+                    "bytes_received": received,
+                    "failed": failed,
+                    "first_chunk_latency": first_chunk,
+                }
             )
-            return "コメントの取得に失敗しました。", None
 
-        # レスポンスをJSONとして解析
-        data = response.json()
-        comment = data.get("response", "").strip()
-        new_context = data.get("context")
+    def snapshot(self):
+        with self.lock:
+            average = self.total_latency / self.call_count if self.call_count else 0.0
+            return {
+                "calls": self.call_count,
+                "errors": self.error_count,
+                "last_latency": self.last_latency,
+                "average_latency": average,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "recent_calls": list(self.recent_calls),
+            }
+
+
+class OllamaClient:
+    """
+    Ollama への接続を保持するクライアント
+    Session を使い回して keep-alive で TCP 接続を再利用する
+    接続できない・混雑している場合は間隔を空けて再試行し、
+    api_url に複数のエンドポイントを渡すと処理中の件数が少ないものへ送る
+    """
+
+    def __init__(
+        self,
+        model_name=DEFAULT_MODEL_NAME,
+        api_url=DEFAULT_API_URL,
+        connect_timeout=5.0,
+        read_timeout=120.0,
+        pool_maxsize=4,
+        cache=None,
+        keep_alive=DEFAULT_KEEP_ALIVE,
+        endpoint_pool=None,
+        max_retries=2,
+        backoff_base=0.5,
+    ):
+        self.model_name = model_name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        # エンドポイントごとのサーキットブレーカー（複数のクライアントで共有できる）
+        self.endpoint_pool = endpoint_pool or EndpointPool(api_url)
+        self.api_url = self.endpoint_pool.endpoints[0].url
+
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self.session_lock = threading.Lock()
+
+        # 呼び出しごとの計測値
+        self.stats = CallStats()
+        # 応答のキャッシュ（ResponseCache、使わない場合は None）
+        self.cache = cache
+
+    @property
+    def session(self):
+        # 接続用のセッションは最初の通信のときに作る
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    requests = load_requests()
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_maxsize
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    session.headers.update({"Content-Type": "application/json"})
+                    self._session = session
+        return self._session
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def _record(self, latency, sent, received, failed=False, first_chunk=None):
+        self.stats.record(latency, sent, received, failed, first_chunk)
+
+    def get_stats(self):
+        stats = self.stats.snapshot()
+        if self.cache is not None:
+            stats["cache"] = self.cache.get_stats()
+        return stats
+
+    def available(self):
+        # すべてのエンドポイントが停止中なら False（トリガーを止めるのに使う）
+        return self.endpoint_pool.available()
+
+    def cache_key(self, policy, model_name, context, prompt):
+        if self.cache is None:
+            return None
+        return self.cache.key_for(policy, model_name, context, prompt)
+
+    def _payload(self, prompt, context, model_name, stream):
+        return encode_payload(model_name, prompt, stream, context, self.keep_alive)
+
+    def _post(self, body, stream=False):
+        """
+        再試行しながら POST し、(エンドポイント, レスポンス) を返す
+        呼び出し元は読み終えたら endpoint_pool.release(エンドポイント, 成否) を呼ぶ
+        """
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.metrics.inc("llm_retries_total")
+                time.sleep(backoff_delay(attempt - 1, self.backoff_base))
+            endpoint = self.endpoint_pool.acquire(exclude=tried)
+            if endpoint is None:
+                raise BackendUnavailable("使える LLM のサーバーがありません")
+            tried.append(endpoint)
+            try:
+                response = self.session.post(
+                    endpoint.url, data=body, timeout=self.timeout, stream=stream
+                )
+            except load_requests().ConnectionError:
+                # 接続できなかった場合だけ再試行する（読み込みのタイムアウトはしない）
+                self.endpoint_pool.release(endpoint, False)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.endpoint_pool.release(endpoint, False)
+                raise
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                response.close()
+                self.endpoint_pool.release(endpoint, False)
+                continue
+            return endpoint, response
 
-        return comment, new_context
-    except Exception as e:
-        print(f"LLMへの問い合わせ中にエラーが発生しました: {e}")
-        return "コメントの取得に失敗しました。", None
+    def warm_up(self, model_name=None):
+        """
+        プロンプトなしで問い合わせ、各エンドポイントにモデルを読み込ませておく
+        最初のコメントがモデルの読み込みを待たずに済むようにする
+        """
+        model_name = model_name or self.model_name
+        body = encode_payload(model_name, "", False, keep_alive=self.keep_alive)
+        loaded = False
+        for endpoint in self.endpoint_pool.endpoints:
+            # 読み込みには時間がかかるので、読み込みのタイムアウトは通常の呼び出しと同じ
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    endpoint.url, data=body, timeout=self.timeout
+                )
+                if response.status_code != 200:
+                    log_event(
+                        "llm_warm_up_failed",
+                        f"モデルの読み込みに失敗しました。ステータスコード: {response.status_code}",
+                        status=response.status_code,
+                        endpoint=endpoint.url,
+                    )
+                    continue
+            except Exception as e:
+                log_event(
+                    "llm_warm_up_error",
+                    f"モデルの読み込み中にエラーが発生しました: {e}",
+                    endpoint=endpoint.url,
+                )
+                continue
+            elapsed = time.perf_counter() - start
+            log_event(
+                "llm_warm_up",
+                f"モデルを読み込みました: {model_name}（{elapsed:.1f}秒）",
+                model=model_name,
+                seconds=elapsed,
+                endpoint=endpoint.url,
+            )
+            loaded = True
+        return loaded
+
+    def generate(self, prompt, context=None, model_name=None, cache_policy=None):
+        model_name = model_name or self.model_name
+        cache_key = self.cache_key(cache_policy, model_name, context, prompt)
+        if cache_key is not None:
+            cached = self.cache.lookup(cache_key, cache_policy)
+            if cached is not None:
+                return cached, context
+
+        body = self._payload(prompt, context, model_name, False)
+
+        start = time.perf_counter()
+        received = 0
+        try:
+            endpoint, response = self._post(body)
+            healthy = False
+            try:
+                received = len(response.content)
+                # 4xx（モデル名の間違いなど）はサーバーの障害としては数えない
+                healthy = response.status_code not in RETRY_STATUSES
+            finally:
+                self.endpoint_pool.release(endpoint, healthy)
+
+            if response.status_code != 200:
+                log_event(
+                    "llm_http_error",
+                    f"APIリクエストが失敗しました。ステータスコード: {response.status_code}",
+                    status=response.status_code,
+                )
+                self._record(time.perf_counter() - start, len(body), received, True)
+                return ERROR_COMMENT, None
+
+            # レスポンスをJSONとして解析
+            data = response.json()
+            comment = data.get("response", "").strip()
+            new_context = data.get("context")
+
+            self._record(time.perf_counter() - start, len(body), received)
+            if cache_key is not None:
+                self.cache.store(cache_key, comment)
+            return comment, new_context
+        except Exception as e:
+            log_event("llm_error", f"LLMへの問い合わせ中にエラーが発生しました: {e}")
+            self._record(time.perf_counter() - start, len(body), received, True)
+            return ERROR_COMMENT, None
+
+    def generate_stream(self, prompt, context=None, model_name=None, cache_policy=None):
+        """
+        stream=True で問い合わせ、NDJSON のチャンクを届いた順に yield する
+        最後のチャンクは done=True で、context を含む
+        失敗した場合は error=True のチャンクを 1 つ返して終了する
+        """
+        model_name = model_name or self.model_name
+        cache_key = self.cache_key(cache_policy, model_name, context, prompt)
+        if cache_key is not None:
+            cached = self.cache.lookup(cache_key, cache_policy)
+            if cached is not None:
+                yield {"response": cached, "done": True, "cached": True}
+                return
+
+        body = self._payload(prompt, context, model_name, True)
+
+        start = time.perf_counter()
+        first_chunk = None
+        received = 0
+        failed = False
+        parts = []
+        endpoint = None
+        healthy = False
+        try:
+            endpoint, response = self._post(body, stream=True)
+            with response:
+                if response.status_code != 200:
+                    healthy = response.status_code not in RETRY_STATUSES
+                    log_event(
+                        "llm_http_error",
+                        f"APIリクエストが失敗しました。ステータスコード: {response.status_code}",
+                        status=response.status_code,
+                    )
+                    failed = True
+                    yield {"response": ERROR_COMMENT, "done": True, "error": True}
+                    return
+
+                # 応答が始まればサーバーは動いている（途中で読むのをやめても成功扱い）
+                healthy = True
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    received += len(line)
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                    chunk = json.loads(line)
+                    parts.append(chunk.get("response", ""))
+                    yield chunk
+                    if chunk.get("done"):
+                        if cache_key is not None:
+                            self.cache.store(cache_key, "".join(parts).strip())
+                        break
+        except Exception as e:
+            log_event("llm_error", f"LLMへの問い合わせ中にエラーが発生しました: {e}")
+            healthy = False
+            failed = True
+            yield {"response": ERROR_COMMENT, "done": True, "error": True}
+        finally:
+            if endpoint is not None:
+                self.endpoint_pool.release(endpoint, healthy)
+            self._record(
+                time.perf_counter() - start, len(body), received, failed, first_chunk
+            )
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+_default_clients = {}
+_default_clients_lock = threading.Lock()
+
+
+def get_default_client(api_url=DEFAULT_API_URL):
+    with _default_clients_lock:
+        client = _default_clients.get(api_url)
+        if client is None:
+            client = OllamaClient(api_url=api_url)
+            _default_clients[api_url] = client
+        return client
+
+
+def get_comment_from_llm(
+    prompt,
+    context=None,
+    model_name=DEFAULT_MODEL_NAME,
+    api_url=DEFAULT_API_URL,
+):
+    # 互換用の関数。URL ごとに共有のクライアントを使う
+    client = get_default_client(api_url)
+    return client.generate(prompt, context, model_name=model_name)
 
 
 # テスト用コード
 if __name__ == "__main__":
     test_prompt = "あなたは優しく励ますアシスタントです。"
     # 初期のcontextはなし
-    response, context = get_comment_from_llm(test_prompt)
+    client = OllamaClient()
+    response, context = client.generate(test_prompt)
     print(f"LLMからのテストレスポンス: {response}")
     print(f"受け取ったcontext: {context}")
+    print(f"通信統計: {client.get_stats()}")
@@ -1,17 +1,36 @@
 # app.py
 
-from flask import Flask, jsonify, render_template, request, redirect
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    render_template,
+    request,
+    redirect,
+    session,
+)
 import threading
-import queue
 import os
 import json
 import atexit
-import chardet
-import ast
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from trigger_manager import TriggerManager
-from random_trigger import RandomTrigger
-from api_client import get_comment_from_llm
-from logger import get_logger
+from random_trigger import RandomTrigger, AsyncRandomTrigger
+from file_watcher import FileWatcher
+from api_client import OllamaClient, DEFAULT_API_URL
+from async_runtime import get_async_runtime
+from context_store import ContextStore, ContextTokens, parse_context
+from endpoint_pool import EndpointPool
+from logger import Logger
+from message_channel import MessageChannel
+from metrics import get_metrics, log_event
+from persona import Persona
+from request_scheduler import RequestScheduler, PRIORITY_USER
+from response_cache import ResponseCache
+from session_registry import SessionRegistry, SessionLimitError, WriterSession
+from text_encoding import detect_encoding
+from timer_service import get_timer_service
 
 
 def create_app():
@@ -20,8 +39,72 @@ def create_app():
     # 設定ファイルのパス
     settings_file = "settings.json"
 
-    # メッセージを保持するキュー
-    app.message_queue = queue.Queue()
+    # セッション ID を Cookie に保存するための鍵
+    app.secret_key = os.environ.get("NOVEL_ADVICER_SECRET_KEY") or os.urandom(24)
+
+    # 執筆者ごとのセッション（TriggerManager やメッセージチャネルを保持）
+    app.sessions = SessionRegistry()
+
+    # 起動時の設定（キャッシュや接続先など、アプリ全体で共有するものに使う）
+    startup_settings = load_settings(settings_file)
+
+    # 処理ごとの回数と所要時間（/metrics で公開する）
+    metrics = get_metrics()
+    metrics.configure(
+        sample_rate=startup_settings.get("metrics_sample_rate", 1.0),
+        idle_sample_rate=startup_settings.get("metrics_idle_sample_rate", 0.0),
+        json_logs=startup_settings.get("json_logs", False),
+    )
+
+    # 同じ問い合わせへの応答を使い回すキャッシュ（設定で無効にできる）
+    app.response_cache = None
+    if startup_settings.get("response_cache", True):
+        app.response_cache = ResponseCache(
+            db_path=startup_settings.get("response_cache_db") or None
+        )
+
+    # モデル名ごとに共有する LLM クライアント
+    # api_url にはリストで複数の Ollama を指定でき、障害の状態は全クライアントで共有する
+    app.endpoint_pool = EndpointPool(
+        startup_settings.get("api_url", DEFAULT_API_URL),
+        failure_threshold=startup_settings.get("circuit_failure_threshold", 3),
+        reset_timeout=startup_settings.get("circuit_reset_timeout", 30),
+    )
+    app.keep_alive = startup_settings.get("keep_alive", "30m")
+    app.llm_clients = {}
+    app.async_llm_clients = {}
+    app.llm_clients_lock = threading.Lock()
+
+    # システムプロンプトの context はバイナリファイルに保存する
+    app.context_store = ContextStore()
+
+    # セッションの準備（システムプロンプトの送信など）をリクエストの外で行う
+    app.startup_executor = ThreadPoolExecutor(
+        max_workers=4, thread_name_prefix="session-start"
+    )
+
+    if startup_settings.get("warm_up", True) and startup_settings.get("model_name"):
+        # 最初のコメントでモデルの読み込みを待たないよう、起動時に読み込ませておく
+        # クライアントの作成（requests の読み込み）もバックグラウンドで行う
+        model_name = startup_settings["model_name"]
+        get_timer_service().submit(
+            lambda: get_llm_client(app, model_name).warm_up()
+        )
+
+    # LLM へのリクエストを優先度順に処理するスケジューラー
+    app.request_scheduler = RequestScheduler()
+
+    metrics.gauge("sessions_active", lambda: len(app.sessions.sessions))
+    metrics.gauge("scheduler_queue_depth", lambda: app.request_scheduler.depth)
+    metrics.gauge("scheduler_active", lambda: app.request_scheduler.active)
+    metrics.gauge(
+        "llm_endpoints_available",
+        lambda: sum(e["state"] != "open" for e in app.endpoint_pool.get_stats()),
+    )
+    if app.response_cache:
+        cache = app.response_cache
+        metrics.gauge("response_cache_hits", lambda: cache.get_stats()["hits"])
+        metrics.gauge("response_cache_misses", lambda: cache.get_stats()["misses"])
 
     @app.route("/", methods=["GET", "POST"])
     def index():
@@ -33,6 +116,9 @@ def create_app():
             min_interval_str = request.form.get("min_interval", "").strip()
             max_interval_str = request.form.get("max_interval", "").strip()
             context_str = request.form.get("context", "").strip()
+            stream = request.form.get("stream") == "on"
+            # 保存済みの context を使わず、システムプロンプトを送り直す
+            reset_context = request.form.get("reset_context") == "on"
 
             # サーバーサイドでのバリデーション
             errors = []
@@ -62,26 +148,37 @@ def create_app():
                 }
                 return render_template("error.html", error_message=error_message)
 
-            # 設定を辞書にまとめる
-            settings = {
-                "filepath": filepath,
-                "model_name": model_name,
-                "system_prompt": system_prompt,
-                "min_interval": min_interval,
-                "max_interval": max_interval,
-                "context_str": context_str,
-            }
+            # 設定ファイルの値にフォームの値を上書きする（フォームにない設定も保持する）
+            settings = load_settings(settings_file)
+            settings.update(
+                {
+                    "filepath": filepath,
+                    "model_name": model_name,
+                    "system_prompt": system_prompt,
+                    "min_interval": min_interval,
+                    "max_interval": max_interval,
+                    "context_str": context_str,
+                    "stream": stream,
+                }
+            )
 
             # アプリケーションを初期化
+            session_id = session.get("session_id") or uuid.uuid4().hex
             try:
-                success = initialize_app(app, settings)
+                success = initialize_app(
+                    app, settings, session_id, use_previous_context=not reset_context
+                )
                 if success:
-                    # 設定を保存
+                    session["session_id"] = session_id
+                    # 設定を保存（context はファイルのパスだけを保存する）
+                    settings.pop("context_str", None)
                     save_settings(settings_file, settings)
                     return redirect("/chat")
                 else:
                     error_message = "アプリケーションの初期化に失敗しました。設定を確認してください。"
                     return render_template("error.html", error_message=error_message)
+            except SessionLimitError as e:
+                return render_template("error.html", error_message=str(e))
             except Exception as e:
                 # エラー詳細をテンプレートに渡す
                 error_message = str(e)
@@ -90,32 +187,106 @@ def create_app():
             settings = load_settings(settings_file)
             return render_template("index.html", settings=settings)
 
+    def current_session():
+        session_id = session.get("session_id")
+        if not session_id:
+            return None
+        return app.sessions.get(session_id)
+
     @app.route("/chat")
     def chat():
+        if current_session() is None:
+            return redirect("/")
         return render_template("chat.html")
 
     @app.route("/get_messages")
     def get_messages():
-        messages = []
-        while not app.message_queue.empty():
-            message = app.message_queue.get()
-            messages.append(message)
-        return jsonify(messages)
+        # SSE が使えない場合のポーリング用
+        writer = current_session()
+        if writer is None:
+            return jsonify({"status": "no_session"}), 404
+        cursor = request.args.get("after", 0, type=int)
+        items, latest = writer.message_channel.get_since(cursor)
+        return jsonify(
+            {"cursor": latest, "messages": [message for _, message in items]}
+        )
+
+    @app.route("/events")
+    def events():
+        # Server-Sent Events で新しいメッセージを届いた時点で送る
+        writer = current_session()
+        if writer is None:
+            return jsonify({"status": "no_session"}), 404
+        cursor = request.headers.get("Last-Event-ID", type=int)
+        if cursor is None:
+            cursor = request.args.get("after", 0, type=int)
+        channel = writer.message_channel
+
+        def stream(cursor):
+            while True:
+                items, latest = channel.wait_for(cursor, timeout=15)
+                writer.touch()
+                if not items:
+                    # 接続維持のためのコメント行
+                    yield ": keep-alive\n\n"
+                    cursor = latest
+                    continue
+                for seq, message in items:
+                    data = json.dumps(message, ensure_ascii=False)
+                    yield f"id: {seq}\ndata: {data}\n\n"
+                cursor = latest
+
+        return Response(
+            stream(cursor),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.route("/stats")
+    def stats():
+        # LLM 呼び出しのレイテンシと通信量、リクエストの待ち状況
+        result = {
+            "scheduler": app.request_scheduler.get_stats(),
+            "sessions": app.sessions.get_stats(),
+            "endpoints": app.endpoint_pool.get_stats(),
+        }
+        with app.llm_clients_lock:
+            result["llm"] = {
+                name: client.get_stats() for name, client in app.llm_clients.items()
+            }
+            result["async_llm"] = {
+                name: client.get_stats()
+                for name, client in app.async_llm_clients.items()
+            }
+        return jsonify(result)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        # Prometheus のテキスト形式
+        return Response(
+            metrics.render_prometheus(), mimetype="text/plain; version=0.0.4"
+        )
 
     @app.route("/pause", methods=["POST"])
     def pause():
-        if hasattr(app, "trigger_manager") and app.trigger_manager:
-            app.trigger_manager.on_pause()
-        if hasattr(app, "random_trigger") and app.random_trigger:
-            app.random_trigger.pause()
+        writer = current_session()
+        if writer is None:
+            return jsonify({"status": "no_session"}), 404
+        if writer.trigger_manager:
+            writer.trigger_manager.on_pause()
+        if writer.random_trigger:
+            writer.random_trigger.pause()
         return jsonify({"status": "success"})
 
     @app.route("/resume", methods=["POST"])
     def resume():
-        if hasattr(app, "trigger_manager") and app.trigger_manager:
-            app.trigger_manager.on_resume()
-        if hasattr(app, "random_trigger") and app.random_trigger:
-            app.random_trigger.resume()
+        writer = current_session()
+        if writer is None:
+            return jsonify({"status": "no_session"}), 404
+        if writer.trigger_manager:
+            writer.trigger_manager.on_resume()
+        if writer.random_trigger:
+            writer.random_trigger.resume()
         return jsonify({"status": "success"})
 
     @app.route("/error")
@@ -127,10 +298,12 @@ def create_app():
 
     # アプリケーション終了時に呼び出す関数を登録
     def on_exit():
-        if hasattr(app, "trigger_manager") and app.trigger_manager:
-            app.trigger_manager.save_log()
-            if hasattr(app, "random_trigger") and app.random_trigger:
-                app.random_trigger.stop()
+        app.startup_executor.shutdown(wait=False)
+        app.sessions.close_all()
+        app.request_scheduler.stop()
+        app.endpoint_pool.close()
+        if app.response_cache:
+            app.response_cache.close()
 
     atexit.register(on_exit)
 
@@ -144,6 +317,28 @@ def load_settings(settings_file):
         "system_prompt": "ロールプレイしてください。あなたは文芸好きの女の子で、執筆中の私を見守っています。あなたはセリフのみ返します。",
         "min_interval": 5,
         "max_interval": 30,
+        "stream": True,
+        "concurrency": 1,
+        "async_mode": False,
+        "response_cache": True,
+        "response_cache_db": "",
+        # ラベル -> "off" / "cached" / "varied"（休憩・再開などの既定値を上書きする）
+        "cache_policies": {},
+        "token_budget": 2048,
+        "keep_alive": "30m",
+        "warm_up": True,
+        "api_url": DEFAULT_API_URL,
+        "circuit_failure_threshold": 3,
+        "circuit_reset_timeout": 30,
+        "metrics_sample_rate": 1.0,
+        "metrics_idle_sample_rate": 0.0,
+        "json_logs": False,
+        "prefetch": False,
+        "prefetch_lead": 15,
+        "persona_name": "",
+        "personas": [],
+        "duplicate_threshold": 0.7,
+        "duplicate_window": 32,
     }
 
     if os.path.exists(settings_file):
@@ -175,82 +370,301 @@ def save_settings(settings_file, settings):
         print(f"設定ファイルの保存中にエラーが発生しました: {e}")
 
 
-def detect_encoding(filepath):
+def get_llm_client(app, model_name):
+    # 同じモデルならクライアントを使い回して接続を維持する
+    with app.llm_clients_lock:
+        client = app.llm_clients.get(model_name)
+        if client is None:
+            client = OllamaClient(
+                model_name=model_name,
+                endpoint_pool=app.endpoint_pool,
+                cache=app.response_cache,
+                keep_alive=app.keep_alive,
+            )
+            app.llm_clients[model_name] = client
+        return client
+
+
+def get_async_llm_client(app, model_name):
+    # asyncio モード用のクライアント（イベントループ上でのみ使う）
+    # ssl などを読み込むので、asyncio モードを使うときまで読み込まない
+    from async_client import AsyncOllamaClient
+
+    with app.llm_clients_lock:
+        client = app.async_llm_clients.get(model_name)
+        if client is None:
+            client = AsyncOllamaClient(
+                model_name=model_name,
+                endpoint_pool=app.endpoint_pool,
+                cache=app.response_cache,
+                keep_alive=app.keep_alive,
+            )
+            app.async_llm_clients[model_name] = client
+        return client
+
+
+def prepare_persona(app, spec, settings, use_previous_context, async_mode):
     """
-    ファイルのエンコーディングを自動検出
+    追加の人物の context を用意する（前回の context があれば使い、なければ作る）
+    spec に書かれていない項目は通常の設定の値を使う
     """
-    with open(filepath, "rb") as f:
-        raw_data = f.read(1024)  # 先頭 1024 バイトを検出に使用
-    result = chardet.detect(raw_data)
-    return (
-        result["encoding"] if result["confidence"] > 0.8 else "utf-8"
-    )  # 信頼度が低い場合は utf-8 にフォールバック
+    model_name = spec.get("model_name") or settings["model_name"]
+    system_prompt = spec.get("system_prompt") or settings["system_prompt"]
+    name = spec.get("name") or model_name
+    client = get_llm_client(app, model_name)
+
+    context = None
+    path = app.context_store.path_for(model_name, system_prompt)
+    if use_previous_context and os.path.exists(path):
+        context = app.context_store.load(path)
+    greeting = None
+    if context is None:
+        log_event("system_prompt", f"{name} にシステムプロンプトを送信します...")
+        greeting, context = client.generate(system_prompt)
+        if not context:
+            raise ConnectionError(
+                f"{name} のレスポンスの取得に失敗しました。APIとの通信に問題がある可能性があります。"
+            )
+        context = ContextTokens(context)
+        app.context_store.save(model_name, system_prompt, context)
+
+    persona = Persona(
+        name,
+        model_name,
+        system_prompt,
+        context,
+        client,
+        async_client=get_async_llm_client(app, model_name) if async_mode else None,
+        weights=spec.get("weights"),
+        max_in_flight=spec.get("max_in_flight", 1),
+    )
+    persona.greeting = greeting
+    return persona
 
 
-def initialize_app(app, settings, use_previous_context=False):
+def initialize_app(app, settings, session_id, use_previous_context=False):
+    """
+    設定を確かめてセッションを登録し、すぐに戻る
+    システムプロンプトの送信やトリガーの準備は start_session でバックグラウンドに行い、
+    進み具合はチャット画面にお知らせとして表示する
+    """
     filepath = settings["filepath"]
     model_name = settings["model_name"]
     system_prompt = settings["system_prompt"]
-    min_interval = settings["min_interval"]
-    max_interval = settings["max_interval"]
-    context_str = settings["context_str"]
+    context_str = settings.get("context_str", "")
 
     if not os.path.exists(filepath):
         raise FileNotFoundError(f"指定されたファイルが存在しません: {filepath}")
 
     try:
+        # 判定時に標本を読むので、全体を読み直して確かめる必要はない
         encoding = detect_encoding(filepath)
-        with open(filepath, "r", encoding=encoding) as f:
-            f.read()
     except Exception as e:
         raise IOError(f"ファイルを開くことができません: {e}")
 
+    context = None
     if context_str:
-        context = ast.literal_eval(context_str)
+        context = parse_context(context_str)
+    elif use_previous_context:
+        # 同じモデルとシステムプロンプトで保存した context があれば送り直さずに使う
+        path = app.context_store.path_for(model_name, system_prompt)
+        if os.path.exists(path):
+            context = app.context_store.load(path)
+
+    app.sessions.check_capacity(session_id)
+
+    # 同じセッションでの設定のやり直しならメッセージチャネルを引き継ぐ
+    writer = app.sessions.get(session_id)
+    if writer:
+        message_channel = writer.message_channel
+        writer.stop_triggers()
+    else:
+        message_channel = MessageChannel()
+
+    logger = Logger(session_id)
+    writer = WriterSession(
+        session_id, message_channel, logger, scheduler=app.request_scheduler
+    )
+    app.sessions.add(writer)
+    # context の保存先はモデルとシステムプロンプトで決まるので先に書いておく
+    settings["context_file"] = app.context_store.path_for(model_name, system_prompt)
+
+    writer.report_progress("準備しています…")
+    app.startup_executor.submit(
+        start_session,
+        app,
+        writer,
+        dict(settings),
+        encoding,
+        context,
+        use_previous_context,
+    )
+    return True
+
 
-    logger = get_logger()
+def start_session(app, writer, settings, encoding, context, use_previous_context):
+    try:
+        _start_session(app, writer, settings, encoding, context, use_previous_context)
+    except Exception as e:
+        log_event("session_start_failed", f"初期化中にエラーが発生しました: {e}")
+        writer.mark_failed(str(e))
+        return
+    if writer.closed or app.sessions.get(writer.session_id) is not writer:
+        # 準備中に設定のやり直しやセッションの破棄があった
+        writer.stop_triggers()
+        return
+    writer.mark_ready()
 
-    if not context_str:
-        print("システムプロンプトを送信します...")
-        response, context = get_comment_from_llm(system_prompt, model_name=model_name)
+
+def _start_session(app, writer, settings, encoding, context, use_previous_context):
+    filepath = settings["filepath"]
+    model_name = settings["model_name"]
+    system_prompt = settings["system_prompt"]
+    min_interval = settings["min_interval"]
+    max_interval = settings["max_interval"]
+    stream = settings.get("stream", False)
+    concurrency = settings.get("concurrency", 1)
+    async_mode = settings.get("async_mode", False)
+    token_budget = settings.get("token_budget", 2048)
+    prefetch = settings.get("prefetch", False)
+    restored = context is not None
+    message_channel = writer.message_channel
+    logger = writer.logger
+
+    client = get_llm_client(app, model_name)
+
+    if not restored:
+        log_event("system_prompt", "システムプロンプトを送信します...")
+        writer.report_progress(
+            f"{model_name} にシステムプロンプトを送信しています…"
+            "（モデルの読み込みに時間がかかることがあります）"
+        )
+        response, context = client.generate(system_prompt)
         if context:
-            print(f"APIとの通信に成功しました。LLMからのレスポンス: {response}")
-            logger.set_model_info(model_name, system_prompt, context)
+            log_event(
+                "system_prompt_response",
+                f"APIとの通信に成功しました。LLMからのレスポンス: {response}",
+            )
+            context = ContextTokens(context)
+            logger.set_model_info(model_name, system_prompt, settings["context_file"])
             processed_response = logger.add_log(system_prompt, response)
-            app.message_queue.put(processed_response)
+            message_channel.put(processed_response)
         else:
             raise ConnectionError(
                 "レスポンスの取得に失敗しました。APIとの通信に問題がある可能性があります。"
             )
     else:
-        print("前回の設定を使用します。")
-        logger.set_model_info(model_name, system_prompt, context)
-        restart_prompt = "ただいま戻りました。お出迎えの挨拶をお願いします。"
-        response, new_context = get_comment_from_llm(
-            restart_prompt, context, model_name
+        log_event("context_restored", "前回の設定を使用します。")
+        logger.set_model_info(model_name, system_prompt, settings["context_file"])
+        # 再開の挨拶の前にモデルを読み込ませておく
+        writer.report_progress(f"{model_name} を読み込んでいます…")
+        client.warm_up()
+    app.context_store.save(model_name, system_prompt, context)
+
+    runtime = get_async_runtime() if async_mode else None
+    async_client = get_async_llm_client(app, model_name) if async_mode else None
+
+    # personas があれば、通常の設定の人物と合わせて全員にコメントさせる
+    personas = []
+    if settings.get("personas"):
+        writer.report_progress("ほかの人物の準備をしています…")
+        personas.append(
+            Persona(
+                settings.get("persona_name") or model_name,
+                model_name,
+                system_prompt,
+                context,
+                client,
+                async_client=async_client,
+            )
         )
-        processed_response = logger.add_log(restart_prompt, response)
-        app.message_queue.put(response)
-
-    if hasattr(app, "random_trigger") and app.random_trigger:
-        app.random_trigger.stop()
+        specs = settings["personas"]
+        with ThreadPoolExecutor(max_workers=len(specs)) as executor:
+            personas.extend(
+                executor.map(
+                    lambda spec: prepare_persona(
+                        app, spec, settings, use_previous_context, async_mode
+                    ),
+                    specs,
+                )
+            )
 
     trigger_manager = TriggerManager(
-        filepath, encoding, app.message_queue, context, model_name
+        filepath,
+        encoding,
+        message_channel,
+        context,
+        model_name,
+        client,
+        stream=stream,
+        require_new_content=True,
+        min_text_interval=min_interval,
+        scheduler=app.request_scheduler,
+        logger=logger,
+        async_client=async_client,
+        runtime=runtime,
+        token_budget=token_budget,
+        prefetch_lead=settings.get("prefetch_lead", 15),
+        duplicate_threshold=settings.get("duplicate_threshold", 0.7),
+        duplicate_window=settings.get("duplicate_window", 32),
+        cache_policies=settings.get("cache_policies"),
+        personas=personas,
     )
-    trigger_manager.logger.set_model_info(model_name, system_prompt, context)
-    app.trigger_manager = trigger_manager
+    writer.trigger_manager = trigger_manager
+    # 人物の数だけ並行して生成できるようにする
+    # （ワーカー数は生きているセッションのうち最も多く必要とするものに合わせる）
+    writer.reserve_workers(max(concurrency, len(personas)))
+
+    for persona in personas:
+        if persona.greeting:
+            trigger_manager.deliver_response(
+                persona.system_prompt, "挨拶", None, persona.greeting, persona
+            )
 
-    random_trigger = RandomTrigger(
-        min_interval=min_interval,
-        max_interval=max_interval,
-        trigger_function=trigger_manager.on_random_message,
-    )
-    app.random_trigger = random_trigger
+    if restored:
+        # 再開時の挨拶はユーザー操作として優先して送る
+        restart_prompt = "ただいま戻りました。お出迎えの挨拶をお願いします。"
+        trigger_manager.broadcast(restart_prompt, "再開の挨拶", PRIORITY_USER)
+
+    if writer.closed:
+        # 準備中にセッションが閉じられたので、トリガーと監視は作らない
+        return
+
+    # 先読みを使う場合は、発火前に次のコメントを生成させる
+    prefetch_function = trigger_manager.prefetch if prefetch else None
+    if async_mode:
+        random_trigger = AsyncRandomTrigger(
+            min_interval=min_interval,
+            max_interval=max_interval,
+            trigger_function=trigger_manager.on_random_message,
+            runtime=runtime,
+            prefetch_function=prefetch_function,
+            prefetch_lead=trigger_manager.prefetch_lead_time,
+        )
+    else:
+        random_trigger = RandomTrigger(
+            min_interval=min_interval,
+            max_interval=max_interval,
+            trigger_function=trigger_manager.on_random_message,
+            prefetch_function=prefetch_function,
+            prefetch_lead=trigger_manager.prefetch_lead_time,
+        )
+    if not writer.attach(random_trigger=random_trigger):
+        return
 
-    return app
+    # 原稿が保存されたら原稿についてのコメントを送る
+    writer.attach(
+        file_watcher=FileWatcher(filepath, trigger_manager.on_document_changed)
+    )
 
 
 if __name__ == "__main__":
+    import sys
+
+    # python app.py batch 原稿.txt ... で原稿全体の一括レビューを行う
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from batch_review import main as batch_main
+
+        sys.exit(batch_main(sys.argv[2:], load_settings("settings.json")))
     app = create_app()
     app.run(debug=False, port=5000)
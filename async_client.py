@@ -0,0 +1,328 @@
+# async_client.py
+
+import asyncio
+import json
+import ssl
+import time
+from api_client import CallStats, DEFAULT_MODEL_NAME, DEFAULT_API_URL, ERROR_COMMENT
+from api_client import DEFAULT_KEEP_ALIVE, encode_payload
+from endpoint_pool import EndpointPool, BackendUnavailable, RETRY_STATUSES
+from endpoint_pool import backoff_delay
+from metrics import log_event
+
+
+class AsyncOllamaClient:
+    """
+    asyncio 版の Ollama クライアント
+    標準ライブラリのストリームで HTTP/1.1 を話し、keep-alive の接続を使い回す
+    1 つのイベントループで多数の生成を同時に待てるようにするためのもの
+    """
+
+    def __init__(
+        self,
+        model_name=DEFAULT_MODEL_NAME,
+        api_url=DEFAULT_API_URL,
+        connect_timeout=5.0,
+        read_timeout=120.0,
+        max_connections=4,
+        cache=None,
+        keep_alive=DEFAULT_KEEP_ALIVE,
+        endpoint_pool=None,
+        max_retries=2,
+        backoff_base=0.5,
+    ):
+        self.model_name = model_name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        # OllamaClient と同じ EndpointPool を渡すと障害の状態を共有できる
+        self.endpoint_pool = endpoint_pool or EndpointPool(api_url)
+        self.api_url = self.endpoint_pool.endpoints[0].url
+
+        # 同時接続数の上限（Ollama 側の並列数に合わせる）
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.idle = {}  # エンドポイントの URL -> 使い回せる (reader, writer) のリスト
+        self.stats = CallStats()
+        self.cache = cache  # OllamaClient と共有できる
+
+    def available(self):
+        return self.endpoint_pool.available()
+
+    def get_stats(self):
+        stats = self.stats.snapshot()
+        if self.cache is not None:
+            stats["cache"] = self.cache.get_stats()
+        return stats
+
+    def cache_key(self, policy, model_name, context, prompt):
+        if self.cache is None:
+            return None
+        return self.cache.key_for(policy, model_name, context, prompt)
+
+    def _payload(self, prompt, context, model_name, stream):
+        model_name = model_name or self.model_name
+        return encode_payload(model_name, prompt, stream, context, self.keep_alive)
+
+    async def _connect(self, endpoint):
+        idle = self.idle.setdefault(endpoint.url, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    endpoint.host,
+                    endpoint.port,
+                    ssl=ssl.create_default_context() if endpoint.use_ssl else None,
+                ),
+                self.connect_timeout,
+            )
+        except asyncio.TimeoutError:
+            # 接続できなかったものとして再試行の対象にする
+            raise ConnectionError("接続がタイムアウトしました")
+        return reader, writer, False
+
+    def _release(self, endpoint, reader, writer, keep_alive):
+        if keep_alive and not writer.is_closing():
+            self.idle.setdefault(endpoint.url, []).append((reader, writer))
+        else:
+            writer.close()
+
+    async def _readline(self, reader):
+        return await asyncio.wait_for(reader.readline(), self.read_timeout)
+
+    async def _send(self, body, endpoint):
+        # 使い回した接続が切れていた場合は新しい接続で 1 度だけやり直す
+        for attempt in range(2):
+            reader, writer, reused = await self._connect(endpoint)
+            try:
+                request = (
+                    f"POST {endpoint.path} HTTP/1.1\r\n"
+                    f"Host: {endpoint.host}:{endpoint.port}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: keep-alive\r\n\r\n"
+                ).encode("ascii")
+                writer.write(request + body)
+                await writer.drain()
+                status_line = await self._readline(reader)
+                if not status_line:
+                    raise ConnectionResetError("接続が閉じられました")
+                status = int(status_line.split()[1])
+                headers = {}
+                while True:
+                    line = await self._readline(reader)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                return status, headers, reader, writer
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused or attempt == 1:
+                    raise
+
+    async def _open(self, body):
+        """
+        再試行しながらリクエストを送り、(エンドポイント, status, headers, reader, writer)
+        を返す。呼び出し元は読み終えたら endpoint_pool.release を呼ぶ
+        """
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.metrics.inc("llm_retries_total")
+                await asyncio.sleep(backoff_delay(attempt - 1, self.backoff_base))
+            endpoint = self.endpoint_pool.acquire(exclude=tried)
+            if endpoint is None:
+                raise BackendUnavailable("使える LLM のサーバーがありません")
+            tried.append(endpoint)
+            try:
+                status, headers, reader, writer = await self._send(body, endpoint)
+            except (OSError, asyncio.IncompleteReadError):
+                # 接続できなかった場合だけ再試行する（読み込みのタイムアウトはしない）
+                self.endpoint_pool.release(endpoint, False)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.endpoint_pool.release(endpoint, False)
+                raise
+            if status in RETRY_STATUSES and attempt < self.max_retries:
+                writer.close()
+                self.endpoint_pool.release(endpoint, False)
+                continue
+            return endpoint, status, headers, reader, writer
+
+    async def _iter_body(self, reader, headers):
+        # 本文をチャンクごとに返す（chunked / Content-Length / 切断まで）
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._readline(reader)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # トレーラーを読み飛ばす
+                    while (await self._readline(reader)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                data = await asyncio.wait_for(
+                    reader.readexactly(size + 2), self.read_timeout
+                )
+                yield data[:-2]
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                data = await asyncio.wait_for(
+                    reader.read(min(remaining, 65536)), self.read_timeout
+                )
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), self.read_timeout)
+                if not data:
+                    return
+                yield data
+
+    def _keep_alive(self, headers):
+        return (
+            headers.get("connection", "").lower() != "close"
+            and ("content-length" in headers or "transfer-encoding" in headers)
+        )
+
+    async def generate(self, prompt, context=None, model_name=None, cache_policy=None):
+        model_name = model_name or self.model_name
+        cache_key = self.cache_key(cache_policy, model_name, context, prompt)
+        if cache_key is not None:
+            cached = self.cache.lookup(cache_key, cache_policy)
+            if cached is not None:
+                return cached, context
+
+        body = self._payload(prompt, context, model_name, False)
+        start = time.perf_counter()
+        received = 0
+        async with self.semaphore:
+            try:
+                endpoint, status, headers, reader, writer = await self._open(body)
+                chunks = []
+                try:
+                    async for data in self._iter_body(reader, headers):
+                        received += len(data)
+                        chunks.append(data)
+                except BaseException:
+                    writer.close()
+                    self.endpoint_pool.release(endpoint, False)
+                    raise
+                self._release(endpoint, reader, writer, self._keep_alive(headers))
+                # 4xx（モデル名の間違いなど）はサーバーの障害としては数えない
+                self.endpoint_pool.release(endpoint, status not in RETRY_STATUSES)
+
+                if status != 200:
+                    log_event(
+                        "llm_http_error",
+                        f"APIリクエストが失敗しました。ステータスコード: {status}",
+                        status=status,
+                    )
+                    latency = time.perf_counter() - start
+                    self.stats.record(latency, len(body), received, True)
+                    return ERROR_COMMENT, None
+
+                data = json.loads(b"".join(chunks))
+                comment = data.get("response", "").strip()
+                new_context = data.get("context")
+                self.stats.record(time.perf_counter() - start, len(body), received)
+                if cache_key is not None:
+                    self.cache.store(cache_key, comment)
+                return comment, new_context
+            except Exception as e:
+                log_event("llm_error", f"LLMへの問い合わせ中にエラーが発生しました: {e}")
+                latency = time.perf_counter() - start
+                self.stats.record(latency, len(body), received, True)
+                return ERROR_COMMENT, None
+
+    async def generate_stream(
+        self, prompt, context=None, model_name=None, cache_policy=None
+    ):
+        """
+        OllamaClient.generate_stream の asyncio 版
+        """
+        model_name = model_name or self.model_name
+        cache_key = self.cache_key(cache_policy, model_name, context, prompt)
+        if cache_key is not None:
+            cached = self.cache.lookup(cache_key, cache_policy)
+            if cached is not None:
+                yield {"response": cached, "done": True, "cached": True}
+                return
+
+        body = self._payload(prompt, context, model_name, True)
+        start = time.perf_counter()
+        first_chunk = None
+        received = 0
+        failed = False
+        async with self.semaphore:
+            endpoint = None
+            writer = None
+            completed = False
+            healthy = False
+            try:
+                endpoint, status, headers, reader, writer = await self._open(body)
+                healthy = status not in RETRY_STATUSES
+                if status != 200:
+                    log_event(
+                        "llm_http_error",
+                        f"APIリクエストが失敗しました。ステータスコード: {status}",
+                        status=status,
+                    )
+                    failed = True
+                    yield {"response": ERROR_COMMENT, "done": True, "error": True}
+                    return
+
+                buffer = b""
+                parts = []
+                async for data in self._iter_body(reader, headers):
+                    received += len(data)
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        if first_chunk is None:
+                            first_chunk = time.perf_counter() - start
+                        chunk = json.loads(line)
+                        parts.append(chunk.get("response", ""))
+                        yield chunk
+                if buffer.strip():
+                    chunk = json.loads(buffer)
+                    parts.append(chunk.get("response", ""))
+                    yield chunk
+                completed = True
+                if cache_key is not None:
+                    self.cache.store(cache_key, "".join(parts).strip())
+            except Exception as e:
+                log_event("llm_error", f"LLMへの問い合わせ中にエラーが発生しました: {e}")
+                healthy = False
+                failed = True
+                yield {"response": ERROR_COMMENT, "done": True, "error": True}
+            finally:
+                if writer is not None:
+                    if completed:
+                        self._release(
+                            endpoint, reader, writer, self._keep_alive(headers)
+                        )
+                    else:
+                        writer.close()
+                if endpoint is not None:
+                    self.endpoint_pool.release(endpoint, healthy)
+                latency = time.perf_counter() - start
+                self.stats.record(latency, len(body), received, failed, first_chunk)
+
+    async def close(self):
+        for idle in self.idle.values():
+            while idle:
+                _, writer = idle.pop()
+                writer.close()
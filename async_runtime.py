@@ -0,0 +1,64 @@
+# async_runtime.py
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import log_event
+
+
+class AsyncRuntime:
+    """
+    専用スレッドでイベントループを 1 つ動かし、他のスレッドからコルーチンを投入する
+    Flask のリクエストスレッドやタイマーからは submit() で非同期処理を依頼する
+    原稿の読み込みやプロンプトの組み立てなど、ループを止める処理は
+    run_blocking() で少数のスレッドに任せる
+    """
+
+    def __init__(self, blocking_workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=blocking_workers, thread_name_prefix="async-blocking"
+        )
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # concurrent.futures.Future を返す
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._report_error)
+        return future
+
+    def _report_error(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            log_event("async_error", f"非同期処理中にエラーが発生しました: {error}")
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_blocking(self, func, *args):
+        # ループ上から await する（func は executor のスレッドで動く）
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_async_runtime():
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = AsyncRuntime()
+    return _runtime
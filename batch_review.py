@@ -0,0 +1,512 @@
+# batch_review.py
+# 原稿全体（またはフォルダ内の原稿すべて）を場面・セリフの区切りで分け、
+# 並列に LLM へ送ってコメントを JSONL に書き出す
+#   python batch_review.py 原稿.txt [原稿フォルダ ...] -o review.jsonl [--workers 4]
+#   python app.py batch 原稿.txt -o review.jsonl
+# 途中で止めても、同じ出力ファイルを指定して実行し直せば終わった所から再開する
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from api_client import OllamaClient, DEFAULT_API_URL, DEFAULT_MODEL_NAME, ERROR_COMMENT
+from context_store import ContextStore, ContextTokens
+from logger import get_logger
+from manuscript_index import CHAPTER_PATTERN
+from metrics import get_metrics, log_event
+from prompt_builder import PromptBuilder
+from text_encoding import detect_encoding, iter_text
+from trigger_manager import PROMPTS_WITH_WEIGHTS
+
+# 読み込む原稿の拡張子（フォルダを指定した場合）
+MANUSCRIPT_EXTENSIONS = (".txt", ".md")
+
+# 場面の区切りとして扱う行（見出しと「＊」「◇」などだけの行）
+HEADING_LINE_PATTERN = re.compile(r"^#{2,6}[ \t]+\S")
+SCENE_BREAK_PATTERN = re.compile(r"^\s*[＊*◇◆□■☆★・－\-]{1,5}\s*$")
+
+SUMMARY_START = re.compile(r"<!--\s*SUMMARY_START\s*-->")
+SUMMARY_END = re.compile(r"<!--\s*SUMMARY_END\s*-->")
+
+# 原稿を使うテンプレート（登場人物の索引を使うものは除く）
+TEXT_PROMPTS = [
+    (weight, label, template)
+    for weight, label, template, needs_text in PROMPTS_WITH_WEIGHTS
+    if needs_text is True
+]
+
+
+class ReviewChunk:
+    """
+    コメントを付ける原稿の一区切り
+    digest は本文のハッシュで、再開のときに済んだものを見分けるのに使う
+    """
+
+    def __init__(self, filepath, index, line, text, chapter=None, summary=None):
+        self.filepath = filepath
+        self.index = index
+        self.line = line  # 先頭の行番号（1 から）
+        self.text = text
+        self.chapter = chapter
+        self.summary = summary
+        self.digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+    @property
+    def key(self):
+        return (os.path.abspath(self.filepath), self.digest)
+
+
+def iter_manuscripts(paths):
+    # フォルダは中の原稿を名前順にたどる
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(MANUSCRIPT_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def iter_lines(filepath, encoding):
+    # 全体を読み込まずに 1 行ずつ返す（改行は含めない）
+    rest = ""
+    for text in iter_text(filepath, encoding):
+        lines = (rest + text).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    if rest:
+        yield rest.rstrip("\r")
+
+
+def iter_blocks(lines):
+    """
+    (先頭の行番号, 行のリスト, 種類) を返す。種類は "heading"・"break"・"summary"・"text"
+    空行・「# 名前」のセリフブロック・引用（>）の手前で区切る
+    """
+    block = []
+    start = 0
+    summary = None
+    for number, line in enumerate(lines, 1):
+        if summary is not None:
+            match = SUMMARY_END.search(line)
+            summary.append(line[: match.start()] if match else line)
+            if match:
+                yield start, summary, "summary"
+                summary = None
+            continue
+        match = SUMMARY_START.search(line)
+        if match:
+            if block:
+                yield start, block, "text"
+                block = []
+            start = number
+            rest = line[match.end() :]
+            end = SUMMARY_END.search(rest)
+            if end:
+                yield start, [rest[: end.start()]], "summary"
+            else:
+                summary = [rest]
+            continue
+
+        stripped = line.strip()
+        kind = None
+        if HEADING_LINE_PATTERN.match(line) or CHAPTER_PATTERN.match(stripped):
+            kind = "heading"
+        elif stripped and SCENE_BREAK_PATTERN.match(line):
+            kind = "break"
+        if kind or not stripped or line.startswith(("# ", ">")):
+            if block:
+                yield start, block, "text"
+                block = []
+        if kind:
+            yield number, [stripped], kind
+        elif stripped:
+            if not block:
+                start = number
+            block.append(line)
+    if summary is not None:
+        # 閉じられていない要約は本文として扱う
+        block.extend(summary)
+    if block:
+        yield start, block, "text"
+
+
+def iter_chunks(filepath, encoding, max_chars=1500, min_chars=200):
+    """
+    ブロックを max_chars 程度ずつにまとめた ReviewChunk を返す
+    見出しと場面の区切りでは、min_chars 以上たまっていれば必ず区切る
+    max_chars を超える 1 つのブロックは行の途中では切らずにそのまま 1 つにする
+    """
+    index = 0
+    chapter = None  # 今の見出し
+    summary = None
+    parts = []
+    size = 0
+    start = 1
+    start_chapter = None  # 区切りの先頭の見出し
+
+    def make_chunk():
+        return ReviewChunk(
+            filepath,
+            index,
+            start,
+            "\n".join(parts),
+            chapter=start_chapter,
+            summary=summary,
+        )
+
+    for number, lines, kind in iter_blocks(iter_lines(filepath, encoding)):
+        if kind == "summary":
+            summary = "\n".join(lines).strip() or None
+            continue
+        if kind in ("heading", "break") and size >= min_chars:
+            yield make_chunk()
+            index += 1
+            parts = []
+            size = 0
+        if kind == "heading":
+            chapter = lines[0].lstrip("#").strip()
+            continue
+        if kind == "break":
+            continue
+        text = "\n".join(lines)
+        if parts and size + len(text) > max_chars:
+            yield make_chunk()
+            index += 1
+            parts = []
+            size = 0
+        if not parts:
+            start = number
+            start_chapter = chapter
+        parts.append(text)
+        size += len(text)
+    if parts:
+        yield make_chunk()
+
+
+def choose_template(chunk, label=None):
+    """
+    (ラベル, テンプレート) を返す
+    指定がなければ重みに従って選ぶ。同じ本文には再開後も同じテンプレートを使う
+    """
+    if label:
+        for _, prompt_label, template in TEXT_PROMPTS:
+            if prompt_label == label:
+                return prompt_label, template
+        raise ValueError(f"原稿を使うテンプレートに '{label}' はありません。")
+    rng = random.Random(chunk.digest)
+    weights = [weight for weight, _, _ in TEXT_PROMPTS]
+    _, prompt_label, template = rng.choices(TEXT_PROMPTS, weights=weights)[0]
+    return prompt_label, template
+
+
+class ReviewOutput:
+    """
+    結果を 1 件ずつ JSONL に追記する（書くたびに flush するので途中で止めても残る）
+    既存の出力を読み、コメントを取得できた区切りを再開用のチェックポイントとして使う
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.file = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で止まった行
+                    continue
+                if record.get("type") == "review":
+                    self.done.add((record["file"], record["digest"]))
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 最後の行が途中で切れていれば、次の行とつながらないよう改行を足す
+        broken = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                broken = f.read(1) != b"\n"
+        self.file = open(self.path, "a", encoding="utf-8")
+        if broken:
+            self.file.write("\n")
+
+    def is_done(self, chunk):
+        return chunk.key in self.done
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if record.get("type") == "review":
+                self.done.add((record["file"], record["digest"]))
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+class BatchReviewer:
+    """
+    ReviewChunk を決まった数のワーカーで LLM に送る
+    送り中の数を workers の 2 倍までに抑え、原稿を先読みしすぎないようにする
+    """
+
+    def __init__(
+        self,
+        client,
+        context,
+        output,
+        workers=4,
+        token_budget=2048,
+        label=None,
+        logger=None,
+    ):
+        self.client = client
+        self.context = context
+        self.output = output
+        self.workers = workers
+        self.label = label
+        self.logger = logger or get_logger()
+        self.metrics = get_metrics()
+        self.prompt_builder = PromptBuilder(budget=token_budget)
+        self.lock = threading.Lock()
+        self.counts = {"reviewed": 0, "skipped": 0, "failed": 0}
+
+    def build_prompt(self, chunk):
+        label, template = choose_template(chunk, self.label)
+        body = self.logger.format_scenario(chunk.text)
+        # 章の見出しは本文の見出し（「本文:」の代わり）として付ける
+        prompt, usage = self.prompt_builder.build(
+            template,
+            chunk.summary,
+            body,
+            context=self.context,
+            body_label=chunk.chapter,
+        )
+        return label, prompt, usage
+
+    def review(self, chunk):
+        label, prompt, usage = self.build_prompt(chunk)
+        start = time.perf_counter()
+        response, _ = self.client.generate(prompt, context=self.context)
+        seconds = time.perf_counter() - start
+        record = {
+            "type": "review",
+            "time": datetime.now().isoformat(),
+            "file": os.path.abspath(chunk.filepath),
+            "chunk": chunk.index,
+            "line": chunk.line,
+            "digest": chunk.digest,
+            "chapter": chunk.chapter,
+            "label": label,
+            "tokens": usage["total_tokens"],
+            "seconds": round(seconds, 3),
+        }
+        if response == ERROR_COMMENT:
+            # 失敗した区切りはチェックポイントにせず、次の実行で送り直す
+            record["type"] = "error"
+            self.count("failed")
+        else:
+            record["response"] = self.logger.process_response(response)
+            self.count("reviewed")
+        self.output.write(record)
+        return record
+
+    def count(self, status):
+        with self.lock:
+            self.counts[status] += 1
+        self.metrics.inc("batch_chunks_total", status=status)
+
+    def run(self, chunks, on_record=None):
+        """
+        すべての区切りを処理して件数を返す。Ctrl+C で止めた場合も書き出し済みの分は残る
+        """
+        pending = set()
+        max_pending = self.workers * 2
+        executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="batch-review"
+        )
+
+        def collect():
+            done, rest = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                if on_record:
+                    on_record(record)
+            return rest
+
+        try:
+            for chunk in chunks:
+                if self.output.is_done(chunk):
+                    self.count("skipped")
+                    continue
+                while len(pending) >= max_pending:
+                    pending = collect()
+                pending.add(executor.submit(self.review, chunk))
+            while pending:
+                pending = collect()
+        finally:
+            # 中断した場合はまだ始まっていない区切りを捨てる
+            executor.shutdown(wait=True, cancel_futures=True)
+        return dict(self.counts)
+
+
+def read_settings(settings_file):
+    # Flask を読み込まないよう、app.load_settings ではなく JSON をそのまま読む
+    if not os.path.exists(settings_file):
+        return {}
+    try:
+        with open(settings_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"設定ファイルの読み込み中にエラーが発生しました: {e}")
+        return {}
+
+
+def prepare_context(client, model_name, system_prompt, context_store):
+    # アプリと同じ context のファイルがあれば使い、なければシステムプロンプトを送る
+    path = context_store.path_for(model_name, system_prompt)
+    if os.path.exists(path):
+        context = context_store.load(path)
+        if context is not None:
+            return context
+    log_event("system_prompt", "システムプロンプトを送信します...")
+    _, context = client.generate(system_prompt)
+    if not context:
+        raise ConnectionError(
+            "レスポンスの取得に失敗しました。APIとの通信に問題がある可能性があります。"
+        )
+    context = ContextTokens(context)
+    context_store.save(model_name, system_prompt, context)
+    return context
+
+
+def iter_all_chunks(paths, max_chars):
+    for filepath in iter_manuscripts(paths):
+        try:
+            encoding = detect_encoding(filepath)
+        except OSError as e:
+            print(f"{filepath} を読み込めません: {e}")
+            continue
+        yield from iter_chunks(filepath, encoding, max_chars=max_chars)
+
+
+def parse_args(argv=None, settings=None):
+    settings = settings or {}
+    parser = argparse.ArgumentParser(
+        description="原稿全体に区切りごとのコメントを付けて JSONL に書き出す"
+    )
+    parser.add_argument("paths", nargs="+", help="原稿のファイルまたはフォルダ")
+    parser.add_argument("-o", "--output", default="review.jsonl")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-chars", type=int, default=1500)
+    parser.add_argument("--label", default=None, help="使うテンプレートのラベル")
+    parser.add_argument(
+        "--model", default=settings.get("model_name") or DEFAULT_MODEL_NAME
+    )
+    parser.add_argument("--system-prompt", default=settings.get("system_prompt", ""))
+    parser.add_argument(
+        "--api-url",
+        nargs="+",
+        default=settings.get("api_url") or DEFAULT_API_URL,
+    )
+    parser.add_argument(
+        "--token-budget", type=int, default=settings.get("token_budget", 2048)
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None, settings=None):
+    if settings is None:
+        settings = read_settings("settings.json")
+    args = parse_args(argv, settings)
+    if not args.system_prompt:
+        print("システムプロンプトを --system-prompt か settings.json で指定してください。")
+        return 2
+    label_choices = [label for _, label, _ in TEXT_PROMPTS]
+    if args.label and args.label not in label_choices:
+        print(f"--label には次のいずれかを指定してください: {', '.join(label_choices)}")
+        return 2
+
+    client = OllamaClient(
+        model_name=args.model,
+        api_url=args.api_url,
+        pool_maxsize=args.workers,
+        keep_alive=settings.get("keep_alive", "30m"),
+    )
+    output = ReviewOutput(args.output)
+    try:
+        context = prepare_context(
+            client, args.model, args.system_prompt, ContextStore()
+        )
+        reviewer = BatchReviewer(
+            client,
+            context,
+            output,
+            workers=args.workers,
+            token_budget=args.token_budget,
+            label=args.label,
+        )
+        output.open()
+        if output.done:
+            print(f"{len(output.done)} 件は済んでいるので飛ばします。")
+
+        def on_record(record):
+            status = "失敗" if record["type"] == "error" else "完了"
+            name = os.path.basename(record["file"])
+            print(f"[{status}] {name} #{record['chunk']}（{record['line']} 行目）")
+
+        start = time.perf_counter()
+        log_event("batch_review_started", f"一括レビューを開始します: {args.paths}")
+        try:
+            counts = reviewer.run(
+                iter_all_chunks(args.paths, args.chunk_chars), on_record
+            )
+        except KeyboardInterrupt:
+            print("中断しました。同じ出力ファイルを指定すると続きから再開します。")
+            return 130
+        elapsed = time.perf_counter() - start
+        log_event(
+            "batch_review_finished",
+            f"一括レビューが終わりました（{elapsed:.1f} 秒）",
+            **counts,
+        )
+        print(
+            f"完了 {counts['reviewed']} 件・済み {counts['skipped']} 件・"
+            f"失敗 {counts['failed']} 件（{elapsed:.1f} 秒）: {args.output}"
+        )
+        return 1 if counts["failed"] else 0
+    except ConnectionError as e:
+        print(e)
+        return 1
+    finally:
+        output.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
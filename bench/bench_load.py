@@ -0,0 +1,602 @@
+# bench/bench_load.py
+# 偽の Ollama（bench/fake_ollama.py）を相手に、TriggerManager・RandomTrigger・
+# Flask のエンドポイントへ負荷をかけ、レイテンシ・取りこぼし・CPU・メモリを測る
+#   python bench/bench_load.py triggers [--sessions 16] [--duration 20] [--size-mb 4]
+#   python bench/bench_load.py flask [--sessions 16] [--duration 20]
+#   python bench/bench_load.py startup [--sessions 4] [--load-delay 3]
+#   python bench/bench_load.py close [--sessions 32] [--close-delay 0.6]
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from bench_text_pipeline import make_manuscript  # noqa: E402
+
+SYSTEM_PROMPT = "ロールプレイしてください。あなたは執筆中の私を見守っています。"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def rss_mb():
+    # 現在の常駐メモリ（/proc が使えない環境では最大値）
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+class Recorder:
+    """
+    プロンプトを送った時刻と応答が届いた時刻からレイテンシを集める
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = defaultdict(deque)
+        self.fired = 0
+        self.latencies = []
+
+    def on_send(self, prompt):
+        with self.lock:
+            self.fired += 1
+            self.sent[prompt].append(time.perf_counter())
+
+    def on_deliver(self, prompt):
+        with self.lock:
+            pending = self.sent.get(prompt)
+            if pending:
+                self.latencies.append(time.perf_counter() - pending.popleft())
+
+    def attach(self, manager):
+        # インスタンスの属性として包み、TriggerManager 本体は変えずに計測する
+        send_to_llm = manager.send_to_llm
+        deliver_response = manager.deliver_response
+
+        def measured_send(prompt, label, *args, **kwargs):
+            self.on_send(prompt)
+            return send_to_llm(prompt, label, *args, **kwargs)
+
+        def measured_deliver(prompt, *args, **kwargs):
+            self.on_deliver(prompt)
+            return deliver_response(prompt, *args, **kwargs)
+
+        manager.send_to_llm = measured_send
+        manager.deliver_response = measured_deliver
+
+
+class Sampler:
+    """
+    実行中の RSS の最大値を一定間隔で記録する
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self.start_rss = rss_mb()
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.cpu = time.process_time() - self.start_cpu
+        self.wall = time.perf_counter() - self.start_wall
+        self.end_rss = rss_mb()
+
+
+def print_latency(name, latencies):
+    print(
+        f"{name:<20} 件数 {len(latencies):6d}  "
+        f"p50 {percentile(latencies, 50) * 1000:8.1f} ms  "
+        f"p95 {percentile(latencies, 95) * 1000:8.1f} ms  "
+        f"最大 {max(latencies, default=0) * 1000:8.1f} ms"
+    )
+
+
+def print_resources(sampler):
+    print(
+        f"CPU {sampler.cpu:.2f} 秒（{sampler.cpu / sampler.wall * 100:.0f}%）  "
+        f"RSS {sampler.start_rss:.1f} → {sampler.end_rss:.1f} MB"
+        f"（最大 {sampler.peak:.1f} MB）"
+    )
+
+
+def run_triggers(args, server, directory):
+    # アプリと同じ部品を直接組み立て、Flask を通さずに負荷をかける
+    from api_client import OllamaClient
+    from context_store import ContextTokens
+    from logger import Logger
+    from message_channel import MessageChannel
+    from random_trigger import RandomTrigger
+    from request_scheduler import RequestScheduler
+    from trigger_manager import TriggerManager
+
+    client = OllamaClient(model_name="bench", api_url=server.api_url)
+    _, context = client.generate(SYSTEM_PROMPT)
+    context = ContextTokens(context or [])
+    scheduler = RequestScheduler(workers=args.concurrency)
+    recorder = Recorder()
+    manuscript = make_manuscript(int(args.size_mb * 1024 * 1024))
+
+    managers = []
+    triggers = []
+    loggers = []
+    for i in range(args.sessions):
+        path = os.path.join(directory, f"manuscript_{i}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(manuscript)
+        logger = Logger(f"bench{i:04d}")
+        manager = TriggerManager(
+            path,
+            "utf-8",
+            MessageChannel(),
+            context,
+            "bench",
+            client,
+            stream=args.stream,
+            scheduler=scheduler,
+            logger=logger,
+            token_budget=args.token_budget,
+        )
+        recorder.attach(manager)
+        managers.append((path, manager))
+        loggers.append(logger)
+        trigger = RandomTrigger(
+            args.min_interval, args.max_interval, manager.on_random_message
+        )
+        triggers.append(trigger)
+
+    stopped = threading.Event()
+
+    def writer():
+        # 執筆者の追記と保存通知（FileWatcher の代わり）
+        rng = random.Random(1)
+        while not stopped.wait(args.append_interval):
+            path, manager = rng.choice(managers)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("# 花子\n「もう少しだけ書こう」\n\n")
+            manager.on_document_changed()
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    with Sampler() as sampler:
+        writer_thread.start()
+        time.sleep(args.duration)
+        stopped.set()
+        for trigger in triggers:
+            trigger.stop()
+        writer_thread.join()
+        # 受け付け済みのリクエストが終わるまで待つ
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            stats = scheduler.get_stats()
+            if stats["queue_depth"] == 0 and stats["active"] == 0:
+                break
+            time.sleep(0.1)
+
+    scheduler.stop()
+    for logger in loggers:
+        logger.close()
+    return {
+        "recorder": recorder,
+        "sampler": sampler,
+        "scheduler": scheduler.get_stats(),
+        "llm": client.get_stats(),
+        "excerpts": [manager.manuscript.get_stats() for _, manager in managers],
+    }
+
+
+def report_triggers(result, server):
+    recorder = result["recorder"]
+    scheduler = result["scheduler"]
+    llm = result["llm"]
+    print(f"送信したプロンプト {recorder.fired}  応答 {len(recorder.latencies)}")
+    print(
+        f"取りこぼし: 破棄 {scheduler['dropped']}  まとめ {scheduler['coalesced']}  "
+        f"エラー {llm['errors']}"
+    )
+    print_latency("プロンプト→応答", recorder.latencies)
+    first_chunks = [
+        call["first_chunk_latency"]
+        for call in llm["recent_calls"]
+        if call["first_chunk_latency"] is not None
+    ]
+    print_latency("最初のチャンク", first_chunks)
+    print(f"スケジューラーの最大待ち時間 {scheduler['max_wait'] * 1000:.1f} ms")
+    excerpts = result["excerpts"]
+    print(
+        "原稿の読み込み: "
+        f"キャッシュ {sum(e['cache_hits'] for e in excerpts)}  "
+        f"追記 {sum(e['append_updates'] for e in excerpts)}  "
+        f"全体 {sum(e['full_rebuilds'] for e in excerpts)}"
+    )
+    print_resources(result["sampler"])
+    print(f"偽の Ollama: {server.counters}")
+
+
+def run_flask(args, server, directory):
+    from app import create_app
+
+    manuscript = make_manuscript(int(args.size_mb * 1024 * 1024))
+    settings = {
+        "filepath": "",
+        "model_name": "bench",
+        "system_prompt": SYSTEM_PROMPT,
+        "min_interval": int(args.min_interval),
+        "max_interval": int(max(args.max_interval, args.min_interval)),
+        "stream": args.stream,
+        "concurrency": args.concurrency,
+        "token_budget": args.token_budget,
+        "api_url": server.api_url,
+        "warm_up": False,
+    }
+    with open("settings.json", "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False)
+    app = create_app()
+
+    clients = []
+    rejected = 0
+    for i in range(args.sessions):
+        path = os.path.join(directory, f"manuscript_{i}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(manuscript)
+        client = app.test_client()
+        response = client.post(
+            "/",
+            data={
+                "filepath": path,
+                "model_name": "bench",
+                "system_prompt": SYSTEM_PROMPT,
+                "min_interval": str(settings["min_interval"]),
+                "max_interval": str(settings["max_interval"]),
+                "stream": "on" if args.stream else "",
+            },
+        )
+        if response.status_code == 302:
+            clients.append(client)
+        else:
+            rejected += 1
+
+    stopped = threading.Event()
+    lock = threading.Lock()
+    poll_latencies = []
+    stats_latencies = []
+    received = [0]
+
+    def poller(client):
+        cursor = 0
+        while not stopped.is_set():
+            start = time.perf_counter()
+            response = client.get(f"/get_messages?after={cursor}")
+            elapsed = time.perf_counter() - start
+            data = response.get_json()
+            cursor = data.get("cursor", cursor)
+            with lock:
+                poll_latencies.append(elapsed)
+                received[0] += len(data.get("messages", []))
+            stopped.wait(args.poll_interval)
+
+    def stats_poller():
+        client = app.test_client()
+        while not stopped.is_set():
+            start = time.perf_counter()
+            client.get("/stats")
+            with lock:
+                stats_latencies.append(time.perf_counter() - start)
+            stopped.wait(1.0)
+
+    threads = [threading.Thread(target=poller, args=(c,)) for c in clients]
+    threads.append(threading.Thread(target=stats_poller))
+    with Sampler() as sampler:
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+    stats = app.test_client().get("/stats").get_json()
+    app.sessions.close_all()
+    app.request_scheduler.stop()
+    return {
+        "sessions": len(clients),
+        "rejected": rejected,
+        "received": received[0],
+        "poll_latencies": poll_latencies,
+        "stats_latencies": stats_latencies,
+        "sampler": sampler,
+        "stats": stats,
+    }
+
+
+def report_flask(result, server):
+    scheduler = result["stats"]["scheduler"]
+    print(f"セッション {result['sessions']}  上限で拒否 {result['rejected']}")
+    print(f"受信したメッセージ {result['received']}")
+    print(
+        f"取りこぼし: 破棄 {scheduler['dropped']}  まとめ {scheduler['coalesced']}"
+    )
+    print_latency("/get_messages", result["poll_latencies"])
+    print_latency("/stats", result["stats_latencies"])
+    for name, llm in result["stats"]["llm"].items():
+        print(
+            f"LLM {name}: 呼び出し {llm['calls']}  エラー {llm['errors']}  "
+            f"平均 {llm['average_latency'] * 1000:.1f} ms"
+        )
+    print_resources(result["sampler"])
+    print(f"偽の Ollama: {server.counters}")
+
+
+def is_comment(message):
+    # 準備中のお知らせや途中経過ではない、LLM からのコメント
+    if isinstance(message, str):
+        return True
+    return not message.get("notice") and not message.get("partial")
+
+
+def run_startup(args, server, directory):
+    # アプリの読み込みから、最初のページと最初のコメントが出るまでの時間を測る
+    start = time.perf_counter()
+    from app import create_app
+
+    imported = time.perf_counter()
+    settings = {
+        "filepath": "",
+        "model_name": "bench",
+        "system_prompt": SYSTEM_PROMPT,
+        "min_interval": 60,
+        "max_interval": 120,
+        "stream": args.stream,
+        "api_url": server.api_url,
+        "warm_up": True,
+    }
+    with open("settings.json", "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False)
+    app = create_app()
+    first_page = None
+    response = app.test_client().get("/")
+    if response.status_code == 200:
+        first_page = time.perf_counter()
+    deferred = {
+        name: name in sys.modules for name in ("requests", "chardet", "async_client")
+    }
+
+    manuscript = make_manuscript(int(args.size_mb * 1024 * 1024))
+    clients = []
+    post_latencies = []
+    for i in range(args.sessions):
+        path = os.path.join(directory, f"manuscript_{i}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(manuscript)
+        client = app.test_client()
+        posted = time.perf_counter()
+        response = client.post(
+            "/",
+            data={
+                "filepath": path,
+                "model_name": "bench",
+                "system_prompt": SYSTEM_PROMPT,
+                "min_interval": str(settings["min_interval"]),
+                "max_interval": str(settings["max_interval"]),
+                "stream": "on" if args.stream else "",
+            },
+        )
+        post_latencies.append(time.perf_counter() - posted)
+        if response.status_code == 302:
+            clients.append((client, posted))
+
+    first_comments = []
+    deadline = time.perf_counter() + args.duration
+    for client, posted in clients:
+        cursor = 0
+        while time.perf_counter() < deadline:
+            data = client.get(f"/get_messages?after={cursor}").get_json()
+            cursor = data.get("cursor", cursor)
+            if any(is_comment(m) for m in data.get("messages", [])):
+                first_comments.append(time.perf_counter() - posted)
+                break
+            time.sleep(0.01)
+
+    app.sessions.close_all()
+    app.request_scheduler.stop()
+    return {
+        "import": imported - start,
+        "first_page": first_page - start if first_page else None,
+        "deferred": deferred,
+        "post_latencies": post_latencies,
+        "first_comments": first_comments,
+        "from_start": time.perf_counter() - start,
+        "sessions": len(clients),
+    }
+
+
+def report_startup(result, server):
+    print(f"app の読み込み {result['import'] * 1000:.1f} ms")
+    if result["first_page"] is None:
+        print("最初のページ: 取得できませんでした")
+    else:
+        print(f"起動から最初のページまで {result['first_page'] * 1000:.1f} ms")
+    loaded = [name for name, value in result["deferred"].items() if value]
+    print(f"最初のページの時点で読み込み済み: {', '.join(loaded) or 'なし'}")
+    print_latency("POST /", result["post_latencies"])
+    print_latency("POST から最初のコメント", result["first_comments"])
+    print(
+        f"最初のコメントが届いたセッション {len(result['first_comments'])}"
+        f"/{result['sessions']}"
+    )
+    print(f"偽の Ollama: {server.counters}")
+
+
+def run_close(args, server, directory):
+    # 準備中のセッションを閉じたり設定し直したりして、後始末が競合しないかを確かめる
+    from app import create_app
+
+    settings = {
+        "filepath": "",
+        "model_name": "bench",
+        "system_prompt": SYSTEM_PROMPT,
+        "min_interval": 60,
+        "max_interval": 120,
+        "api_url": server.api_url,
+    }
+    with open("settings.json", "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False)
+    app = create_app()
+    path = os.path.join(directory, "manuscript.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(make_manuscript(int(args.size_mb * 1024 * 1024)))
+    form = {
+        "filepath": path,
+        "model_name": "bench",
+        "system_prompt": SYSTEM_PROMPT,
+        "min_interval": "60",
+        "max_interval": "120",
+        # 毎回システムプロンプトを送り、準備にかかる時間をそろえる
+        "reset_context": "on",
+    }
+
+    writers = []
+    errors = []
+    for batch in range(0, args.sessions, 4):
+        clients = []
+        for i in range(batch, min(batch + 4, args.sessions)):
+            client = app.test_client()
+            before = set(app.sessions.sessions)
+            client.post("/", data=form)
+            (session_id,) = set(app.sessions.sessions) - before
+            writers.append(app.sessions.sessions[session_id])
+            clients.append((client, session_id))
+        time.sleep(random.uniform(0, args.close_delay))
+        try:
+            for i, (client, session_id) in enumerate(clients):
+                if i % 2:
+                    # 同じセッションでの設定のやり直し（古いセッションが閉じられる）
+                    client.post("/", data=form)
+                    writers.append(app.sessions.sessions[session_id])
+                elif i % 4 == 2:
+                    app.sessions.remove(session_id)
+            # 残りはまとめて閉じる（閉じ終わるまでの間に準備が終わることがある）
+            app.sessions.close_all()
+        except Exception as e:
+            errors.append(repr(e))
+
+    app.startup_executor.shutdown(wait=True)
+    app.request_scheduler.stop()
+    leaked = [
+        w.session_id
+        for w in writers
+        if not w.closed or w.random_trigger is not None or w.file_watcher is not None
+    ]
+    return {
+        "writers": len(writers),
+        "states": {
+            state: sum(w.state == state for w in writers)
+            for state in ("warming", "ready", "failed")
+        },
+        "errors": errors,
+        "leaked": leaked,
+        # 閉じたセッションが RequestScheduler に残したワーカー数の登録
+        "reserved": len(app.request_scheduler.reserved),
+    }
+
+
+def report_close(result, server):
+    print(f"閉じたセッション {result['writers']}  準備の状態 {result['states']}")
+    print(f"閉じるときの例外 {len(result['errors'])} 件")
+    for error in result["errors"][:5]:
+        print(f"  {error}")
+    print(f"止まっていないトリガー・監視 {len(result['leaked'])} 件")
+    print(f"残っているワーカー数の登録 {result['reserved']} 件")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="偽の Ollama を使った負荷ベンチマーク")
+    parser.add_argument(
+        "scenario", choices=["triggers", "flask", "startup", "close"]
+    )
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--size-mb", type=float, default=4.0)
+    parser.add_argument("--min-interval", type=float, default=0.5)
+    parser.add_argument("--max-interval", type=float, default=2.0)
+    parser.add_argument("--append-interval", type=float, default=0.05)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--token-budget", type=int, default=2048)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--token-rate", type=float, default=200.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--load-delay", type=float, default=0.0)
+    parser.add_argument("--close-delay", type=float, default=0.6)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        failure_rate=args.failure_rate,
+        load_delay=args.load_delay,
+    ).start()
+    cwd = os.getcwd()
+    run, report = {
+        "triggers": (run_triggers, report_triggers),
+        "flask": (run_flask, report_flask),
+        "startup": (run_startup, report_startup),
+        "close": (run_close, report_close),
+    }[args.scenario]
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # logs/ や settings.json を一時ディレクトリに作る
+            os.chdir(directory)
+            # アプリのログ出力は計測の邪魔になるので捨てる
+            with open(os.devnull, "w") as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    result = run(args, server, directory)
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        server.stop()
+
+    print(
+        f"シナリオ: {args.scenario}  セッション {args.sessions}  "
+        f"{args.duration:.0f} 秒  原稿 {args.size_mb:.1f} MB"
+    )
+    report(result, server)
+
+
+if __name__ == "__main__":
+    main()
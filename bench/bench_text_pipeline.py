@@ -0,0 +1,168 @@
+# bench/bench_text_pipeline.py
+# Logger の文字列加工（format_scenario / process_response / shorten_prompt）を
+# 以前の実装と比較するマイクロベンチマーク
+#   python bench/bench_text_pipeline.py [原稿のサイズ(MB)]
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logger import Logger  # noqa: E402
+from manuscript import Manuscript, SUMMARY_PATTERN  # noqa: E402
+
+
+# 以前の実装（比較用）
+def legacy_format_scenario(text):
+    def replace_match(match):
+        name = match.group(1)
+        dialogue = match.group(2).replace("\n", "").strip()
+        return f"{name}：{dialogue}\n"
+
+    text = re.sub(r"# (\S+)\n((?:[^#>\n].*\n?)+)", replace_match, text)
+    text = re.sub(r"\n+", "\n", text).strip()
+    return text
+
+
+def legacy_process_response(response):
+    response = re.sub(r"<\|.*?\|>", "", response)
+    response = re.sub(r"<\|.*?\|", "", response)
+    response = re.sub(r"\|.*?\|>", "", response)
+    response = response.replace("|im-start|", "")
+    response = response.replace("|im-end|", "")
+    if (
+        response.startswith("「")
+        and response.endswith("」")
+        and response.count("「") == 1
+        and response.count("」") == 1
+    ):
+        response = response[1:-1]
+    response = response.strip()
+    if not response.endswith(("。", "？", "?", "！", "!")):
+        response += "。"
+    return response
+
+
+def legacy_shorten_prompt(prompt, max_length=100):
+    matches = re.findall(r"〔(.*?)〕", prompt, re.DOTALL)
+    shortened_prompt = prompt
+    for match in matches:
+        cleaned_match = legacy_format_scenario(match)
+        if len(cleaned_match) > max_length:
+            trimmed_prompt = (
+                cleaned_match[:max_length] + "..." + cleaned_match[-max_length:]
+            )
+            shortened_prompt = shortened_prompt.replace(match, trimmed_prompt)
+    return shortened_prompt
+
+
+def make_manuscript(size_bytes, seed=0):
+    # 地の文とセリフブロックが混ざった原稿を作る
+    rng = random.Random(seed)
+    names = ["花子", "太郎", "先生", "猫"]
+    parts = []
+    total = 0
+    while total < size_bytes:
+        if rng.random() < 0.4:
+            lines = "\n".join(
+                "「" + "あいうえおかきくけこ" * rng.randint(1, 4) + "」"
+                for _ in range(rng.randint(1, 3))
+            )
+            part = f"# {rng.choice(names)}\n{lines}\n\n"
+        else:
+            part = "彼女は窓の外を眺めていた。" * rng.randint(1, 6) + "\n\n"
+        parts.append(part)
+        total += len(part.encode("utf-8"))
+    return "".join(parts)
+
+
+def legacy_excerpt(path):
+    # 以前の TriggerManager.on_random_message と同じく全文を読んで整形する
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    match = SUMMARY_PATTERN.search(text)
+    summary = match.group(1).strip() if match else None
+    body = legacy_format_scenario(SUMMARY_PATTERN.sub("", text))
+    return summary, body[-3000:]
+
+
+def measure(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, legacy, current):
+    print(
+        f"{name:<28} 旧: {legacy * 1000:9.3f} ms  新: {current * 1000:9.3f} ms  "
+        f"x{legacy / current if current else float('inf'):.2f}"
+    )
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    logger = Logger()
+    manuscript = make_manuscript(int(size_mb * 1024 * 1024))
+    prompt = (
+        "以下は私の書いた文章です。\n〔"
+        + manuscript[-3000:]
+        + "〕\nあなたはこの文章を読んで気になった点を一つ呟きます"
+    )
+    plain_response = "「今日は筆が進んでいますね。" + "続きが楽しみです。" * 30 + "」"
+    token_response = "<|im_start|>" + plain_response + "<|im_end|>"
+
+    print(f"原稿サイズ: {len(manuscript.encode('utf-8')) / 1024 / 1024:.1f} MB")
+    report(
+        "format_scenario (全文)",
+        measure(legacy_format_scenario, manuscript, 3),
+        measure(logger.format_scenario, manuscript, 3),
+    )
+    report(
+        "shorten_prompt",
+        measure(legacy_shorten_prompt, prompt, 500),
+        measure(logger.shorten_prompt, prompt, 500),
+    )
+    report(
+        "process_response",
+        measure(legacy_process_response, plain_response, 20000),
+        measure(logger.process_response, plain_response, 20000),
+    )
+    report(
+        "process_response (トークン付)",
+        measure(legacy_process_response, token_response, 20000),
+        measure(logger.process_response, token_response, 20000),
+    )
+
+    # 原稿ファイルからの抜粋（初回は全体を走査し、その後は追記分と末尾だけを読む）
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "manuscript.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(manuscript)
+        document = Manuscript(path, "utf-8", logger.format_scenario)
+
+        def append_and_read(path):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("# 花子\n「もう少しだけ書こう」\n\n")
+            return document.get_excerpt()
+
+        document.get_excerpt()
+        report(
+            "抜粋 (追記ごと)",
+            measure(legacy_excerpt, path, 3),
+            measure(append_and_read, path, 50),
+        )
+        report(
+            "抜粋 (変更なし)",
+            measure(legacy_excerpt, path, 3),
+            measure(lambda _: document.get_excerpt(), path, 1000),
+        )
+    logger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# bench/fake_ollama.py
+# ベンチマーク用の Ollama の代わりになる HTTP サーバー（/api/generate のみ）
+#   python bench/fake_ollama.py [--port 11434] [--latency 0.2] [--token-rate 40]
+#                               [--failure-rate 0.0] [--load-delay 0.0]
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 応答として返す文章（トークンの代わりに 2 文字ずつ送る）
+REPLY = "今日は筆が進んでいますね。この場面の空気感がとても好きです。続きが楽しみです。"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._send_json(400, {"error": "invalid json"})
+            return
+        server.count("requests")
+
+        if self.path != "/api/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+        server.load_model(payload.get("model"))
+        if not payload.get("prompt"):
+            # プロンプトなしはモデルの読み込み（keep_alive）だけ
+            server.count("warm_ups")
+            self._send_json(200, {"model": payload.get("model"), "done": True})
+            return
+        if server.should_fail():
+            server.count("failures")
+            self._send_json(500, {"error": "injected failure"})
+            return
+
+        time.sleep(server.latency)
+        context = list(payload.get("context") or [])
+        context.extend(range(len(payload["prompt"]) // 2))
+        tokens = [REPLY[i : i + 2] for i in range(0, len(REPLY), 2)]
+        final = {
+            "done": True,
+            "context": context,
+            "prompt_eval_count": len(payload["prompt"]) // 2,
+            "eval_count": len(tokens),
+        }
+
+        if not payload.get("stream", True):
+            time.sleep(len(tokens) / server.token_rate)
+            self._send_json(200, {"response": REPLY, **final})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(1 / server.token_rate)
+            self._write_chunk({"response": token, "done": False})
+        self._write_chunk({"response": "", **final})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        line = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """
+    遅延・トークンの生成速度・失敗の割合を指定できる偽の Ollama
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.2,
+        token_rate=40.0,
+        failure_rate=0.0,
+        load_delay=0.0,
+    ):
+        super().__init__((host, port), FakeOllamaHandler)
+        self.latency = latency  # 最初のトークンまでの時間（秒）
+        self.token_rate = token_rate  # 1 秒あたりのトークン数
+        self.failure_rate = failure_rate  # 500 を返す割合
+        self.load_delay = load_delay  # モデルごとの最初の読み込みにかかる時間（秒）
+        self.loading = {}  # モデル名 -> 読み込みが終わったら set される Event
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "warm_ups": 0, "failures": 0, "disconnects": 0}
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def load_model(self, model):
+        # 同じモデルへの最初のリクエストだけ読み込みを待たせる（同時に来たものも待つ）
+        with self.lock:
+            loaded = self.loading.get(model)
+            if loaded is None:
+                loaded = self.loading[model] = threading.Event()
+                first = True
+            else:
+                first = False
+        if first:
+            time.sleep(self.load_delay)
+            loaded.set()
+        else:
+            loaded.wait()
+
+    def handle_error(self, request, client_address):
+        # 応答の途中で接続を切られるのはよくあることなので、数えるだけにする
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            self.count("disconnects")
+            return
+        super().handle_error(request, client_address)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="偽の Ollama サーバー")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=40.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--load-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(
+        port=args.port,
+        latency=args.latency,
+        token_rate=args.token_rate,
+        failure_rate=args.failure_rate,
+        load_delay=args.load_delay,
+    )
+    print(f"偽の Ollama を起動しました: {server.api_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"リクエスト数: {server.counters}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# context_store.py
+
+import ast
+import hashlib
+import json
+import os
+import sys
+import threading
+from array import array
+from metrics import log_event
+
+
+class ContextTokens(list):
+    """
+    Ollama の context（トークン ID の列）
+    JSON にしたバイト列を一度だけ作り、毎回のリクエストで使い回す
+    作った後に中身を書き換えないこと
+    """
+
+    def __init__(self, tokens=()):
+        super().__init__(tokens)
+        self._json_bytes = None
+
+    def to_json_bytes(self):
+        if self._json_bytes is None:
+            self._json_bytes = json.dumps(self, separators=(",", ":")).encode("ascii")
+        return self._json_bytes
+
+
+def parse_context(context_str):
+    """
+    フォームやログに書かれた context（"[1, 2, 3]" の形式）を読み込む
+    """
+    try:
+        tokens = json.loads(context_str)
+    except ValueError:
+        # 以前の Python リテラル形式にも対応する
+        tokens = ast.literal_eval(context_str)
+    return ContextTokens(int(t) for t in tokens)
+
+
+class ContextStore:
+    """
+    context を array('i') のバイナリファイルとして保存する
+    settings.json には巨大なリストではなくファイルのパスだけを書く
+    """
+
+    def __init__(self, directory="contexts"):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def path_for(self, model_name, system_prompt):
+        # モデルとシステムプロンプトの組み合わせごとに 1 ファイル
+        digest = hashlib.blake2b(
+            f"{model_name}\0{system_prompt}".encode("utf-8"), digest_size=12
+        ).hexdigest()
+        return os.path.join(self.directory, f"{digest}.ctx")
+
+    def save(self, model_name, system_prompt, context):
+        path = self.path_for(model_name, system_prompt)
+        data = array("i", context)
+        if sys.byteorder != "little":
+            data.byteswap()
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # 書き込み途中のファイルを読まないよう、別名で書いてから置き換える
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                data.tofile(f)
+            os.replace(tmp_path, path)
+        return path
+
+    def load(self, path):
+        """
+        保存した context を読み込む（読めなければ None）
+        """
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except OSError as e:
+            log_event("context_read_error", f"コンテキストの読み込み中にエラーが発生しました: {e}")
+            return None
+        data = array("i")
+        data.frombytes(raw[: len(raw) - len(raw) % data.itemsize])
+        if sys.byteorder != "little":
+            data.byteswap()
+        return ContextTokens(data)
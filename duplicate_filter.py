@@ -0,0 +1,128 @@
+# duplicate_filter.py
+
+import hashlib
+import random
+import threading
+import time
+import unicodedata
+from array import array
+from metrics import get_metrics
+
+# MinHash のハッシュ関数 (a * x + b) mod p に使う素数（2^61 - 1）
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize(text):
+    """
+    句読点・括弧・記号・空白を除き、全角と半角をそろえる
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    # 文字（L）と数字（N）だけを残す（長音符「ー」は文字として残る）
+    return "".join(c for c in text if unicodedata.category(c)[0] in "LN")
+
+
+class DuplicateFilter:
+    """
+    最近のコメントとほぼ同じコメントを見分ける
+    文字 n-gram の MinHash を固定長の array に輪状に記録し、一致する割合で
+    Jaccard 係数を見積もる。日本語は単語に分けずに文字の 2-gram を使う
+    """
+
+    def __init__(self, capacity=32, threshold=0.7, num_hashes=32, ngram=2, seed=1):
+        self.capacity = capacity  # 覚えておくコメントの数
+        self.threshold = threshold  # これ以上似ていれば重複とみなす
+        self.num_hashes = num_hashes
+        self.ngram = ngram
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME))
+            for _ in range(num_hashes)
+        ]
+        self.lock = threading.Lock()
+        # capacity 件分の署名を 1 つの array に並べる
+        self.signatures = array("Q", bytes(8 * capacity * num_hashes))
+        self.filled = 0
+        self.position = 0  # 次に書き込む場所
+        self.metrics = get_metrics()
+
+        self.checks = 0
+        self.duplicates = 0
+        self.check_seconds = 0.0
+        # 最も似ていたコメントとの類似度の分布（0.1 刻み、閾値の調整用）
+        self.similarity_counts = [0] * 10
+
+    def fingerprint(self, text):
+        # MinHash の署名（空の文字列なら None）
+        text = normalize(text)
+        if not text:
+            return None
+        n = self.ngram
+        shingles = {text[i : i + n] for i in range(max(len(text) - n + 1, 1))}
+        hashes = [
+            int.from_bytes(
+                hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little"
+            )
+            for s in shingles
+        ]
+        return array(
+            "Q",
+            (
+                min((a * h + b) % MERSENNE_PRIME for h in hashes)
+                for a, b in self.permutations
+            ),
+        )
+
+    def _best_match(self, signature):
+        best = 0.0
+        k = self.num_hashes
+        for slot in range(self.filled):
+            offset = slot * k
+            stored = self.signatures[offset : offset + k]
+            same = sum(1 for x, y in zip(signature, stored) if x == y)
+            best = max(best, same / k)
+        return best
+
+    def check(self, text, remember=True):
+        """
+        (重複か, 最も似ていたコメントとの類似度) を返す
+        remember=True なら、重複でなかったコメントを記録する
+        """
+        start = time.perf_counter()
+        signature = self.fingerprint(text)
+        if signature is None:
+            return False, 0.0
+        with self.lock:
+            similarity = self._best_match(signature)
+            duplicate = similarity >= self.threshold
+            if remember and not duplicate:
+                offset = self.position * self.num_hashes
+                self.signatures[offset : offset + self.num_hashes] = signature
+                self.position = (self.position + 1) % self.capacity
+                self.filled = min(self.filled + 1, self.capacity)
+            elapsed = time.perf_counter() - start
+            self.checks += 1
+            self.duplicates += duplicate
+            self.check_seconds += elapsed
+            self.similarity_counts[min(int(similarity * 10), 9)] += 1
+        self.metrics.inc("duplicate_checks_total")
+        self.metrics.observe("duplicate_check_seconds", elapsed)
+        return duplicate, similarity
+
+    def clear(self):
+        with self.lock:
+            self.filled = 0
+            self.position = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "threshold": self.threshold,
+                "stored": self.filled,
+                "checks": self.checks,
+                "duplicates": self.duplicates,
+                "duplicate_rate": self.duplicates / self.checks if self.checks else 0.0,
+                "check_ms": (
+                    self.check_seconds / self.checks * 1000 if self.checks else 0.0
+                ),
+                "similarity_counts": list(self.similarity_counts),
+            }
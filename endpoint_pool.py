@@ -0,0 +1,204 @@
+# endpoint_pool.py
+
+import random
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+from metrics import get_metrics, log_event
+from timer_service import get_timer_service
+
+# 再試行するステータスコード（混雑中・再起動中）
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class BackendUnavailable(Exception):
+    """
+    使える Ollama のエンドポイントがない（すべてのサーキットブレーカーが開いている）
+    """
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    # 上限付きの指数バックオフに揺らぎを加える（full jitter）
+    return random.uniform(0, min(cap, base * (2**attempt)))
+
+
+class CircuitBreaker:
+    """
+    連続して failure_threshold 回失敗したら reset_timeout 秒の間リクエストを止める
+    時間が経ったら 1 件だけ試し、成功すれば元に戻す
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def can_attempt(self):
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.trial_in_flight)
+
+    def begin(self):
+        if self.opened_at is not None:
+            self.trial_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        # 開いたばかりなら True を返す
+        self.failures += 1
+        was_closed = self.opened_at is None
+        if self.trial_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+            return was_closed
+        return False
+
+
+class Endpoint:
+    def __init__(self, url, breaker):
+        self.url = url
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.use_ssl = parts.scheme == "https"
+        self.port = parts.port or (443 if self.use_ssl else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.base_url = f"{parts.scheme}://{parts.netloc}"
+        self.breaker = breaker
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+
+class EndpointPool:
+    """
+    複数の Ollama のエンドポイントを、処理中の件数が少ない順に使い分ける
+    エンドポイントごとにサーキットブレーカーを持ち、止まっているものは
+    定期的に /api/tags へ問い合わせて復帰を確認する
+    """
+
+    def __init__(
+        self,
+        urls,
+        failure_threshold=3,
+        reset_timeout=30.0,
+        health_interval=10.0,
+        timer_service=None,
+    ):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.endpoints = [
+            Endpoint(url, CircuitBreaker(failure_threshold, reset_timeout))
+            for url in urls
+        ]
+        self.lock = threading.Lock()
+        self.metrics = get_metrics()
+        self.health_interval = health_interval
+        self.timer_service = timer_service or get_timer_service()
+        self.health_handle = None
+        self.closed = False
+        if health_interval:
+            self.health_handle = self.timer_service.call_later(
+                health_interval, self.check_health
+            )
+
+    def acquire(self, exclude=()):
+        """
+        使うエンドポイントを選んで処理中の件数を増やす（なければ None）
+        exclude には再試行のときに前回失敗したものを渡す
+        """
+        with self.lock:
+            candidates = [
+                e
+                for e in self.endpoints
+                if e.breaker.can_attempt() and e not in exclude
+            ]
+            if not candidates and exclude:
+                # 他に使えるものがなければ同じエンドポイントで再試行する
+                candidates = [e for e in self.endpoints if e.breaker.can_attempt()]
+            if not candidates:
+                return None
+            endpoint = min(candidates, key=lambda e: (e.in_flight, e.requests))
+            endpoint.breaker.begin()
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, ok):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.breaker.record_success()
+                return
+            endpoint.failures += 1
+            opened = endpoint.breaker.record_failure()
+        self.metrics.inc("llm_endpoint_failures_total", endpoint=endpoint.base_url)
+        if opened:
+            self.metrics.inc("llm_circuit_opened_total", endpoint=endpoint.base_url)
+            log_event(
+                "circuit_open",
+                f"LLM のサーバーに接続できないため一時的に停止します: {endpoint.base_url}",
+                endpoint=endpoint.base_url,
+            )
+
+    def available(self):
+        with self.lock:
+            return any(e.breaker.state != "open" for e in self.endpoints)
+
+    def check_health(self):
+        # 止まっているエンドポイントに軽い問い合わせをして、応答があれば戻す
+        for endpoint in self.endpoints:
+            with self.lock:
+                if endpoint.breaker.state == "closed":
+                    continue
+            try:
+                with urllib.request.urlopen(endpoint.base_url + "/api/tags", timeout=3):
+                    pass
+            except Exception:
+                continue
+            with self.lock:
+                endpoint.breaker.record_success()
+            log_event(
+                "circuit_closed",
+                f"LLM のサーバーが復帰しました: {endpoint.base_url}",
+                endpoint=endpoint.base_url,
+            )
+        with self.lock:
+            if not self.closed:
+                self.health_handle = self.timer_service.call_later(
+                    self.health_interval, self.check_health
+                )
+
+    def get_stats(self):
+        with self.lock:
+            return [
+                {
+                    "url": e.url,
+                    "state": e.breaker.state,
+                    "in_flight": e.in_flight,
+                    "requests": e.requests,
+                    "failures": e.failures,
+                }
+                for e in self.endpoints
+            ]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.health_handle is not None:
+                self.timer_service.cancel(self.health_handle)
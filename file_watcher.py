@@ -0,0 +1,143 @@
+# file_watcher.py
+
+import os
+import sys
+import struct
+import select
+import threading
+import time
+import ctypes
+import ctypes.util
+from metrics import log_event
+
+# inotify のイベント種別（linux/inotify.h）
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _init_inotify(directory):
+    # 使えない環境では None を返し、stat によるポーリングに切り替える
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # エディタは別名保存→置き換えを行うことが多いのでディレクトリごと監視する
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """
+    原稿ファイルの変更を監視し、保存が落ち着いたところで on_change を呼ぶ
+    Linux では inotify、それ以外では os.stat のポーリングで変更を検出する
+    """
+
+    def __init__(self, filepath, on_change, debounce=2.0, poll_interval=1.0):
+        self.filepath = os.path.abspath(filepath)
+        self.directory = os.path.dirname(self.filepath)
+        self.filename = os.fsencode(os.path.basename(self.filepath))
+        self.on_change = on_change
+        self.debounce = debounce  # 最後の変更からこの秒数だけ静かになったら通知
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.stop_lock = threading.Lock()
+        self.last_key = self.stat_key()
+        self.change_count = 0
+
+        self.inotify_fd = _init_inotify(self.directory)
+        self.mode = "inotify" if self.inotify_fd is not None else "polling"
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        log_event(
+            "watcher_started", f"ファイル監視を開始しました（{self.mode}）。", mode=self.mode
+        )
+
+    def stat_key(self):
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def wait_for_event(self, timeout):
+        # 対象ファイルへのイベントがあれば True
+        if self.inotify_fd is None:
+            return not self.stop_event.wait(timeout)
+        ready, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            data = os.read(self.inotify_fd, 4096)
+        except BlockingIOError:
+            return False
+        found = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if name == self.filename:
+                found = True
+        return found
+
+    def run(self):
+        pending_since = None  # 未通知の変更を最後に検出した時刻
+        while not self.stop_event.is_set():
+            if pending_since is None:
+                timeout = self.poll_interval
+            else:
+                timeout = max(0.0, self.debounce - (time.monotonic() - pending_since))
+                timeout = min(timeout, self.poll_interval)
+
+            self.wait_for_event(timeout)
+            if self.stop_event.is_set():
+                break
+
+            # 通知の有無にかかわらず stat で実際に変わったかを確かめる
+            key = self.stat_key()
+            if key != self.last_key:
+                self.last_key = key
+                pending_since = time.monotonic()
+                continue
+
+            if (
+                pending_since is not None
+                and time.monotonic() - pending_since >= self.debounce
+            ):
+                pending_since = None
+                if key is None:
+                    continue
+                self.change_count += 1
+                try:
+                    self.on_change()
+                except Exception as e:
+                    log_event(
+                        "watcher_error", f"変更通知の処理中にエラーが発生しました: {e}"
+                    )
+
+    def stop(self):
+        # 何度呼んでもよい（inotify の fd を閉じるのは最初の 1 回だけ）
+        with self.stop_lock:
+            if self.stop_event.is_set():
+                return
+            self.stop_event.set()
+        self.thread.join()
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        log_event("watcher_stopped", "ファイル監視を停止しました。")
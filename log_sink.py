@@ -0,0 +1,119 @@
+# log_sink.py
+
+import os
+import json
+import time
+import threading
+from metrics import log_event
+from timer_service import get_timer_service
+
+
+class JsonlLogSink:
+    """
+    ログを 1 行 1 レコードの JSONL ファイルへ追記する
+    書き込みはまとめて行い、一定間隔で fsync する（タイマーサービス上で実行）
+    ファイルが max_bytes を超えたら連番付きの新しいファイルに切り替える
+    """
+
+    def __init__(
+        self, path, max_bytes=5 * 1024 * 1024, flush_interval=1.0, fsync_interval=5.0
+    ):
+        self.base_path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.part = 0
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.last_fsync = time.monotonic()
+        self.closed = False
+        self.timer_service = get_timer_service()
+        self.handle = self.timer_service.call_later(flush_interval, self._periodic)
+
+    def part_path(self, part):
+        if part == 0:
+            return self.base_path
+        root, ext = os.path.splitext(self.base_path)
+        return f"{root}.{part}{ext}"
+
+    def paths(self):
+        # 書き出し済みのファイルを古い順に返す
+        return [
+            self.part_path(part)
+            for part in range(self.part + 1)
+            if os.path.exists(self.part_path(part))
+        ]
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.pending_lock:
+            self.pending.append(line)
+
+    def _open(self):
+        path = self.part_path(self.part)
+        self.file = open(path, "a", encoding="utf-8")
+        self.size = os.path.getsize(path)
+
+    def flush(self, sync=False):
+        with self.pending_lock:
+            lines, self.pending = self.pending, []
+        with self.io_lock:
+            if lines:
+                if self.file is None:
+                    self._open()
+                for line in lines:
+                    length = len(line.encode("utf-8"))
+                    if self.size > 0 and self.size + length > self.max_bytes:
+                        self._rotate()
+                    self.file.write(line)
+                    self.size += length
+                self.file.flush()
+            if self.file is not None and (
+                sync or time.monotonic() - self.last_fsync >= self.fsync_interval
+            ):
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.monotonic()
+
+    def _rotate(self):
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.part += 1
+        self._open()
+
+    def _periodic(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            log_event("log_write_error", f"ログの書き込み中にエラーが発生しました: {e}")
+        self.handle = self.timer_service.call_later(self.flush_interval, self._periodic)
+
+    def read_records(self):
+        # 書き出し済みのレコードを順に返す
+        self.flush()
+        for path in self.paths():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # 異常終了で途中までしか書かれていない行は読み飛ばす
+                        continue
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.timer_service.cancel(self.handle)
+        self.flush(sync=True)
+        with self.io_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
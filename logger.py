@@ -3,31 +3,72 @@
 import re
 import threading
 import os
+from collections import deque
 from datetime import datetime
+from log_sink import JsonlLogSink
+from metrics import get_metrics, log_event
+
+# 応答に混じる特殊トークン（<|...|> とその片割れ）
+SPECIAL_TOKEN_PATTERNS = (
+    re.compile(r"<\|.*?\|>"),
+    re.compile(r"<\|.*?\|"),
+    re.compile(r"\|.*?\|>"),
+)
+
+# プロンプト中の〔〕で囲まれた原稿部分
+BRACKET_PATTERN = re.compile(r"〔(.*?)〕", re.DOTALL)
+
+# 「# 名前」で始まるセリフブロックと連続した改行
+SCENARIO_PATTERN = re.compile(r"# (\S+)\n((?:[^#>\n].*\n?)+)")
+NEWLINES_PATTERN = re.compile(r"\n+")
 
 
 class Logger:
-    def __init__(self):
-        self.log = []
+    def __init__(self, session_id=None, recent_limit=200):
+        self.session_id = session_id  # 複数セッションのログを区別するため
+        self.model_name = None
+        self.system_prompt = None
+        # context はトークン列をログに書かず、保存したファイルのパスだけを記録する
+        self.context_file = None
+        # メモリには直近のログだけを保持し、全件は JSONL ファイルに追記する
+        self.log = deque(maxlen=recent_limit)
         self.lock = threading.Lock()
+        self.metrics = get_metrics()
         self.logs_directory = "logs"
         # ログフォルダが存在しない場合は作成
         if not os.path.exists(self.logs_directory):
             os.makedirs(self.logs_directory)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = self.log_filename("session", timestamp, "jsonl")
+        self.sink = JsonlLogSink(os.path.join(self.logs_directory, filename))
+
+    def log_filename(self, log_type, timestamp, ext):
+        if self.session_id:
+            return f"chat_log_{log_type}_{timestamp}_{self.session_id[:8]}.{ext}"
+        return f"chat_log_{log_type}_{timestamp}.{ext}"
 
-    def set_model_info(self, model_name, system_prompt, context):
+    def set_model_info(self, model_name, system_prompt, context_file=None):
         with self.lock:
             self.model_name = model_name
             self.system_prompt = system_prompt
-            self.context = context
+            self.context_file = context_file
+            self.sink.write(
+                {
+                    "type": "meta",
+                    "model_name": model_name,
+                    "system_prompt": system_prompt,
+                    "context_file": context_file,
+                }
+            )
 
     def process_response(self, response):
         # レスポンスの加工処理
-        response = re.sub(r"<\|.*?\|>", "", response)
-        response = re.sub(r"<\|.*?\|", "", response)
-        response = re.sub(r"\|.*?\|>", "", response)
-        response = response.replace("|im-start|", "")
-        response = response.replace("|im-end|", "")
+        # 特殊トークンは「|」を含むので、含まない場合は置換自体を省く
+        if "|" in response:
+            for pattern in SPECIAL_TOKEN_PATTERNS:
+                response = pattern.sub("", response)
+            response = response.replace("|im-start|", "")
+            response = response.replace("|im-end|", "")
         if (
             response.startswith("「")
             and response.endswith("」")
@@ -44,20 +85,24 @@ class Logger:
         return response
 
     def shorten_prompt(self, prompt, max_length=100):
-        # プロンプトの短縮処理
-        pattern = r"〔(.*?)〕"
-        matches = re.findall(pattern, prompt, re.DOTALL)
-        shortened_prompt = prompt
-        for match in matches:
+        # プロンプトの短縮処理（〔〕の中身を 1 回の走査で置き換える）
+        def replace_match(match):
+            # 整形しても長さは増えないので、短いものは整形自体を省く
+            if len(match.group(1)) <= max_length:
+                return match.group(0)
             # 改行を除去
-            cleaned_match = self.format_scenario(match)  # match.replace("\n\n", "\n")
-            if len(cleaned_match) > max_length:
-                # 前後を含めて短縮
-                trimmed_prompt = (
-                    cleaned_match[:max_length] + "..." + cleaned_match[-max_length:]
-                )
-                shortened_prompt = shortened_prompt.replace(match, trimmed_prompt)
-        return shortened_prompt
+            cleaned_match = self.format_scenario(match.group(1))
+            if len(cleaned_match) <= max_length:
+                return match.group(0)
+            # 前後を含めて短縮
+            trimmed_prompt = (
+                cleaned_match[:max_length] + "..." + cleaned_match[-max_length:]
+            )
+            return f"〔{trimmed_prompt}〕"
+
+        if "〔" not in prompt:
+            return prompt
+        return BRACKET_PATTERN.sub(replace_match, prompt)
 
     # ※自分用 正規表現を使って形式を変換
     def format_scenario(self, text):
@@ -69,43 +114,64 @@ class Logger:
             )  # セリフ部分を1行にまとめる
             return f"{name}：{dialogue}\n"
 
-        # 正規表現でキャラクター名とセリフ部分を取得・変換
-        text = re.sub(r"# (\S+)\n((?:[^#>\n].*\n?)+)", replace_match, text)
+        with self.metrics.timer("format_scenario_seconds"):
+            # 正規表現でキャラクター名とセリフ部分を取得・変換
+            if "# " in text:
+                text = SCENARIO_PATTERN.sub(replace_match, text)
 
-        # 空行を削除
-        text = re.sub(r"\n+", "\n", text).strip()
+            # 空行を削除
+            text = NEWLINES_PATTERN.sub("\n", text).strip()
 
         return text
 
-    def add_log(self, prompt, response):
-        with self.lock:
-            processed_response = self.process_response(response)
-            shortened_prompt = self.shorten_prompt(prompt)
-            self.log.append(
-                {"prompt": shortened_prompt, "response": processed_response}
+    def add_log(self, prompt, response, processed=False):
+        # processed=True なら response は process_response で加工済み
+        with self.metrics.timer("add_log_seconds"):
+            # 文字列の加工はロックの外で行う
+            processed_response = (
+                response if processed else self.process_response(response)
             )
-            return processed_response  # 必要に応じて加工済みのレスポンスを返す
+            shortened_prompt = self.shorten_prompt(prompt)
+            entry = {"prompt": shortened_prompt, "response": processed_response}
+            with self.lock:
+                self.log.append(entry)
+                self.sink.write(
+                    {"type": "entry", "time": datetime.now().isoformat(), **entry}
+                )
+        return processed_response  # 必要に応じて加工済みのレスポンスを返す
 
     def save_log(self, log_type="auto"):
+        # JSONL から従来の読みやすい形式のテキストを作る
         with self.lock:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"chat_log_{log_type}_{timestamp}.txt"
+            filename = self.log_filename(log_type, timestamp, "txt")
             filepath = os.path.join(self.logs_directory, filename)
+            meta = {
+                "model_name": self.model_name,
+                "system_prompt": self.system_prompt,
+                "context_file": self.context_file,
+            }
+            records = self.sink.read_records()
             with open(filepath, "w", encoding="utf-8") as f:
                 f.write("=== メタ情報 ===\n")
-                f.write(f"モデル名: {self.model_name or '不明'}\n")
-                f.write(f"システムプロンプト: {self.system_prompt or '不明'}\n")
-                f.write(f"コンテキスト: {self.context or 'なし'}\n")
+                f.write(f"モデル名: {meta['model_name'] or '不明'}\n")
+                f.write(f"システムプロンプト: {meta['system_prompt'] or '不明'}\n")
+                f.write(f"コンテキストファイル: {meta['context_file'] or 'なし'}\n")
                 f.write("=== ログ ===\n")
-                for entry in self.log:
+                for entry in records:
+                    if entry.get("type") != "entry":
+                        continue
                     f.write("Prompt:\n")
                     f.write(entry["prompt"] + "\n")
                     f.write("Response:\n")
                     f.write(entry["response"] + "\n")
                     f.write("-" * 40 + "\n")
-            print(f"ログを保存しました: {filepath}")
+            log_event("log_saved", f"ログを保存しました: {filepath}", path=filepath)
             return filepath
 
+    def close(self):
+        self.sink.close()
+
 
 _logger_instance = None
 _logger_lock = threading.Lock()
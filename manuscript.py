@@ -0,0 +1,208 @@
+# manuscript.py
+
+import os
+import re
+import mmap
+import threading
+from metrics import get_metrics, log_event
+from text_encoding import decode_bytes, get_encoding_cache, read_text
+
+SUMMARY_PATTERN = re.compile(
+    r"<!--\s*SUMMARY_START\s*-->(.*?)<!--\s*SUMMARY_END\s*-->", re.DOTALL
+)
+
+# 要約ブロックの目印（追記部分にこれが含まれる場合は要約を読み直す）
+SUMMARY_MARKER = b"SUMMARY_"
+
+# format_scenario のセリフブロックは空行・「#」「>」で始まる行で終わるので、
+# これらの行頭で切れば末尾だけ整形しても全体を整形した結果と一致する
+BLOCK_BOUNDARIES = (b"\n\n", b"\n\r\n", b"\n#", b"\n>")
+
+
+def normalize_newlines(text):
+    # テキストモードで開いた場合と同じ改行に揃える
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class Manuscript:
+    """
+    原稿ファイルの要約ブロックと末尾の整形済みテキストを保持するキャッシュ
+    (mtime, size, inode) が変わらなければ読み直さず、追記だけなら要約を使い回す
+    末尾は mmap で後ろから必要な分だけ読むため、原稿の長さに比例しない
+    """
+
+    def __init__(self, filepath, encoding, formatter, window=3000):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.formatter = formatter  # Logger.format_scenario
+        self.window = window
+        self.lock = threading.Lock()
+
+        self.key = None
+        self.size = 0
+        self.boundary_bytes = b""  # 前回の末尾数バイト（追記かどうかの判定用）
+        self.summary = None
+        self.last_body = ""
+
+        # 読み込みの統計
+        self.cache_hits = 0
+        self.append_updates = 0
+        self.full_rebuilds = 0
+        self.metrics = get_metrics()
+        self.encoding_cache = get_encoding_cache()
+        self.set_encoding(encoding)
+
+    def set_encoding(self, encoding):
+        # self.lock を保持した状態、または初期化中に呼ぶ
+        self.encoding = encoding
+        # UTF-16 などは改行がそのままのバイトにならないので全体読み込みにする
+        self.ascii_compatible = "\n".encode(encoding, errors="ignore") == b"\n"
+        self.key = None
+
+    def get_excerpt(self):
+        """
+        (要約, 整形済み本文の末尾 window 文字) を返す
+        """
+        with self.metrics.timer("manuscript_read_seconds"), self.lock:
+            try:
+                stat = os.stat(self.filepath)
+            except OSError as e:
+                log_event("read_error", f"テキストの読み込み中にエラーが発生しました: {e}")
+                return None, ""
+
+            key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if key == self.key:
+                self.cache_hits += 1
+                self.metrics.inc("manuscript_reads_total", outcome="cache_hit")
+                return self.summary, self.last_body
+
+            try:
+                # ASCII だけだった原稿に日本語が書き足された場合などは判定し直す
+                encoding = self.encoding_cache.detect(self.filepath)
+                if encoding != self.encoding:
+                    self.set_encoding(encoding)
+                if not self.ascii_compatible:
+                    self._rebuild_from_text()
+                elif stat.st_size == 0:
+                    self.summary, self.last_body = None, ""
+                    self.boundary_bytes = b""
+                else:
+                    with open(self.filepath, "rb") as f:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            self._update(mm, stat)
+            except Exception as e:
+                log_event("read_error", f"テキストの読み込み中にエラーが発生しました: {e}")
+                return None, ""
+
+            self.key = key
+            self.size = stat.st_size
+            return self.summary, self.last_body
+
+    def _is_append(self, mm, stat):
+        if self.key is None or stat.st_ino != self.key[2]:
+            return False
+        if len(mm) <= self.size or not self.boundary_bytes:
+            return False
+        start = self.size - len(self.boundary_bytes)
+        return mm[start : self.size] == self.boundary_bytes
+
+    def _update(self, mm, stat):
+        if self._is_append(mm, stat):
+            # 目印が境界をまたいでいても見つかるよう少し手前から調べる
+            overlap = max(0, self.size - len(SUMMARY_MARKER))
+            if mm.find(SUMMARY_MARKER, overlap) == -1:
+                self.append_updates += 1
+                self.metrics.inc("manuscript_reads_total", outcome="append")
+            else:
+                self._rescan_summary(mm)
+        else:
+            self._rescan_summary(mm)
+
+        self.last_body = self._scan_tail(mm)
+        self.boundary_bytes = mm[max(0, len(mm) - 64) :]
+
+    def _rescan_summary(self, mm):
+        self.full_rebuilds += 1
+        self.metrics.inc("manuscript_reads_total", outcome="full")
+        with self.metrics.timer("summary_scan_seconds"):
+            self.summary = self._scan_summary(mm)
+
+    def _decode(self, data):
+        # 保存途中で末尾の文字が欠けていても置換文字にせず捨てる
+        return normalize_newlines(decode_bytes(data, self.encoding, final=False))
+
+    def _scan_summary(self, mm):
+        # 最初の要約ブロックだけを取り出す（正規表現の re.search と同じ）
+        pos = mm.find(b"SUMMARY_START")
+        while pos != -1:
+            begin = mm.rfind(b"<!--", 0, pos)
+            end_marker = mm.find(b"SUMMARY_END", pos)
+            if begin == -1 or end_marker == -1:
+                return None
+            end = mm.find(b"-->", end_marker)
+            if end == -1:
+                return None
+            match = SUMMARY_PATTERN.search(self._decode(mm[begin : end + 3]))
+            if match:
+                return match.group(1).strip()
+            pos = mm.find(b"SUMMARY_START", pos + 1)
+        return None
+
+    def _block_start(self, mm, before, lowest):
+        # lowest から before の間で最も近いブロック境界の行頭を返す（なければ 0）
+        start = 0
+        for boundary in BLOCK_BOUNDARIES:
+            index = mm.rfind(boundary, lowest, before)
+            if index != -1:
+                # 「\n#」「\n>」は改行の直後、空行は空行の直後から
+                offset = 1 if boundary[-1:] in (b"#", b">") else len(boundary)
+                start = max(start, index + offset)
+        return start
+
+    def _scan_tail(self, mm):
+        size = len(mm)
+        # 1文字あたり最大 4 バイトとして読み始め、足りなければ倍々に広げる
+        back = self.window * 4
+        while True:
+            if back >= size:
+                start = 0
+            else:
+                # 境界を探す範囲も限定し、見つからなければ範囲を広げて読み直す
+                start = self._block_start(mm, size - back, max(0, size - 2 * back))
+                if start == 0 and size - 2 * back > 0:
+                    back *= 2
+                    continue
+            text = self._decode(mm[start:size])
+            if start > 0 and self._has_open_summary(text):
+                # 要約ブロックの途中から読んでいる場合は広げ直す
+                back *= 2
+                continue
+            body = SUMMARY_PATTERN.sub("", text)
+            body = self.formatter(body)
+            if start == 0 or len(body) >= self.window:
+                return body[-self.window :]
+            back *= 2
+
+    def _has_open_summary(self, text):
+        end = text.find("SUMMARY_END")
+        if end == -1:
+            return False
+        start = text.find("SUMMARY_START")
+        return start == -1 or start > end
+
+    def _rebuild_from_text(self):
+        self.full_rebuilds += 1
+        self.metrics.inc("manuscript_reads_total", outcome="full")
+        text = normalize_newlines(read_text(self.filepath, self.encoding))
+        match = SUMMARY_PATTERN.search(text)
+        self.summary = match.group(1).strip() if match else None
+        body = self.formatter(SUMMARY_PATTERN.sub("", text))
+        self.last_body = body[-self.window :]
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "cache_hits": self.cache_hits,
+                "append_updates": self.append_updates,
+                "full_rebuilds": self.full_rebuilds,
+            }
@@ -0,0 +1,321 @@
+# manuscript_index.py
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from collections import Counter
+from metrics import get_metrics, log_event
+from text_encoding import decode_bytes
+from timer_service import get_timer_service
+
+# 索引ファイルの形式が変わったら上げる
+INDEX_VERSION = 1
+
+# ハッシュを取る単位（行の途中では切らない）
+CHUNK_BYTES = 16 * 1024
+
+# 索引を更新してから保存するまでの秒数（その間の更新はまとめて 1 回で保存する）
+SAVE_DELAY = 30
+
+# 「## 見出し」と「# 名前」のセリフブロック（Logger.format_scenario と同じ形式）
+HEADING_PATTERN = re.compile(rb"^#{2,6}[ \t]+([^\r\n]+)", re.MULTILINE)
+DIALOGUE_PATTERN = re.compile(
+    rb"^# (\S+)\r?\n((?:[^#>\r\n][^\n]*\n?)+)", re.MULTILINE
+)
+SUMMARY_BLOCK_PATTERN = re.compile(
+    rb"<!--\s*SUMMARY_START\s*-->.*?<!--\s*SUMMARY_END\s*-->", re.DOTALL
+)
+# 「第一章」「第3話」のような行も見出しとして扱う
+CHAPTER_PATTERN = re.compile(
+    r"^第\s*[0-9０-９一二三四五六七八九十百千]+\s*[章話節部幕]"
+)
+
+
+class ManuscriptIndex:
+    """
+    原稿の見出し・セリフブロック・要約ブロックのバイト位置と、登場人物ごとの
+    セリフの数を記録する索引。索引は index_dir に保存し、次回の起動時にも使う
+    原稿は一定の大きさの塊ごとにハッシュを覚え、変わった塊から後ろだけを読み直す
+    """
+
+    def __init__(self, filepath, encoding, index_dir="indexes", save_delay=SAVE_DELAY):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.index_path = os.path.join(
+            index_dir,
+            hashlib.blake2b(
+                os.path.abspath(filepath).encode("utf-8"), digest_size=12
+            ).hexdigest()
+            + ".json",
+        )
+        self.lock = threading.Lock()
+        self.metrics = get_metrics()
+        self.save_delay = save_delay
+        self.save_handle = None  # 保存の予約（未保存の更新があるときだけ）
+        # UTF-16 などはバイト列のまま行を探せないので索引を作らない
+        self.enabled = "\n".encode(encoding, errors="ignore") == b"\n"
+        self.chapter_prefix = re.compile(
+            b"^" + re.escape("第".encode(encoding, errors="ignore")), re.MULTILINE
+        )
+
+        self.key = None  # (mtime_ns, size)
+        self.size = 0
+        self.chunks = []  # [開始位置, 長さ, ハッシュ]
+        self.headings = []  # [開始位置, 見出し]
+        self.dialogues = []  # [開始位置, 終了位置, 名前]
+        self.summaries = []  # [開始位置, 終了位置]
+        self.counts = Counter()  # 名前 -> セリフブロックの数
+        # 名前 -> その人物のセリフブロックの (開始位置の一覧, 終了位置の一覧)
+        self.by_name = {}
+
+        self.rescanned_bytes = 0
+        self.refreshes = 0
+        self._load()
+
+    def _load(self):
+        if not self.enabled:
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            data.get("version") != INDEX_VERSION
+            or data.get("encoding") != self.encoding
+        ):
+            return
+        # 保存時の原稿と違っていても、ハッシュの比較で変わった所から読み直される
+        self.size = data["size"]
+        self.chunks = data["chunks"]
+        self.headings = data["headings"]
+        self.dialogues = data["dialogues"]
+        self.summaries = data["summaries"]
+        self._rebuild_names()
+
+    def _save(self):
+        data = {
+            "version": INDEX_VERSION,
+            "path": os.path.abspath(self.filepath),
+            "encoding": self.encoding,
+            "size": self.size,
+            "chunks": self.chunks,
+            "headings": self.headings,
+            "dialogues": self.dialogues,
+            "summaries": self.summaries,
+            "counts": dict(self.counts),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            log_event("index_save_error", f"索引の保存中にエラーが発生しました: {e}")
+
+    def refresh(self):
+        """
+        原稿が変わっていれば索引を更新する（変わった部分だけを読む）
+        """
+        if not self.enabled:
+            return False
+        with self.lock:
+            try:
+                stat = os.stat(self.filepath)
+            except OSError as e:
+                log_event(
+                    "index_refresh_error", f"索引の更新中にエラーが発生しました: {e}"
+                )
+                return False
+            key = (stat.st_mtime_ns, stat.st_size)
+            if key == self.key:
+                return False
+            with self.metrics.timer("manuscript_index_seconds"):
+                if stat.st_size == 0:
+                    self._truncate(0)
+                else:
+                    with open(self.filepath, "rb") as f:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            self._update(mm)
+            self.key = key
+            self.size = stat.st_size
+            self.refreshes += 1
+            self._schedule_save()
+            return True
+
+    def _schedule_save(self):
+        # self.lock を保持した状態で呼ぶ
+        if self.save_handle is None:
+            self.save_handle = get_timer_service().call_later(
+                self.save_delay, self.flush
+            )
+
+    def flush(self):
+        # 未保存の更新があれば索引を保存する（セッションを閉じるときにも呼ぶ）
+        with self.lock:
+            if self.save_handle is None:
+                return
+            get_timer_service().cancel(self.save_handle)
+            self.save_handle = None
+            self._save()
+
+    def _chunk_matches(self, mm, chunk):
+        offset, length, digest = chunk
+        if offset + length > len(mm):
+            return False
+        return _digest(mm[offset : offset + length]) == digest
+
+    def _first_changed(self, mm):
+        # 追記なら最後の塊だけ確かめる。そうでなければ先頭から比べる
+        if self.chunks and len(mm) > self.size:
+            if self._chunk_matches(mm, self.chunks[-1]):
+                return self.chunks[-1][0]
+        for chunk in self.chunks:
+            if not self._chunk_matches(mm, chunk):
+                return chunk[0]
+        # 最後の行が書きかけだった場合に備えて最後の塊は読み直す
+        return self.chunks[-1][0] if self.chunks else 0
+
+    def _update(self, mm):
+        start, chunk_start = self._truncate(self._first_changed(mm))
+        self.rescanned_bytes += len(mm) - start
+        self.metrics.inc("manuscript_index_bytes_total", len(mm) - start)
+
+        self.chunks.extend(_make_chunks(mm, chunk_start))
+        for match in HEADING_PATTERN.finditer(mm, start):
+            self.headings.append([match.start(), self._decode(match.group(1))])
+        for match in self.chapter_prefix.finditer(mm, start):
+            line_end = mm.find(b"\n", match.start())
+            line_end = len(mm) if line_end == -1 else line_end
+            title = self._decode(mm[match.start() : line_end]).strip()
+            if CHAPTER_PATTERN.match(title):
+                self.headings.append([match.start(), title])
+        self.headings.sort()
+        for match in DIALOGUE_PATTERN.finditer(mm, start):
+            name = self._decode(match.group(1))
+            self.dialogues.append([match.start(), match.end(), name])
+        for match in SUMMARY_BLOCK_PATTERN.finditer(mm, start):
+            self.summaries.append([match.start(), match.end()])
+        self._rebuild_names()
+
+    def _truncate(self, offset):
+        """
+        offset 以降に関わる記録を捨て、(読み直しを始める位置, 塊を作り直す位置) を返す
+        offset をまたぐセリフや要約のブロックは、その先頭から読み直す
+        """
+        while True:
+            start = offset
+            for spans in (self.dialogues, self.summaries):
+                for span in spans:
+                    if span[0] < offset <= span[1]:
+                        offset = span[0]
+            if offset == start:
+                break
+        # ハッシュは塊ごとなので、offset を含む塊の先頭から作り直す
+        chunk_start = offset
+        for chunk in self.chunks:
+            if chunk[0] <= offset < chunk[0] + chunk[1]:
+                chunk_start = chunk[0]
+                break
+        self.chunks = [c for c in self.chunks if c[0] < chunk_start]
+        self.headings = [h for h in self.headings if h[0] < offset]
+        self.dialogues = [d for d in self.dialogues if d[0] < offset]
+        self.summaries = [s for s in self.summaries if s[0] < offset]
+        return offset, chunk_start
+
+    def _rebuild_names(self):
+        by_name = {}
+        for start, end, name in self.dialogues:
+            starts, ends = by_name.setdefault(name, ([], []))
+            starts.append(start)
+            ends.append(end)
+        self.by_name = by_name
+        self.counts = Counter({name: len(v[0]) for name, v in by_name.items()})
+
+    def _decode(self, data):
+        return decode_bytes(data, self.encoding).replace("\r", "")
+
+    def current_chapter(self):
+        """
+        (見出し, 開始位置) を返す。見出しがなければ (None, 0)
+        """
+        with self.lock:
+            if not self.headings:
+                return None, 0
+            offset, title = self.headings[-1]
+            return title, offset
+
+    def characters(self, since=0):
+        """
+        since 以降にセリフのある登場人物と、そのセリフブロックの数
+        """
+        with self.lock:
+            result = Counter()
+            for name, (starts, _) in self.by_name.items():
+                count = len(starts) - bisect.bisect_left(starts, since)
+                if count:
+                    result[name] = count
+            return result
+
+    def character_lines(self, name, max_chars=800, since=0):
+        """
+        name の直近のセリフを「名前：セリフ」の行にして、古い順に返す
+        読むのは返すセリフの部分だけ
+        """
+        with self.lock:
+            starts, ends = self.by_name.get(name, ([], []))
+            first = bisect.bisect_left(starts, since)
+            spans = list(zip(starts[first:], ends[first:]))
+        lines = []
+        total = 0
+        try:
+            with open(self.filepath, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for start, end in reversed(spans):
+                        match = DIALOGUE_PATTERN.match(mm[start:end])
+                        if match is None:
+                            # 索引の更新前に原稿が書き換えられた
+                            continue
+                        dialogue = self._decode(match.group(2)).replace("\n", "")
+                        lines.append(f"{name}：{dialogue.strip()}")
+                        total += len(lines[-1])
+                        if total >= max_chars:
+                            break
+        except (OSError, ValueError) as e:
+            log_event(
+                "dialogue_read_error", f"セリフの読み込み中にエラーが発生しました: {e}"
+            )
+        return "\n".join(reversed(lines))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "size": self.size,
+                "headings": len(self.headings),
+                "dialogues": len(self.dialogues),
+                "characters": len(self.counts),
+                "refreshes": self.refreshes,
+                "rescanned_bytes": self.rescanned_bytes,
+            }
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def _make_chunks(mm, start):
+    # start から末尾までを CHUNK_BYTES 程度の、行の終わりで切れる塊に分ける
+    chunks = []
+    size = len(mm)
+    while start < size:
+        newline = mm.find(b"\n", min(start + CHUNK_BYTES, size))
+        end = size if newline == -1 else newline + 1
+        chunks.append([start, end - start, _digest(mm[start:end])])
+        start = end
+    return chunks
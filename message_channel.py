@@ -0,0 +1,57 @@
+# message_channel.py
+
+import threading
+import itertools
+from collections import deque
+
+
+class MessageChannel:
+    """
+    チャット画面へ送るメッセージの配信チャネル
+    メッセージに連番を振って一定数だけ保持し、各クライアントは自分のカーソル
+    （最後に受け取った番号）以降を読み出すため、複数タブで取り合いにならない
+    asyncio モードでも配信はスレッドで待つ（/events は WSGI の応答でスレッドを使うため）
+    """
+
+    def __init__(self, maxlen=500):
+        self.messages = deque(maxlen=maxlen)  # (連番, メッセージ) のリスト
+        self.next_seq = 1
+        self.condition = threading.Condition()
+
+    def put(self, message):
+        # queue.Queue と同じ呼び出し方で使えるようにしている
+        with self.condition:
+            self.messages.append((self.next_seq, message))
+            self.next_seq += 1
+            self.condition.notify_all()
+
+    @property
+    def latest_seq(self):
+        return self.next_seq - 1
+
+    def _since(self, cursor):
+        if not self.messages:
+            return [], self.latest_seq
+        # 連番は連続しているので先頭からの位置を直接計算できる
+        first_seq = self.messages[0][0]
+        start = max(0, cursor + 1 - first_seq)
+        items = list(itertools.islice(self.messages, start, None))
+        return items, self.latest_seq
+
+    def get_since(self, cursor=0):
+        with self.condition:
+            if cursor > self.latest_seq:
+                # サーバー再起動などでカーソルが先に進んでいる場合は最初から
+                cursor = 0
+            return self._since(cursor)
+
+    def wait_for(self, cursor=0, timeout=None):
+        """
+        cursor より新しいメッセージが届くまで最大 timeout 秒待ち、
+        ([(連番, メッセージ), ...], 最新の連番) を返す
+        """
+        with self.condition:
+            if cursor > self.latest_seq:
+                cursor = 0
+            self.condition.wait_for(lambda: self.latest_seq > cursor, timeout)
+            return self._since(cursor)
@@ -0,0 +1,220 @@
+# metrics.py
+
+import contextlib
+import json
+import random
+import threading
+import time
+from datetime import datetime
+
+# 所要時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+METRIC_PREFIX = "novel_advicer_"
+
+# 計測しないときに返す何もしないコンテキストマネージャー
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Metrics:
+    """
+    処理ごとの回数と所要時間を集計し、Prometheus のテキスト形式で返す
+    所要時間は sample_rate の割合だけ計測する（回数は常に数える）
+    /metrics が一定時間読まれていなければ idle_sample_rate に下げて負荷を抑える
+    """
+
+    def __init__(
+        self,
+        sample_rate=1.0,
+        idle_sample_rate=0.0,
+        watch_timeout=300.0,
+        json_logs=False,
+        buckets=DEFAULT_BUCKETS,
+    ):
+        self.sample_rate = sample_rate
+        self.idle_sample_rate = idle_sample_rate
+        self.watch_timeout = watch_timeout
+        self.json_logs = json_logs  # True の場合、ログを JSON の 1 行で出す
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # (名前, ラベル) -> 値
+        self.histograms = {}  # (名前, ラベル) -> _Histogram
+        self.gauges = {}  # 名前 -> 値を返す関数
+        self.descriptions = {}
+        self.last_scrape = None  # 最後に /metrics が読まれた時刻
+
+    def configure(self, sample_rate=None, idle_sample_rate=None, json_logs=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if idle_sample_rate is not None:
+            self.idle_sample_rate = idle_sample_rate
+        if json_logs is not None:
+            self.json_logs = json_logs
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def sampled(self):
+        watched = (
+            self.last_scrape is not None
+            and time.monotonic() - self.last_scrape < self.watch_timeout
+        )
+        rate = self.sample_rate if watched else self.idle_sample_rate
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram.counts[i] += 1
+                    break
+            histogram.total += seconds
+            histogram.count += 1
+
+    def timer(self, name, **labels):
+        """
+        with metrics.timer("名前"): の形で所要時間を計測する
+        """
+        if not self.sampled():
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, func):
+        # 取得時に func() を呼んで現在値を返す
+        self.gauges[name] = func
+
+    def log_event(self, event, message, **fields):
+        """
+        print の代わり。json_logs の場合は event と fields を含む JSON を出す
+        """
+        if not self.json_logs:
+            print(message)
+            return
+        record = {"time": datetime.now().isoformat(), "event": event}
+        record.update(fields)
+        record["message"] = message
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+    def render_prometheus(self):
+        self.last_scrape = time.monotonic()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.total, h.count)
+                for key, h in self.histograms.items()
+            )
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            metric = METRIC_PREFIX + name
+            header(metric, "counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+        for (name, labels), counts, total, count in histograms:
+            metric = METRIC_PREFIX + name
+            header(metric, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(labels + (("le", repr(bound)),))
+                lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+            inf_labels = _format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{metric}_bucket{inf_labels} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+        for name, func in sorted(self.gauges.items()):
+            metric = METRIC_PREFIX + name
+            try:
+                value = func()
+            except Exception:
+                continue
+            header(metric, "gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+_metrics_instance = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics_instance
+    with _metrics_lock:
+        if _metrics_instance is None:
+            _metrics_instance = Metrics()
+    return _metrics_instance
+
+
+def log_event(event, message, **fields):
+    get_metrics().log_event(event, message, **fields)
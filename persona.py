@@ -0,0 +1,69 @@
+# persona.py
+
+import threading
+
+
+class Persona:
+    """
+    コメントする人物（モデルとシステムプロンプトの組み合わせ）
+    ファンアウトでは原稿の読み込みとプロンプトの組み立てを共有し、
+    人物ごとの context とクライアントで並行して生成する
+    """
+
+    def __init__(
+        self,
+        name,
+        model_name,
+        system_prompt,
+        context,
+        client,
+        async_client=None,
+        weights=None,
+        max_in_flight=1,
+    ):
+        self.name = name
+        self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.context = context
+        self.client = client
+        self.async_client = async_client
+        # ラベル -> 重み（指定のないラベルは共通の重み、0 なら使わない）
+        self.weights = weights or {}
+        self.max_in_flight = max_in_flight  # 同時に生成する数の上限
+        self.greeting = None  # システムプロンプトへの応答（初回のみ）
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.sent = 0
+        self.skipped = 0
+
+    def weighted_prompts(self, prompts_with_weights):
+        prompts = []
+        for weight, label, template, needs_text in prompts_with_weights:
+            weight = self.weights.get(label, weight)
+            if weight > 0:
+                prompts.append((weight, label, template, needs_text))
+        return prompts
+
+    def try_acquire(self, force=False):
+        # 上限に達していれば今回は送らない（force の場合は上限を超えても送る）
+        with self.lock:
+            if self.in_flight >= self.max_in_flight and not force:
+                self.skipped += 1
+                return False
+            self.in_flight += 1
+            self.sent += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "model_name": self.model_name,
+                "in_flight": self.in_flight,
+                "sent": self.sent,
+                "skipped": self.skipped,
+            }
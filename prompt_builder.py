@@ -0,0 +1,222 @@
+# prompt_builder.py
+
+import re
+import threading
+
+# ひらがな・カタカナ（漢字より少ないトークンになりやすい）
+KANA_PATTERN = re.compile(r"[ぁ-ヿ]")
+
+# 文の区切り（閉じ括弧が続く場合はそこまでを 1 文とする）
+SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]+(?:[。！？!?]+[」』）)]*)?")
+
+# format_scenario が作るセリフ行「名前：セリフ」
+DIALOGUE_PATTERN = re.compile(r"([^\s：]+：)(.*)")
+
+
+class TokenEstimator:
+    """
+    文字の種類ごとの重みからトークン数を見積もる
+    トークナイザーを呼ばずに済むよう、少し多めに見積もる重みにしている
+    """
+
+    def __init__(self, ascii_weight=0.3, kana_weight=0.7, other_weight=1.0, scale=1.0):
+        self.ascii_weight = ascii_weight
+        self.kana_weight = kana_weight
+        self.other_weight = other_weight
+        self.scale = scale  # モデルのトークナイザーに合わせた補正
+
+    def estimate(self, text):
+        if not text:
+            return 0
+        ascii_count = len(text.encode("ascii", errors="ignore"))
+        kana_count = len(text) - len(KANA_PATTERN.sub("", text))
+        other_count = len(text) - ascii_count - kana_count
+        tokens = (
+            ascii_count * self.ascii_weight
+            + kana_count * self.kana_weight
+            + other_count * self.other_weight
+        )
+        return int(tokens * self.scale) + 1
+
+    def max_chars(self, tokens):
+        # tokens に収まりうる最大の文字数（原稿を読み込む範囲の目安）
+        weight = min(self.ascii_weight, self.kana_weight, self.other_weight)
+        return int(tokens / (weight * self.scale)) + 1
+
+
+class PromptBuilder:
+    """
+    トークン数の予算に収まるように、要約と本文の末尾を切り詰めてプロンプトを作る
+    予算は context（システムプロンプト分）・テンプレート・要約・本文で分け合い、
+    本文は行（セリフのまとまり）単位、はみ出す行は文単位で切る
+    """
+
+    def __init__(
+        self,
+        budget=2048,
+        reserve=256,
+        summary_share=0.3,
+        min_tokens=64,
+        estimator=None,
+    ):
+        self.budget = budget
+        self.reserve = reserve  # 応答のために空けておくトークン数
+        self.summary_share = summary_share  # 要約に使える割合の上限
+        self.min_tokens = min_tokens  # 予算が尽きていても最低限送る本文の量
+        self.estimator = estimator or TokenEstimator()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.total_tokens = 0
+        self.saved_tokens = 0
+        self.saved_bytes = 0
+        self.last_usage = None
+
+    @property
+    def max_body_chars(self):
+        return self.estimator.max_chars(self.budget)
+
+    def build(
+        self,
+        template,
+        summary,
+        body,
+        context=None,
+        body_label=None,
+        baseline=None,
+        **fields,
+    ):
+        """
+        (プロンプト, トークン数の内訳) を返す
+        baseline には差分を送る場合の元の本文を渡し、節約できた量を記録する
+        """
+        estimate = self.estimator.estimate
+        # context はトークン列そのものなので長さが正確なトークン数になる
+        context_tokens = len(context) if context else 0
+        template_tokens = estimate(template.format(combined_text="", **fields))
+        available = self.budget - self.reserve - context_tokens - template_tokens
+        available = max(available, self.min_tokens)
+
+        summary_text = ""
+        summary_tokens = 0
+        if summary:
+            summary_text, summary_tokens = self.fit_head(
+                summary, int(available * self.summary_share)
+            )
+        body_text, body_tokens = self.fit_tail(body, available - summary_tokens)
+
+        if summary_text:
+            label = body_label or "本文"
+            combined_text = f"要約:\n{summary_text}\n\n{label}:\n{body_text}"
+        elif body_label:
+            combined_text = f"{body_label}:\n{body_text}"
+        else:
+            combined_text = body_text
+        prompt = template.format(combined_text=combined_text, **fields)
+
+        saved_tokens = 0
+        saved_bytes = 0
+        if baseline is not None and baseline is not body:
+            # 全体を送っていた場合に使っていた量との差
+            full_text, full_tokens = self.fit_tail(baseline, available - summary_tokens)
+            saved_tokens = max(0, full_tokens - body_tokens)
+            saved_bytes = max(
+                0, len(full_text.encode("utf-8")) - len(body_text.encode("utf-8"))
+            )
+
+        usage = {
+            "budget": self.budget,
+            "context_tokens": context_tokens,
+            "template_tokens": template_tokens,
+            "summary_tokens": summary_tokens,
+            "body_tokens": body_tokens,
+            "total_tokens": context_tokens
+            + template_tokens
+            + summary_tokens
+            + body_tokens,
+            "body_chars": len(body_text),
+            "saved_tokens": saved_tokens,
+            "saved_bytes": saved_bytes,
+        }
+        with self.lock:
+            self.requests += 1
+            self.total_tokens += usage["total_tokens"]
+            self.saved_tokens += saved_tokens
+            self.saved_bytes += saved_bytes
+            self.last_usage = usage
+        return prompt, usage
+
+    def fit_tail(self, text, budget):
+        # 末尾から行単位で budget に収まるだけ残す
+        estimate = self.estimator.estimate
+        kept = []
+        used = 0
+        for line in reversed(text.split("\n")):
+            cost = estimate(line) + 1
+            if used + cost <= budget:
+                kept.append(line)
+                used += cost
+                continue
+            partial, cost = self._tail_sentences(line, budget - used)
+            if partial:
+                kept.append(partial)
+                used += cost
+            break
+        return "\n".join(reversed(kept)).strip(), used
+
+    def _tail_sentences(self, line, budget):
+        # はみ出した行の末尾の文だけを残す（セリフ行は名前を付け直す）
+        prefix = ""
+        match = DIALOGUE_PATTERN.fullmatch(line)
+        if match:
+            prefix, line = match.groups()
+        estimate = self.estimator.estimate
+        used = estimate(prefix) + 1
+        kept = []
+        for sentence in reversed(SENTENCE_PATTERN.findall(line)):
+            cost = estimate(sentence)
+            if used + cost > budget:
+                break
+            kept.append(sentence)
+            used += cost
+        if not kept:
+            return "", 0
+        return prefix + "".join(reversed(kept)), used
+
+    def fit_head(self, text, budget):
+        # 先頭から文単位で budget に収まるだけ残す（要約用）
+        estimate = self.estimator.estimate
+        kept = []
+        used = 0
+        for line in text.split("\n"):
+            cost = estimate(line) + 1
+            if used + cost <= budget:
+                kept.append(line)
+                used += cost
+                continue
+            sentences = []
+            partial_used = used + 1
+            for sentence in SENTENCE_PATTERN.findall(line):
+                cost = estimate(sentence)
+                if partial_used + cost > budget:
+                    break
+                sentences.append(sentence)
+                partial_used += cost
+            if sentences:
+                kept.append("".join(sentences))
+                used = partial_used
+            break
+        return "\n".join(kept).strip(), used
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "budget": self.budget,
+                "requests": self.requests,
+                "average_tokens": (
+                    self.total_tokens / self.requests if self.requests else 0.0
+                ),
+                "saved_tokens": self.saved_tokens,
+                "saved_bytes": self.saved_bytes,
+                "last": self.last_usage,
+            }
@@ -1,44 +1,231 @@
 # random_trigger.py
 
 import threading
+import time
 import random
+import asyncio
+import inspect
+from metrics import log_event
+from timer_service import get_timer_service
+
+
+def _lead_seconds(prefetch_lead):
+    # 数値でも、秒数を返す関数でもよい
+    return prefetch_lead() if callable(prefetch_lead) else prefetch_lead
 
 
 class RandomTrigger:
-    def __init__(self, min_interval, max_interval, trigger_function):
+    """
+    prefetch_function を指定すると、発火の prefetch_lead 秒前に
+    prefetch_function(発火予定の時刻) を呼び、応答を先に用意させる
+    """
+
+    def __init__(
+        self,
+        min_interval,
+        max_interval,
+        trigger_function,
+        timer_service=None,
+        prefetch_function=None,
+        prefetch_lead=0,
+    ):
         self.min_interval = min_interval
         self.max_interval = max_interval
         self.trigger_function = trigger_function
-        self.stop_event = threading.Event()
-        self.pause_event = threading.Event()
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
-        print("ランダムトリガーを開始しました。")
-
-    def run(self):
-        while not self.stop_event.is_set():
+        self.prefetch_function = prefetch_function
+        self.prefetch_lead = prefetch_lead
+        # スレッドは持たず、共通のタイマーサービスに次の発火を登録する
+        self.timer_service = timer_service or get_timer_service()
+        self.lock = threading.Lock()
+        self.handle = None
+        self.prefetch_handle = None
+        self.paused = False
+        self.stopped = False
+        with self.lock:
+            self.schedule_next()
+        log_event("trigger_started", "ランダムトリガーを開始しました。")
+
+    def schedule_next(self):
+        # self.lock を保持した状態で呼ぶ
+        interval = random.uniform(self.min_interval, self.max_interval)
+        log_event(
+            "trigger_scheduled",
+            f"次のランダムトリガーまで {interval:.2f} 秒",
+            interval=interval,
+        )
+        self.handle = self.timer_service.call_later(interval, self.on_timer)
+        if self.prefetch_function is None:
+            return
+        lead = _lead_seconds(self.prefetch_lead)
+        if interval > lead:
+            fire_at = time.time() + interval
+            self.prefetch_handle = self.timer_service.call_later(
+                interval - lead, lambda: self.on_prefetch_timer(fire_at)
+            )
+
+    def on_prefetch_timer(self, fire_at):
+        with self.lock:
+            self.prefetch_handle = None
+            if self.stopped or self.paused:
+                return
+        self.prefetch_function(fire_at)
+
+    def cancel_prefetch(self):
+        # self.lock を保持した状態で呼ぶ
+        if self.prefetch_handle is not None:
+            self.timer_service.cancel(self.prefetch_handle)
+            self.prefetch_handle = None
+
+    def on_timer(self):
+        with self.lock:
+            self.handle = None
+            # 一時停止中は発火せず、再開時に次の予定を登録する
+            if self.stopped or self.paused:
+                return
+        self.trigger_function()
+        with self.lock:
+            # 実行中に再開などで次の予定が登録済みなら重ねない
+            if self.handle is None and not self.stopped and not self.paused:
+                self.schedule_next()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+        log_event("trigger_paused", "ランダムトリガーを一時停止しました。")
+
+    def resume(self):
+        with self.lock:
+            if not self.paused or self.stopped:
+                return
+            self.paused = False
+            if self.handle is not None:
+                self.timer_service.cancel(self.handle)
+            self.cancel_prefetch()
+            self.schedule_next()
+        log_event("trigger_resumed", "ランダムトリガーを再開しました。")
+        # 再開時にすぐにトリガーを発火させる（呼び出し元のスレッドはブロックしない）
+        self.timer_service.submit(self.trigger_function)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if self.handle is not None:
+                self.timer_service.cancel(self.handle)
+                self.handle = None
+            self.cancel_prefetch()
+        log_event("trigger_stopped", "ランダムトリガーを停止しました。")
+
+
+class AsyncRandomTrigger:
+    """
+    RandomTrigger と同じ使い方で、イベントループ上のタスクとして動くもの
+    trigger_function は通常の関数でもコルーチン関数でもよい
+    通常の関数（原稿の読み込みやプロンプトの組み立てを含む）は、ほかのセッションを
+    止めないよう runtime.run_blocking でループの外のスレッドで呼ぶ
+    """
+
+    def __init__(
+        self,
+        min_interval,
+        max_interval,
+        trigger_function,
+        runtime,
+        prefetch_function=None,
+        prefetch_lead=0,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.trigger_function = trigger_function
+        self.prefetch_function = prefetch_function
+        self.prefetch_lead = prefetch_lead
+        self.runtime = runtime
+        self.paused = False
+        self.stopped = False
+        self.wake = None  # イベントループ上で作成する
+        self.future = runtime.submit(self.run())
+        log_event("trigger_started", "ランダムトリガーを開始しました。")
+
+    async def fire(self):
+        if inspect.iscoroutinefunction(self.trigger_function):
+            await self.trigger_function()
+            return
+        result = await self.runtime.run_blocking(self.trigger_function)
+        if inspect.isawaitable(result):
+            await result
+
+    async def run(self):
+        self.wake = asyncio.Event()
+        while not self.stopped:
             interval = random.uniform(self.min_interval, self.max_interval)
-            print(f"次のランダムトリガーまで {interval:.2f} 秒")
-            if self.stop_event.wait(interval):
-                break
-            # 一時停止中は待機
-            while self.pause_event.is_set():
-                if self.stop_event.wait(1):
-                    return
-            self.trigger_function()
+            log_event(
+                "trigger_scheduled",
+                f"次のランダムトリガーまで {interval:.2f} 秒",
+                interval=interval,
+            )
+            prefetch_handle = self.schedule_prefetch(interval)
+            try:
+                # 再開・停止で起こされた場合は待ち時間を選び直す
+                await asyncio.wait_for(self.wake.wait(), interval)
+                self.wake.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if prefetch_handle is not None:
+                    prefetch_handle.cancel()
+            if self.paused:
+                # 一時停止中は再開されるまで待つ（再開時の発火は resume で行う）
+                while self.paused and not self.stopped:
+                    await self.wake.wait()
+                    self.wake.clear()
+                continue
+            try:
+                await self.fire()
+            except Exception as e:
+                log_event(
+                    "trigger_error", f"ランダムトリガーの処理中にエラーが発生しました: {e}"
+                )
+
+    def schedule_prefetch(self, interval):
+        if self.prefetch_function is None:
+            return None
+        lead = _lead_seconds(self.prefetch_lead)
+        if interval <= lead:
+            return None
+        fire_at = time.time() + interval
+        return asyncio.get_running_loop().call_later(
+            interval - lead, self.on_prefetch_timer, fire_at
+        )
+
+    def on_prefetch_timer(self, fire_at):
+        if self.stopped or self.paused:
+            return
+        # プロンプトの組み立てはループの外で行う
+        self.runtime.run_blocking(self.prefetch, fire_at)
+
+    def prefetch(self, fire_at):
+        try:
+            self.prefetch_function(fire_at)
+        except Exception as e:
+            log_event("prefetch_error", f"先読みの処理中にエラーが発生しました: {e}")
+
+    def _wake_up(self):
+        if self.wake is not None:
+            self.wake.set()
 
     def pause(self):
-        self.pause_event.set()
-        print("ランダムトリガーを一時停止しました。")
+        self.paused = True
+        log_event("trigger_paused", "ランダムトリガーを一時停止しました。")
 
     def resume(self):
-        if self.pause_event.is_set():
-            self.pause_event.clear()
-            print("ランダムトリガーを再開しました。")
+        if self.paused and not self.stopped:
+            self.paused = False
+            self.runtime.call_soon(self._wake_up)
+            log_event("trigger_resumed", "ランダムトリガーを再開しました。")
             # 再開時にすぐにトリガーを発火させる
-            self.trigger_function()
+            self.runtime.submit(self.fire())
 
     def stop(self):
-        self.stop_event.set()
-        self.thread.join()
-        print("ランダムトリガーを停止しました。")
+        self.stopped = True
+        self.runtime.call_soon(self._wake_up)
+        log_event("trigger_stopped", "ランダムトリガーを停止しました。")
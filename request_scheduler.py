@@ -0,0 +1,265 @@
+# request_scheduler.py
+
+import heapq
+import itertools
+import threading
+import time
+from metrics import get_metrics, log_event
+
+# 数値が小さいほど優先度が高い
+PRIORITY_USER = 0  # 休憩・再開・再開時の挨拶などユーザー操作によるもの
+PRIORITY_RANDOM = 10  # ランダムトリガーや原稿の変更によるもの
+
+
+class _Request:
+    __slots__ = (
+        "priority",
+        "seq",
+        "task",
+        "key",
+        "on_cancel",
+        "runtime",
+        "submitted",
+        "cancelled",
+    )
+
+    def __init__(self, priority, seq, task, key, on_cancel=None, runtime=None):
+        self.priority = priority
+        self.seq = seq
+        self.task = task
+        self.key = key
+        self.on_cancel = on_cancel
+        self.runtime = runtime
+        self.submitted = time.monotonic()
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RequestScheduler:
+    """
+    LLM へのリクエストを優先度付きキューに積み、少数のワーカースレッドで処理する
+    同じ key のリクエストが待機中なら新しいものだけを残す（古いランダムコメントは捨てる）
+    runtime を指定したリクエストはコルーチンとしてイベントループ上で実行し、
+    ワーカースレッドは完了を待たない（同時に実行する数には含める）
+    ワーカー数は workers と、reserve() で登録された数のうち最大のものになる
+    """
+
+    def __init__(self, workers=1, maxsize=16):
+        self.maxsize = maxsize
+        self.condition = threading.Condition()
+        self.heap = []
+        self.pending_by_key = {}
+        self.seq = itertools.count()
+        self.target_workers = 0
+        self.base_workers = 1
+        self.reserved = {}  # owner → その owner が同時に必要とするリクエスト数
+        self.threads = []
+        self.running = True
+
+        # 統計
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.metrics = get_metrics()
+        self.active = 0
+
+        self.resize(workers)
+
+    @property
+    def depth(self):
+        return len(self.heap) - sum(1 for r in self.heap if r.cancelled)
+
+    def resize(self, workers):
+        # 同時に LLM へ送るリクエスト数の下限を変更する
+        with self.condition:
+            self.base_workers = max(1, int(workers))
+            self._update_workers()
+
+    def reserve(self, owner, workers):
+        # owner（セッションなど）が同時に必要とするリクエスト数を登録する
+        with self.condition:
+            self.reserved[owner] = max(1, int(workers))
+            self._update_workers()
+
+    def release(self, owner):
+        # owner の登録を取り消し、ほかの owner に必要な数までワーカーを減らす
+        with self.condition:
+            if self.reserved.pop(owner, None) is not None:
+                self._update_workers()
+
+    def _update_workers(self):
+        # condition を保持した状態で呼ぶ
+        workers = max([self.base_workers, *self.reserved.values()])
+        self.target_workers = workers
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+        self.condition.notify_all()
+
+    def submit(
+        self, task, priority=PRIORITY_RANDOM, key=None, on_cancel=None, runtime=None
+    ):
+        """
+        task を登録する。受け付けなかった場合は False を返す
+        登録後に置き換え・押し出し・停止で実行されなくなった場合は on_cancel() を呼ぶ
+        runtime（AsyncRuntime）を指定した場合、task はコルーチンを返す関数
+        """
+        cancelled = []
+        try:
+            with self.condition:
+                if not self.running:
+                    return False
+                self.submitted += 1
+
+                if key is not None and key in self.pending_by_key:
+                    # 待機中の古いリクエストを新しいものに置き換える
+                    cancelled.append(self._cancel(self.pending_by_key[key]))
+                    self.coalesced += 1
+                    self.metrics.inc("scheduler_coalesced_total")
+
+                if self.depth >= self.maxsize:
+                    lowest = max(
+                        (r for r in self.heap if not r.cancelled), default=None
+                    )
+                    if lowest is None or not (priority < lowest.priority):
+                        self.dropped += 1
+                        self.metrics.inc("scheduler_dropped_total", reason="full")
+                        log_event(
+                            "request_dropped",
+                            "リクエストが混み合っているため、新しいリクエストを破棄します。",
+                            priority=priority,
+                        )
+                        return False
+                    # より優先度の低い待機中リクエストを押し出す
+                    cancelled.append(self._cancel(lowest))
+                    self.dropped += 1
+                    self.metrics.inc("scheduler_dropped_total", reason="evicted")
+
+                request = _Request(
+                    priority, next(self.seq), task, key, on_cancel, runtime
+                )
+                heapq.heappush(self.heap, request)
+                if key is not None:
+                    self.pending_by_key[key] = request
+                self.condition.notify()
+                return True
+        finally:
+            # コールバックはロックの外で呼ぶ（中から submit し直せるように）
+            _notify_cancelled(cancelled)
+
+    def _cancel(self, request):
+        request.cancelled = True
+        if request.key is not None and self.pending_by_key.get(request.key) is request:
+            del self.pending_by_key[request.key]
+        return request
+
+    def _next_request(self):
+        # condition を保持した状態で呼ぶ
+        while self.heap:
+            request = heapq.heappop(self.heap)
+            if request.cancelled:
+                continue
+            if request.key is not None:
+                self.pending_by_key.pop(request.key, None)
+            return request
+        return None
+
+    def _worker(self):
+        current = threading.current_thread()
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running or self._too_many_workers(current):
+                        self.threads.remove(current)
+                        return
+                    # イベントループ上の処理中のものも含めて workers 件までにする
+                    request = None
+                    if self.active < self.target_workers:
+                        request = self._next_request()
+                    if request is not None:
+                        break
+                    self.condition.wait()
+                wait = time.monotonic() - request.submitted
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.active += 1
+            self.metrics.observe("queue_wait_seconds", wait)
+
+            if request.runtime is not None:
+                try:
+                    future = request.runtime.submit(request.task())
+                except Exception as e:
+                    self._report_error(e)
+                    self._finish()
+                    continue
+                future.add_done_callback(lambda _: self._finish())
+                continue
+            try:
+                request.task()
+            except Exception as e:
+                self._report_error(e)
+            finally:
+                self._finish()
+
+    def _report_error(self, error):
+        self.metrics.inc("scheduler_errors_total")
+        log_event("request_error", f"リクエストの処理中にエラーが発生しました: {error}")
+
+    def _finish(self):
+        with self.condition:
+            self.active -= 1
+            self.completed += 1
+            # 実行数の上限で待っているワーカーを起こす
+            self.condition.notify_all()
+
+    def _too_many_workers(self, current):
+        return (
+            len(self.threads) > self.target_workers
+            and self.threads.index(current) >= self.target_workers
+        )
+
+    def get_stats(self):
+        with self.condition:
+            started = self.completed + self.active
+            return {
+                "workers": self.target_workers,
+                "queue_depth": self.depth,
+                "active": self.active,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "average_wait": self.total_wait / started if started else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            cancelled = [r for r in self.heap if not r.cancelled]
+            for request in self.heap:
+                request.cancelled = True
+            self.heap.clear()
+            self.pending_by_key.clear()
+            self.condition.notify_all()
+        _notify_cancelled(cancelled)
+
+
+def _notify_cancelled(requests):
+    for request in requests:
+        if request.on_cancel is None:
+            continue
+        try:
+            request.on_cancel()
+        except Exception as e:
+            log_event(
+                "request_cancel_error",
+                f"取り消したリクエストの後処理中にエラーが発生しました: {e}",
+            )
@@ -0,0 +1,187 @@
+# response_cache.py
+
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# キャッシュの利用方針
+CACHE_OFF = "off"  # 使わない
+CACHE_REUSE = "cached"  # 同じ問い合わせには保存済みの応答を返す
+CACHE_VARIED = "varied"  # 応答を max_variants 種類集めてから、その中から選んで返す
+
+
+class CachedResponse(str):
+    """
+    キャッシュから返した応答（LLM が新しく生成したものと見分けるための印）
+    """
+
+
+class ResponseCache:
+    """
+    (モデル名, context, プロンプト) をキーに LLM の応答を保存する
+    メモリ上の LRU と、任意で SQLite のファイルを二段目として使う
+    """
+
+    def __init__(
+        self,
+        max_entries=256,
+        ttl=30 * 60,
+        max_variants=3,
+        db_path=None,
+        db_max_rows=10000,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_variants = max_variants
+        self.db_max_rows = db_max_rows
+        self.entries = OrderedDict()  # キー -> (作成時刻, [応答, ...])
+        self.lock = threading.Lock()
+
+        # context は毎回同じリストが渡されるので、直前のハッシュを使い回す
+        self.last_context = None
+        self.last_context_digest = b""
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db = None
+        self.db_writes = 0
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, created REAL, variants TEXT)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created ON responses (created)"
+            )
+            self.db.commit()
+
+    def _context_digest(self, context):
+        if context is None:
+            return b""
+        if context is self.last_context:
+            return self.last_context_digest
+        digest = hashlib.blake2b(array("q", context).tobytes(), digest_size=16).digest()
+        self.last_context = context
+        self.last_context_digest = digest
+        return digest
+
+    def make_key(self, model_name, context, prompt):
+        with self.lock:
+            context_digest = self._context_digest(context)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(model_name.encode("utf-8"))
+        h.update(b"\0")
+        h.update(context_digest)
+        h.update(b"\0")
+        h.update(prompt.encode("utf-8"))
+        return h.hexdigest()
+
+    def key_for(self, policy, model_name, context, prompt):
+        # 方針が off のときは None（キャッシュを使わない）
+        if policy not in (CACHE_REUSE, CACHE_VARIED):
+            return None
+        return self.make_key(model_name, context, prompt)
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _load(self, key):
+        # self.lock を保持した状態で呼ぶ
+        entry = self.entries.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self.entries.move_to_end(key)
+                return entry
+            del self.entries[key]
+        if self.db is None:
+            return None
+        row = self.db.execute(
+            "SELECT created, variants FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or self._expired(row[0]):
+            return None
+        entry = (row[0], json.loads(row[1]))
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, key, policy):
+        """
+        使える応答があれば返し、なければ None（LLM に問い合わせる）
+        """
+        if policy not in (CACHE_REUSE, CACHE_VARIED):
+            return None
+        with self.lock:
+            entry = self._load(key)
+            variants = entry[1] if entry else []
+            if not variants or (
+                policy == CACHE_VARIED and len(variants) < self.max_variants
+            ):
+                # varied の場合は種類が揃うまでは問い合わせて集める
+                self.misses += 1
+                return None
+            self.hits += 1
+            return CachedResponse(random.choice(variants))
+
+    def store(self, key, response):
+        with self.lock:
+            entry = self._load(key)
+            if entry is None:
+                entry = (time.time(), [])
+            variants = entry[1]
+            if response not in variants:
+                variants.append(response)
+                del variants[: -self.max_variants]
+            self._put(key, entry)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (key, entry[0], json.dumps(variants, ensure_ascii=False)),
+                )
+                self.db_writes += 1
+                if self.db_writes % 100 == 0:
+                    self._prune_db()
+                self.db.commit()
+
+    def _prune_db(self):
+        # 期限切れと件数超過の行を古い順に削除する
+        if self.ttl is not None:
+            self.db.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            )
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+            "ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_rows,),
+        )
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,240 @@
+# session_registry.py
+
+import threading
+import time
+from metrics import log_event
+from timer_service import get_timer_service
+
+
+class SessionLimitError(Exception):
+    pass
+
+
+class WriterSession:
+    """
+    執筆者 1 人分の状態（TriggerManager・Logger・メッセージチャネルなど）をまとめたもの
+    """
+
+    def __init__(self, session_id, message_channel, logger, scheduler=None):
+        self.session_id = session_id
+        self.message_channel = message_channel
+        self.logger = logger
+        # アプリ全体で共有する RequestScheduler（閉じるときにワーカーの登録を外す）
+        self.scheduler = scheduler
+        self.trigger_manager = None
+        self.random_trigger = None
+        self.file_watcher = None
+        self.created = time.time()
+        self.last_seen = time.monotonic()
+        # "warming"（準備中）→ "ready" または "failed"
+        self.state = "warming"
+        self.error = None
+        self.status_id = f"status-{session_id}-{int(self.created * 1000)}"
+        # 準備のスレッドと close() が同時にトリガーや監視を触るのを防ぐ
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_seen
+
+    def report_progress(self, text):
+        # 準備の進み具合をチャット画面の同じお知らせとして書き換える
+        self.message_channel.put(
+            {"id": self.status_id, "text": text, "partial": True, "notice": True}
+        )
+
+    def mark_ready(self):
+        self.state = "ready"
+        self.message_channel.put({"id": self.status_id, "removed": True})
+
+    def mark_failed(self, error):
+        self.state = "failed"
+        self.error = error
+        self.message_channel.put(
+            {
+                "id": self.status_id,
+                "text": f"初期化に失敗しました: {error}",
+                "partial": False,
+                "notice": True,
+            }
+        )
+
+    def attach(self, random_trigger=None, file_watcher=None):
+        """
+        準備中に作ったトリガーや監視を登録する
+        準備の途中でセッションが閉じられていれば、登録せずに止めて False を返す
+        """
+        with self.lock:
+            if not self.closed:
+                if random_trigger:
+                    self.random_trigger = random_trigger
+                if file_watcher:
+                    self.file_watcher = file_watcher
+                return True
+        if random_trigger:
+            random_trigger.stop()
+        if file_watcher:
+            file_watcher.stop()
+        return False
+
+    def reserve_workers(self, workers):
+        # このセッションが同時に送るリクエスト数を共有の RequestScheduler に登録する
+        with self.lock:
+            if not self.closed and self.scheduler:
+                self.scheduler.reserve(self, workers)
+
+    def stop_triggers(self):
+        # 設定のやり直しや終了時にトリガーと監視を止める（何度呼んでもよい）
+        with self.lock:
+            random_trigger, self.random_trigger = self.random_trigger, None
+            file_watcher, self.file_watcher = self.file_watcher, None
+        if random_trigger:
+            random_trigger.stop()
+        if file_watcher:
+            file_watcher.stop()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.scheduler:
+                self.scheduler.release(self)
+        self.stop_triggers()
+        if self.trigger_manager:
+            self.trigger_manager.save_log()
+            # まだ保存していない索引の更新を書き出す
+            self.trigger_manager.index.flush()
+        self.logger.close()
+
+    def get_stats(self):
+        channel = self.message_channel
+        with channel.condition:
+            buffered = len(channel.messages)
+            buffered_chars = sum(len(str(m)) for _, m in channel.messages)
+        with self.logger.lock:
+            log_entries = len(self.logger.log)
+            log_chars = sum(
+                len(e["prompt"]) + len(e["response"]) for e in self.logger.log
+            )
+        threads = 0
+        if self.file_watcher and self.file_watcher.thread.is_alive():
+            threads += 1
+        prompt = None
+        if self.trigger_manager:
+            prompt = self.trigger_manager.prompt_builder.get_stats()
+            prompt["diff"] = self.trigger_manager.diff_tracker.get_stats()
+            prompt["index"] = self.trigger_manager.index.get_stats()
+            if self.trigger_manager.duplicate_filter:
+                prompt["duplicates"] = self.trigger_manager.duplicate_filter.get_stats()
+            if self.trigger_manager.personas:
+                prompt["personas"] = [
+                    p.get_stats() for p in self.trigger_manager.personas
+                ]
+        return {
+            "session_id": self.session_id,
+            "state": self.state,
+            "idle_seconds": self.idle_seconds(),
+            "messages_buffered": buffered,
+            "log_entries": log_entries,
+            "approx_chars": buffered_chars + log_chars,
+            "threads": threads,
+            "prompt": prompt,
+        }
+
+
+class SessionRegistry:
+    """
+    セッション ID ごとに WriterSession を保持する
+    一定時間アクセスのないセッションは破棄し、同時セッション数に上限を設ける
+    """
+
+    def __init__(self, max_sessions=32, idle_timeout=6 * 60 * 60, sweep_interval=60):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.evicted = 0
+        self.timer_service = get_timer_service()
+        self.sweep_handle = self.timer_service.call_later(sweep_interval, self.sweep)
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session:
+            session.touch()
+        return session
+
+    def check_capacity(self, session_id):
+        # 新しいセッションを追加できなければ SessionLimitError
+        self.evict_idle()
+        with self.lock:
+            self._check_capacity(session_id)
+
+    def _check_capacity(self, session_id):
+        if session_id not in self.sessions and len(self.sessions) >= self.max_sessions:
+            raise SessionLimitError(
+                "同時に利用できるセッション数の上限に達しました。しばらくしてから再度お試しください。"
+            )
+
+    def add(self, session):
+        self.evict_idle()
+        with self.lock:
+            self._check_capacity(session.session_id)
+            old = self.sessions.get(session.session_id)
+            self.sessions[session.session_id] = session
+        if old is not None and old is not session:
+            old.close()
+        return session
+
+    def remove(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session:
+            session.close()
+
+    def evict_idle(self):
+        with self.lock:
+            expired = [
+                s
+                for s in self.sessions.values()
+                if s.idle_seconds() > self.idle_timeout
+            ]
+            for session in expired:
+                del self.sessions[session.session_id]
+            self.evicted += len(expired)
+        for session in expired:
+            log_event(
+                "session_evicted",
+                f"一定時間操作のないセッションを終了します: {session.session_id}",
+                session_id=session.session_id,
+            )
+            session.close()
+
+    def sweep(self):
+        self.evict_idle()
+        self.sweep_handle = self.timer_service.call_later(
+            self.sweep_interval, self.sweep
+        )
+
+    def get_stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {
+            "active_sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "evicted": self.evicted,
+            "sessions": [s.get_stats() for s in sessions],
+        }
+
+    def close_all(self):
+        self.timer_service.cancel(self.sweep_handle)
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
@@ -0,0 +1,114 @@
+# text_diff.py
+
+import threading
+
+# 追記かどうかを調べるときに使う、前回の末尾の長さ（文字数）
+ANCHOR_CHARS = 200
+
+
+def changed_chars(old, new):
+    """
+    old と new で一致しない行の文字数の合計（追加・削除の両方を数える）
+    """
+    old_lines = set(old.split("\n"))
+    new_lines = set(new.split("\n"))
+    added = sum(len(line) for line in new_lines - old_lines)
+    removed = sum(len(line) for line in old_lines - new_lines)
+    return added + removed
+
+
+class DiffTracker:
+    """
+    前回 LLM に送った本文を覚えておき、今回の本文のうち変わった部分を取り出す
+    まず前回の末尾が今回の本文に含まれるか（追記か）を調べ、
+    そうでなければ行のハッシュを比べて変わった範囲を求める
+    """
+
+    def __init__(self, context_lines=3):
+        self.context_lines = context_lines  # 変わった部分の前に付ける行数
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+        self.appends = 0
+        self.edits = 0
+        self.full_sends = 0
+
+    def focus(self, text, remember=True):
+        """
+        (送る本文, 種類) を返し、text を次回の比較用に覚える
+        種類は "full"（初回・変更なし）、"append"（追記）、"edit"（書き換え）
+        remember=False の場合は覚えず、実際に送ったときに remember() を呼ぶ
+        """
+        with self.lock:
+            old = self.snapshot
+            if remember:
+                self.snapshot = text
+            if not old or old == text:
+                self.full_sends += 1
+                return text, "full"
+
+            start = self._appended_start(old, text)
+            if start is not None:
+                self.appends += 1
+                return self._with_context(text, start, len(text)), "append"
+
+            region = self._changed_region(old, text)
+            if region is None:
+                # 削除だけの場合などは全体を送る
+                self.full_sends += 1
+                return text, "full"
+            self.edits += 1
+            return self._with_context(text, *region), "edit"
+
+    def _appended_start(self, old, text):
+        # 前回の末尾が今回の本文の中にあれば、その後ろが追記された部分
+        anchor = old[-ANCHOR_CHARS:]
+        index = text.rfind(anchor)
+        if index == -1:
+            return None
+        start = index + len(anchor)
+        if start >= len(text) or not text[start:].strip():
+            return None
+        return start
+
+    def _changed_region(self, old, text):
+        # 前回になかった行の範囲を (開始, 終了) の文字位置で返す
+        old_hashes = {hash(line) for line in old.split("\n")}
+        lines = text.split("\n")
+        changed = []
+        offset = 0
+        for i, line in enumerate(lines):
+            if hash(line) not in old_hashes and line.strip():
+                # 先頭行は読み込み範囲の都合で途中から始まることがある
+                if not (i == 0 and line in old):
+                    changed.append((offset, offset + len(line)))
+            offset += len(line) + 1
+        if not changed:
+            return None
+        return changed[0][0], changed[-1][1]
+
+    def _with_context(self, text, start, end):
+        # 変わった部分の前に数行を付けて、どこに続く文章かが分かるようにする
+        for _ in range(self.context_lines):
+            newline = text.rfind("\n", 0, max(0, start - 1))
+            if newline == -1:
+                start = 0
+                break
+            start = newline + 1
+        return text[start:end].strip()
+
+    def remember(self, text):
+        with self.lock:
+            self.snapshot = text
+
+    def reset(self):
+        with self.lock:
+            self.snapshot = None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "appends": self.appends,
+                "edits": self.edits,
+                "full_sends": self.full_sends,
+            }
@@ -0,0 +1,177 @@
+# text_encoding.py
+
+import codecs
+import os
+import threading
+from metrics import get_metrics, log_event
+
+# BOM とエンコーディング
+# UTF-32 LE の BOM は UTF-16 LE の BOM で始まるので先に調べる
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# UTF-8 でも chardet の結果でも読めない場合に試す順番
+# Shift_JIS の文章は EUC-JP としてはまず読めないが、
+# 逆は読めてしまうことがあるため EUC-JP を先に試す
+FALLBACK_ENCODINGS = ("euc_jp", "cp932")
+
+# 読み込みの単位（バイト）
+CHUNK_SIZE = 64 * 1024
+
+
+def decode_bytes(data, encoding, final=True):
+    """
+    不正なバイト列は置換文字にして decode する
+    final=False の場合、末尾で途切れた文字は捨てる（書き込み途中のファイル用）
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    text = decoder.decode(data, final)
+    if "\ufffd" in text:
+        get_metrics().inc("decode_replacements_total", text.count("\ufffd"))
+    return text
+
+
+def iter_text(filepath, encoding):
+    """
+    ファイルを CHUNK_SIZE ずつ読みながら decode した文字列を順に返す
+    チャンクの境界で文字が分かれても正しく読め、不正なバイト列でも失敗しない
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    replacements = 0
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            final = not chunk
+            text = decoder.decode(chunk, final)
+            if text:
+                replacements += text.count("\ufffd")
+                yield text
+            if final:
+                break
+    if replacements:
+        get_metrics().inc("decode_replacements_total", replacements)
+
+
+def read_text(filepath, encoding):
+    """
+    ファイル全体を decode する（iter_text をつなげたもの）
+    """
+    return "".join(iter_text(filepath, encoding))
+
+
+def _decodes_cleanly(samples, encoding):
+    try:
+        for sample in samples:
+            # 末尾は途中で切れていてもよい
+            codecs.getincrementaldecoder(encoding)().decode(sample, False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+class EncodingCache:
+    """
+    ファイルのエンコーディングを一度だけ判定し、ファイルごと（デバイスと inode）に覚える
+    BOM を確認し、なければ先頭だけでなく途中や末尾からも標本を取って判定する
+    ASCII しか見つからなかった場合は仮の結果とし、ファイルが伸びたら判定し直す
+    """
+
+    def __init__(self, sample_size=4096, sample_count=5):
+        self.sample_size = sample_size
+        self.sample_count = sample_count
+        self.lock = threading.Lock()
+        self.entries = {}  # (パス, デバイス, inode) -> (エンコーディング, 確定か, サイズ)
+        self.metrics = get_metrics()
+
+    def detect(self, filepath):
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_dev, stat.st_ino)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            encoding, certain, size = entry
+            if certain or size == stat.st_size:
+                self.metrics.inc("encoding_cache_hits_total")
+                return encoding
+
+        with self.metrics.timer("encoding_detect_seconds"):
+            encoding, certain = self._detect(filepath, stat.st_size)
+        with self.lock:
+            self.entries[key] = (encoding, certain, stat.st_size)
+        self.metrics.inc("encoding_detections_total", encoding=encoding)
+        log_event(
+            "encoding_detected",
+            f"エンコーディングを判定しました: {encoding}",
+            encoding=encoding,
+            certain=certain,
+        )
+        return encoding
+
+    def _detect(self, filepath, size):
+        with open(filepath, "rb") as f:
+            head = f.read(4)
+            for bom, encoding in BOMS:
+                if head.startswith(bom):
+                    return encoding, True
+            samples = self._read_samples(f, size)
+
+        if not samples:
+            # ASCII だけなら UTF-8 として読めば同じ
+            return "utf-8", False
+        if _decodes_cleanly(samples, "utf-8"):
+            return "utf-8", True
+
+        # chardet は読み込みに時間がかかるので、UTF-8 で読めない原稿のときだけ使う
+        import chardet
+
+        guess = chardet.detect(b"\n".join(samples))
+        candidates = list(FALLBACK_ENCODINGS)
+        if guess["encoding"] and guess["confidence"] > 0.8:
+            candidates.insert(0, guess["encoding"].lower())
+        for encoding in candidates:
+            if _decodes_cleanly(samples, encoding):
+                return encoding, True
+        # どれでも読めない場合は UTF-8 にして、読めない部分は置換文字にする
+        return "utf-8", True
+
+    def _read_samples(self, f, size):
+        # 先頭・途中・末尾から読み、ASCII 以外を含むものだけを返す
+        step = max(size - self.sample_size, 0) / max(self.sample_count - 1, 1)
+        offsets = sorted({int(step * i) for i in range(self.sample_count)})
+        samples = []
+        for offset in offsets:
+            f.seek(offset)
+            data = f.read(self.sample_size)
+            if offset > 0:
+                # 文字の途中から読まないよう、最初の改行の後ろから使う
+                newline = data.find(b"\n")
+                if newline == -1:
+                    continue
+                data = data[newline + 1 :]
+            if not data.isascii():
+                samples.append(data)
+        return samples
+
+
+_encoding_cache = None
+_encoding_cache_lock = threading.Lock()
+
+
+def get_encoding_cache():
+    global _encoding_cache
+    with _encoding_cache_lock:
+        if _encoding_cache is None:
+            _encoding_cache = EncodingCache()
+    return _encoding_cache
+
+
+def detect_encoding(filepath):
+    """
+    ファイルのエンコーディングを自動検出（結果はファイルごとにキャッシュする）
+    """
+    return get_encoding_cache().detect(filepath)
@@ -0,0 +1,127 @@
+# timer_service.py
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import log_event
+
+
+class TimerHandle:
+    __slots__ = ("due", "seq", "callback", "cancelled", "fired")
+
+    def __init__(self, due, seq, callback):
+        self.due = due
+        self.seq = seq
+        self.callback = callback
+        self.cancelled = False
+        self.fired = False
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerService:
+    """
+    多数のタイマーをヒープで管理し、1 本のスレッドで期限を待つ
+    期限が来たコールバックはスレッドプールで実行するため、
+    LLM 呼び出しなどの重い処理でタイマーが遅れることはない
+    """
+
+    def __init__(self, workers=4):
+        self.heap = []
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="timer"
+        )
+        self.running = True
+        self.cancelled_count = 0
+        self.fired = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, callback):
+        with self.condition:
+            handle = TimerHandle(time.monotonic() + delay, next(self.seq), callback)
+            heapq.heappush(self.heap, handle)
+            # 先頭が変わった場合に待ち時間を計算し直させる
+            if self.heap[0] is handle:
+                self.condition.notify()
+            return handle
+
+    def cancel(self, handle):
+        with self.condition:
+            if handle.cancelled or handle.fired:
+                return
+            handle.cancel()
+            self.cancelled_count += 1
+            # キャンセル済みが半分を超えたらヒープを作り直す
+            if self.cancelled_count > len(self.heap) // 2:
+                self.heap = [h for h in self.heap if not h.cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    def submit(self, callback):
+        # タイマーを介さずにすぐ実行する
+        return self.executor.submit(self._invoke, callback)
+
+    def _invoke(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            log_event("timer_error", f"タイマーの処理中にエラーが発生しました: {e}")
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    handle = self.heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self.heap)
+                        self.cancelled_count = max(0, self.cancelled_count - 1)
+                        continue
+                    delay = handle.due - time.monotonic()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    heapq.heappop(self.heap)
+                    handle.fired = True
+                    self.fired += 1
+                    break
+                else:
+                    return
+            self.executor.submit(self._invoke, handle.callback)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.heap) - self.cancelled_count,
+                "fired": self.fired,
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+
+
+_timer_service = None
+_timer_service_lock = threading.Lock()
+
+
+def get_timer_service():
+    global _timer_service
+    with _timer_service_lock:
+        if _timer_service is None:
+            _timer_service = TimerService()
+    return _timer_service
@@ -3,166 +3,892 @@
 import threading
 import time
 import random
-import re
+import itertools
 from datetime import datetime
-from api_client import get_comment_from_llm
+from api_client import OllamaClient, ERROR_COMMENT
+from duplicate_filter import DuplicateFilter
 from logger import get_logger
+from manuscript import Manuscript
+from manuscript_index import ManuscriptIndex
+from metrics import get_metrics, log_event
+from prompt_builder import PromptBuilder
+from request_scheduler import RequestScheduler, PRIORITY_USER, PRIORITY_RANDOM
+from response_cache import CACHE_OFF, CACHE_VARIED, CachedResponse
+from text_diff import DiffTracker, changed_chars
+
+# ストリーミング中の途中経過を同じメッセージとして更新するための ID
+_message_ids = itertools.count(1)
+
+# 原稿の末尾ではなく、索引から登場人物のセリフを取り出して使うプロンプト
+CHARACTER_TEXT = "character"
+
+# (重み, ラベル, テンプレート, 原稿が必要か)
+PROMPTS_WITH_WEIGHTS = [
+    (
+        2,
+        "現在時刻について",
+        "現在は{time_str}です。時間帯について独り言のような一言をお願いします。",
+        False,
+    ),
+    (
+        1,
+        "時間の経過について",
+        "執筆を開始してから{uptime_minutes}分経過しました。あなたは時間の経過について呟きます。",
+        False,
+    ),
+    (
+        3,
+        "気になった点について",
+        "以下は私の書いた文章です。\n〔{combined_text}〕\nあなたはこの文章を読んで気になった点を一つ呟きます",
+        True,
+    ),
+    (
+        3,
+        "最初に思いついたこと",
+        "以下は私の書いた文章です。\n〔{combined_text}〕\nあなたはこの文章を読んで最初に思いついたことを一つ呟きます。",
+        True,
+    ),
+    (
+        2,
+        "登場人物について",
+        "以下は登場人物{character}のセリフです。\n〔{combined_text}〕\nあなたは{character}について一言呟きます。",
+        CHARACTER_TEXT,
+    ),
+]
+
+# LLM のサーバーに接続できなくなったときに一度だけ表示するお知らせ
+BACKEND_DOWN_NOTICE = "LLM に接続できません。復帰するまでコメントをお休みします。"
+
+# 差分だけを送るときの本文の見出し
+DIFF_LABELS = {
+    "append": "前回から書き足した部分",
+    "edit": "前回から書き直した部分",
+}
+
+# ラベルごとの応答キャッシュの使い方の既定値（設定の cache_policies で上書きできる）
+# 決まった文面のプロンプトは、何種類か応答を集めたらその中から選んで返し、LLM の負荷を減らす
+# 原稿や時刻で内容が変わるプロンプトは、古いコメントの繰り返しにならないよう使わない
+DEFAULT_CACHE_POLICIES = {
+    "休憩": CACHE_VARIED,
+    "再開": CACHE_VARIED,
+    "再開の挨拶": CACHE_VARIED,
+}
+
+# 先に生成したコメントを、予定の発火時刻から何秒ずれるまで使うか
+PREFETCH_MAX_DRIFT = 60
+
+
+class PrefetchedComment:
+    """
+    次のランダムトリガーのために先に生成したコメント
+    """
+
+    def __init__(self, label, prompt, needs_text, content_version, body, fire_at):
+        self.label = label
+        self.prompt = prompt
+        self.needs_text = needs_text
+        self.content_version = content_version
+        self.body = body  # 生成に使った原稿の本文（変わっていないかの確認用）
+        self.fire_at = fire_at
+        self.response = None
+        self.ready = False  # 生成が終わったか
+        self.claimed = False  # 発火時に使うことが決まったか
+        self.dropped = False  # 混雑などで生成されないことが決まったか
 
 
 class TriggerManager:
-    def __init__(self, filepath, encoding, message_queue, initial_context, model_name):
+    def __init__(
+        self,
+        filepath,
+        encoding,
+        message_queue,
+        initial_context,
+        model_name,
+        client=None,
+        stream=False,
+        stream_interval=0.2,
+        require_new_content=False,
+        min_text_interval=0,
+        scheduler=None,
+        logger=None,
+        async_client=None,
+        runtime=None,
+        token_budget=2048,
+        prefetch_lead=15,
+        prefetch_tolerance=40,
+        personas=None,
+        duplicate_threshold=0.7,
+        duplicate_window=32,
+        cache_policies=None,
+    ):
         self.filepath = filepath
         self.encoding = encoding
         self.message_queue = message_queue
         self.context = initial_context  # 最初のコンテキストを使用し、以降は上書きしない
         self.model_name = model_name
+        # 接続を使い回すため、呼び出し元と同じクライアントを共有する
+        self.client = client or OllamaClient(model_name=model_name)
+        self.stream = stream  # True の場合は生成途中の文章も送る
+        self.stream_interval = stream_interval  # 途中経過を送る最小間隔（秒）
         self.lock = threading.Lock()
-        self.api_lock = threading.Lock()
-        self.api_in_progress = False  # APIリクエストが進行中かどうかを示すフラグ
+        # LLM へのリクエストは共通のスケジューラーで優先度順に処理する
+        self.scheduler = scheduler or RequestScheduler()
+        # asyncio モード: runtime のイベントループ上で async_client を使って生成する
+        self.async_client = async_client
+        self.runtime = runtime if async_client is not None else None
+        self.api_in_progress = 0  # 処理中のAPIリクエストの数
         self.last_api_response_time = 0  # 最後のAPIレスポンスの時間
         self.start_time = time.time()  # アプリの開始時間を記録
-        self.logger = get_logger()  # 共通の Logger インスタンスを取得
-
-    def read_file(self):
-        try:
-            with open(self.filepath, "r", encoding=self.encoding) as file:
-                text = file.read()
-            return text
-        except Exception as e:
-            print(f"テキストの読み込み中にエラーが発生しました: {e}")
-            return ""
+        self.paused = False
+        self.backend_down = False  # 接続できないお知らせを表示済みか
+        self.prompts_with_weights = PROMPTS_WITH_WEIGHTS
+        # 複数の人物で同じ原稿にコメントする場合（ファンアウト）
+        self.personas = personas or []
+        if self.personas:
+            # プロンプトの予算は最も長い context に合わせる
+            self.context = max((p.context for p in self.personas), key=len)
+        # ラベル -> キャッシュの使い方（指定のないラベルは使わない）
+        self.cache_policies = dict(DEFAULT_CACHE_POLICIES, **(cache_policies or {}))
+        # 原稿の変更通知を受けている場合、変更がなければ原稿についてのプロンプトは送らない
+        self.require_new_content = require_new_content
+        self.min_text_interval = min_text_interval
+        self.content_version = 1  # 変更通知のたびに増やす
+        self.sent_version = 0  # 最後に原稿を送ったときの content_version
+        self.last_text_prompt_time = 0
+        # セッションごとの Logger（指定がなければ共通のインスタンス）
+        self.logger = logger or get_logger()
+        self.metrics = get_metrics()
+        # 要約と本文の末尾をトークン数の予算に収まるように切り詰める
+        self.prompt_builder = PromptBuilder(budget=token_budget)
+        # 前回送った本文と比べ、書き足し・書き直した部分を中心に送る
+        self.diff_tracker = DiffTracker()
+        # 次のランダムトリガーのコメントを先に生成しておくバッファ（1 件）
+        self.prefetched = None
+        self.prefetch_lead = prefetch_lead  # 発火の何秒前から生成を始めるか
+        self.prefetch_seconds = 0.0  # 先読みの生成にかかった時間（移動平均）
+        # 原稿がこの文字数より多く変わっていたら、先に生成したコメントは捨てる
+        self.prefetch_tolerance = prefetch_tolerance
+        # 最近のコメントとほぼ同じコメントは表示せず、別のテンプレートで言い直させる
+        self.duplicate_filter = None
+        if duplicate_threshold:
+            self.duplicate_filter = DuplicateFilter(
+                capacity=duplicate_window, threshold=duplicate_threshold
+            )
+        # 原稿の要約と末尾をキャッシュし、変更がなければ読み直さない
+        self.manuscript = Manuscript(
+            filepath,
+            encoding,
+            self.logger.format_scenario,
+            window=self.prompt_builder.max_body_chars,
+        )
+        # 見出しとセリフの位置の索引（登場人物のセリフを取り出すのに使う）
+        self.index = ManuscriptIndex(filepath, encoding)
 
     def on_pause(self):
         self.pause_time = time.time()
+        self.paused = True
 
-        print("TriggerManager: 休憩メッセージを送信します。")
+        self.metrics.inc("triggers_total", source="pause")
+        log_event("pause", "TriggerManager: 休憩メッセージを送信します。")
         prompt = "休憩のため席を外します。"
-        self.send_to_llm(prompt)
+        self.broadcast(prompt, "休憩", PRIORITY_USER)
 
     def on_resume(self):
         paused_duration = time.time() - self.pause_time
         self.start_time += paused_duration
+        self.paused = False
 
-        print("TriggerManager: 再開メッセージを送信します。")
+        self.metrics.inc("triggers_total", source="resume")
+        log_event("resume", "TriggerManager: 再開メッセージを送信します。")
         prompt = "用事が終わりました。今から執筆を再開します。"
-        self.send_to_llm(prompt)
+        self.broadcast(prompt, "再開", PRIORITY_USER)
+
+    def backend_available(self):
+        # サーキットブレーカーがすべて開いている間はトリガーを止める
+        client = self.async_client if self.runtime is not None else self.client
+        return client.available()
+
+    def has_new_content(self):
+        with self.lock:
+            if not self.require_new_content:
+                return True
+            return self.content_version != self.sent_version
+
+    def on_document_changed(self):
+        # FileWatcher から原稿の保存が落ち着いたときに呼ばれる
+        with self.lock:
+            self.content_version += 1
+            recently_sent = (
+                time.time() - self.last_text_prompt_time < self.min_text_interval
+            )
+        if self.paused or recently_sent or not self.backend_available():
+            # 間隔が短すぎる場合は次のランダムトリガーに任せる
+            self.metrics.inc("triggers_skipped_total", source="document")
+            return
+        self.metrics.inc("triggers_total", source="document")
+        log_event("document_changed", "TriggerManager: 原稿の変更を検出しました。")
+        self.send_random_prompt(self.available_prompts(text_only=True))
+
+    def random_prompts(self):
+        if self.has_new_content():
+            return self.available_prompts()
+        # 前回から原稿が変わっていなければ時間についてのプロンプトだけにする
+        return [p for p in self.prompts_with_weights if not p[3]]
+
+    def available_prompts(self, text_only=False):
+        # セリフがあるかどうかは、登場人物のプロンプトを選んだときに select_prompt で確かめる
+        prompts = self.prompts_with_weights
+        if text_only:
+            prompts = [p for p in prompts if p[3]]
+        return prompts
+
+    def current_index(self):
+        # 原稿のエンコーディングが判定し直された場合は索引も作り直す
+        if self.index.encoding != self.manuscript.encoding:
+            self.index = ManuscriptIndex(self.filepath, self.manuscript.encoding)
+        self.index.refresh()
+        return self.index
 
     def on_random_message(self):
-        print("TriggerManager: on_random_message が発火しました。")
-
-        current_time = datetime.now()
-        time_str = current_time.strftime("%H時%M分")
-        uptime_minutes = int((time.time() - self.start_time) // 60)
-
-        prompts_with_weights = [
-            (
-                2,
-                "現在時刻について",
-                "現在は{time_str}です。時間帯について独り言のような一言をお願いします。",
-                False,
-            ),
-            (
-                1,
-                "時間の経過について",
-                "執筆を開始してから{uptime_minutes}分経過しました。あなたは時間の経過について呟きます。",
-                False,
-            ),
-            (
-                3,
-                "気になった点について",
-                "以下は私の書いた文章です。\n〔{combined_text}〕\nあなたはこの文章を読んで気になった点を一つ呟きます",
-                True,
-            ),
-            (
-                3,
-                "最初に思いついたこと",
-                "以下は私の書いた文章です。\n〔{combined_text}〕\nあなたはこの文章を読んで最初に思いついたことを一つ呟きます。",
-                True,
-            ),
-        ]
+        if not self.backend_available():
+            self.metrics.inc("triggers_skipped_total", source="random")
+            return
+        self.metrics.inc("triggers_total", source="random")
+        log_event("random_trigger", "TriggerManager: on_random_message が発火しました。")
+        if self.take_prefetched():
+            return
+        self.send_random_prompt(self.random_prompts())
 
+    def select_prompt(self, prompts_with_weights):
+        selected = self.pick_weighted(prompts_with_weights)
+        # 索引は登場人物のプロンプトを選んだときだけ更新する
+        if selected and selected[2] == CHARACTER_TEXT:
+            if not self.current_index().characters():
+                # セリフのない原稿では登場人物についてのプロンプトは使わない
+                prompts = [p for p in prompts_with_weights if p[3] != CHARACTER_TEXT]
+                selected = self.pick_weighted(prompts)
+        return selected
+
+    def pick_weighted(self, prompts_with_weights):
         total_weight = sum(w for w, _, _, _ in prompts_with_weights)
         rand_value = random.uniform(0, total_weight)
         cumulative_weight = 0
-        selected = None
 
         for weight, label, template, needs_text in prompts_with_weights:
             cumulative_weight += weight
             if rand_value <= cumulative_weight:
-                selected = (label, template, needs_text)
-                break
+                return label, template, needs_text
 
-        if not selected:
-            print("プロンプトの選択に失敗しました。")
-            return
+        log_event("prompt_select_failed", "プロンプトの選択に失敗しました。")
+        return None
 
-        label, template, needs_text = selected
+    def build_prompt(self, template, needs_text, when=None, remember=True):
+        """
+        (プロンプト, 使った本文) を返す。when は発火する時刻（time.time() の値）
+        """
+        when = when or time.time()
+        time_str = datetime.fromtimestamp(when).strftime("%H時%M分")
+        uptime_minutes = int((when - self.start_time) // 60)
 
         # テキストが必要な場合のみファイル読み込みや要約抽出を行う
-        if needs_text:
-            text = self.read_file()
-            summary = self.extract_summary(text)
-            body = self.remove_summary_blocks(text)
-            body = self.logger.format_scenario(body)
-            last_body = body[-3000:]
-            if summary:
-                combined_text = f"要約:\n{summary}\n\n本文:\n{last_body}"
-            else:
-                combined_text = last_body
-        else:
+        if not needs_text:
             # テキストが不要なシナリオはcombined_textなしで生成可能。
-            combined_text = ""
+            final_prompt = template.format(
+                time_str=time_str,
+                uptime_minutes=uptime_minutes,
+                combined_text="",
+            )
+            return final_prompt, None
 
-        # プロンプト生成
-        final_prompt = template.format(
+        summary, last_body = self.manuscript.get_excerpt()
+        if needs_text == CHARACTER_TEXT:
+            with self.metrics.timer("prompt_build_seconds"):
+                final_prompt, usage = self.build_character_prompt(
+                    template, summary, time_str, uptime_minutes
+                )
+            self.record_usage(usage, "character")
+            return final_prompt, last_body
+
+        with self.metrics.timer("prompt_build_seconds"):
+            focus_body, diff_kind = self.diff_tracker.focus(last_body, remember)
+            final_prompt, usage = self.prompt_builder.build(
+                template,
+                summary,
+                focus_body,
+                context=self.context,
+                body_label=DIFF_LABELS.get(diff_kind),
+                baseline=last_body,
+                time_str=time_str,
+                uptime_minutes=uptime_minutes,
+            )
+        self.record_usage(usage, diff_kind)
+        return final_prompt, last_body
+
+    def build_character_prompt(self, template, summary, time_str, uptime_minutes):
+        # 今の章でよく話している人物ほど選ばれやすくする
+        index = self.current_index()
+        title, chapter_start = index.current_chapter()
+        speakers = index.characters(since=chapter_start)
+        if not speakers:
+            chapter_start = 0
+            speakers = index.characters()
+        name = random.choices(list(speakers), weights=list(speakers.values()))[0]
+        lines = index.character_lines(
+            name, self.prompt_builder.max_body_chars, since=chapter_start
+        )
+        if title and chapter_start:
+            body_label = f"「{title}」での{name}のセリフ"
+        else:
+            body_label = f"{name}のセリフ"
+        return self.prompt_builder.build(
+            template,
+            summary,
+            lines,
+            context=self.context,
+            body_label=body_label,
+            character=name,
             time_str=time_str,
             uptime_minutes=uptime_minutes,
-            combined_text=combined_text,
         )
 
+    def record_usage(self, usage, kind):
+        self.metrics.inc("prompt_tokens_total", usage["total_tokens"])
+        self.metrics.inc("prompt_tokens_saved_total", usage["saved_tokens"])
+        log_event(
+            "prompt_built",
+            f"プロンプトのトークン数(推定): {usage['total_tokens']}"
+            f"/{usage['budget']}（本文 {usage['body_chars']} 文字、"
+            f"{kind}、節約 {usage['saved_tokens']} トークン）",
+            diff=kind,
+            **usage,
+        )
+
+    def send_random_prompt(self, prompts_with_weights):
+        if self.personas:
+            return self.fan_out(prompts_with_weights)
+        selected = self.select_prompt(prompts_with_weights)
+        if not selected:
+            return
+
+        label, template, needs_text = selected
+        if needs_text:
+            with self.lock:
+                self.sent_version = self.content_version
+                self.last_text_prompt_time = time.time()
+        final_prompt, _ = self.build_prompt(template, needs_text)
         self.send_to_llm(final_prompt, label)
 
-    def remove_summary_blocks(self, text):
-        pattern = r"<!--\s*SUMMARY_START\s*-->(.*?)<!--\s*SUMMARY_END\s*-->"
-        return re.sub(pattern, "", text, flags=re.DOTALL)
+    def fan_out(self, prompts_with_weights):
+        """
+        人物ごとの重みでプロンプトを選び、全員に並行して送る
+        原稿の読み込みと同じプロンプトの組み立ては 1 回だけ行う
+        """
+        allowed = {p[1] for p in prompts_with_weights}
+        built = {}  # ラベル -> プロンプト
+        sends = 0
+        sent_body = None
+        for persona in self.personas:
+            table = [
+                p
+                for p in persona.weighted_prompts(self.prompts_with_weights)
+                if p[1] in allowed
+            ]
+            if not table:
+                continue
+            selected = self.select_prompt(table)
+            if not selected:
+                continue
+            label, template, needs_text = selected
+            if label not in built:
+                # 差分の基準は全員に送り終えてから更新する
+                built[label], body = self.build_prompt(
+                    template, needs_text, remember=False
+                )
+                if needs_text and needs_text != CHARACTER_TEXT:
+                    sent_body = body
+                if needs_text:
+                    with self.lock:
+                        self.sent_version = self.content_version
+                        self.last_text_prompt_time = time.time()
+            self.send_to_llm(built[label], label, persona=persona)
+            sends += 1
+        # 組み立てを共有できた回数
+        self.metrics.inc("prompt_builds_shared_total", sends - len(built))
+        if sent_body is not None:
+            self.diff_tracker.remember(sent_body)
 
-    def extract_summary(self, text):
-        # コメントブロックで囲まれた要約部分を抽出。
-        pattern = r"<!--\s*SUMMARY_START\s*-->(.*?)<!--\s*SUMMARY_END\s*-->"
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            return match.group(1).strip()
-        else:
-            return None
+    def prefetch_lead_time(self):
+        # 発火の何秒前に生成を始めるか（実際にかかった時間に合わせて伸ばす）
+        with self.lock:
+            return max(self.prefetch_lead, self.prefetch_seconds * 1.5)
 
-    def send_to_llm(self, prompt, label):
+    def prefetch(self, fire_at):
+        """
+        fire_at（time.time() の値）に発火するランダムトリガーのコメントを先に生成する
+        結果は発火時に take_prefetched で使う
+        """
+        if self.personas or self.paused or not self.backend_available():
+            # ファンアウトでは先読みしない
+            return
+        with self.lock:
+            if self.prefetched is not None:
+                return
+        selected = self.select_prompt(self.random_prompts())
+        if not selected:
+            return
+        label, template, needs_text = selected
         with self.lock:
-            if self.api_in_progress:
-                print("APIリクエストが進行中のため、新しいリクエストをスキップします。")
+            version = self.content_version
+        # 使われるまで差分の基準は更新しない
+        prompt, body = self.build_prompt(
+            template, needs_text, when=fire_at, remember=False
+        )
+        entry = PrefetchedComment(label, prompt, needs_text, version, body, fire_at)
+        with self.lock:
+            if self.prefetched is not None:
                 return
-            self.api_in_progress = True
+            self.prefetched = entry
+        self.metrics.inc("prefetch_started_total", label=label)
+        log_event("prefetch", f"次のコメントを先に生成します:{label}", label=label)
 
-        print(f"LLMに送信するプロンプト:{label}...")
+        cache_policy = self.cache_policies.get(label, CACHE_OFF)
+        if self.runtime is not None:
+            def task():
+                return self.prefetch_async(entry, cache_policy)
+        else:
+            def task():
+                with self.lock:
+                    self.api_in_progress += 1
+                started = time.monotonic()
+                try:
+                    response, _ = self.client.generate(
+                        prompt,
+                        context=self.context,
+                        model_name=self.model_name,
+                        cache_policy=cache_policy,
+                    )
+                finally:
+                    with self.lock:
+                        self.last_api_response_time = time.time()
+                        self.api_in_progress -= 1
+                self.finish_prefetch(entry, response, time.monotonic() - started)
+
+        submitted = self.scheduler.submit(
+            task,
+            PRIORITY_RANDOM,
+            (id(self), "prefetch"),
+            on_cancel=lambda: self.drop_prefetch(entry, "cancelled"),
+            runtime=self.runtime,
+        )
+        if not submitted:
+            self.drop_prefetch(entry, "rejected")
+
+    def drop_prefetch(self, entry, reason):
+        """
+        スケジューラーに受け付けられなかった・取り消された先読みを片付ける
+        発火時にすでに使うことになっていた場合は、その場で普通に送る
+        """
+        with self.lock:
+            entry.dropped = True
+            if self.prefetched is entry:
+                self.prefetched = None
+            claimed = entry.claimed
+        self.metrics.inc("prefetch_wasted_total", reason=reason)
+        log_event(
+            "prefetch_wasted",
+            f"先に生成したコメントを破棄しました（{reason}）",
+            reason=reason,
+        )
+        if claimed and not self.paused:
+            self.send_random_prompt(self.random_prompts())
+
+    async def prefetch_async(self, entry, cache_policy=CACHE_OFF):
+        with self.lock:
+            self.api_in_progress += 1
+        started = time.monotonic()
+        try:
+            response, _ = await self.async_client.generate(
+                entry.prompt,
+                context=self.context,
+                model_name=self.model_name,
+                cache_policy=cache_policy,
+            )
+        finally:
+            with self.lock:
+                self.last_api_response_time = time.time()
+                self.api_in_progress -= 1
+        self.finish_prefetch(entry, response, time.monotonic() - started)
+
+    def finish_prefetch(self, entry, response, seconds):
+        with self.lock:
+            entry.response = response
+            entry.ready = True
+            self.prefetch_seconds = (
+                seconds
+                if not self.prefetch_seconds
+                else self.prefetch_seconds * 0.7 + seconds * 0.3
+            )
+            claimed = entry.claimed
+            failed = response == ERROR_COMMENT and not claimed
+            if failed and self.prefetched is entry:
+                self.prefetched = None
+        if claimed:
+            # 発火時にまだ生成中だったものは、できた時点で配信する
+            self.use_prefetched(entry)
+        elif failed:
+            self.metrics.inc("prefetch_wasted_total", reason="error")
+
+    def take_prefetched(self):
+        """
+        先に生成したコメントが使えれば配信して True を返す
+        原稿が大きく変わった・予定の時刻からずれた場合は捨てる
+        """
+        with self.lock:
+            entry, self.prefetched = self.prefetched, None
+        if entry is None:
+            return False
+        reason = self.prefetch_stale_reason(entry)
+        if reason:
+            self.metrics.inc("prefetch_wasted_total", reason=reason)
+            log_event(
+                "prefetch_wasted",
+                f"先に生成したコメントを破棄しました（{reason}）",
+                reason=reason,
+            )
+            return False
+        with self.lock:
+            if entry.dropped:
+                # 生成されないことが決まっているので、普通に送る
+                return False
+            entry.claimed = True
+            ready = entry.ready
+        self.metrics.inc("prefetch_hits_total", ready=ready)
+        if ready:
+            self.use_prefetched(entry)
+        return True
+
+    def prefetch_stale_reason(self, entry):
+        if abs(time.time() - entry.fire_at) > PREFETCH_MAX_DRIFT:
+            return "expired"
+        if entry.needs_text:
+            _, body = self.manuscript.get_excerpt()
+            if body != entry.body:
+                if changed_chars(entry.body, body) > self.prefetch_tolerance:
+                    return "changed"
+        return None
+
+    def use_prefetched(self, entry):
+        if entry.needs_text:
+            with self.lock:
+                self.sent_version = self.content_version
+                self.last_text_prompt_time = time.time()
+            if entry.needs_text != CHARACTER_TEXT:
+                self.diff_tracker.remember(entry.body)
+        log_event(
+            "prefetch_hit",
+            f"先に生成したコメントを使います:{entry.label}",
+            label=entry.label,
+        )
+        self.deliver_response(entry.prompt, entry.label, None, entry.response)
+
+    def send_to_llm(
+        self,
+        prompt,
+        label,
+        priority=PRIORITY_RANDOM,
+        persona=None,
+        retry=False,
+        use_cache=True,
+    ):
+        """
+        retry=True は重複した応答の言い直し（その応答も重複なら、もう言い直さない）
+        use_cache=False はキャッシュを使わずに LLM に生成させる
+        """
+        log_event("llm_send", f"LLMに送信するプロンプト:{label}...", label=label)
+
+        cache_policy = CACHE_OFF
+        if use_cache:
+            cache_policy = self.cache_policies.get(label, CACHE_OFF)
+        # ユーザー操作への応答は必ず送る。言い直しと、重複したキャッシュの応答の
+        # 生成し直しは、応答を待っていた枠をそのまま使う
+        force = retry or not use_cache or priority != PRIORITY_RANDOM
+        if persona is not None and not persona.try_acquire(force):
+            # この人物の生成が上限まで詰まっていれば今回は見送る
+            self.metrics.inc("persona_skipped_total", persona=persona.name)
+            return None
+
+        if self.runtime is not None:
+            # asyncio モードではスレッドを使わずイベントループ上で応答を待つ
+            # 優先度・置き換え・同時実行数は同じスケジューラーで管理する
+            def task():
+                return self.send_to_llm_async(
+                    prompt, label, cache_policy, persona, retry
+                )
+        else:
+            client, context, model_name = self.target(persona)
+
+            def task():
+                with self.lock:
+                    self.api_in_progress += 1
+                try:
+                    # LLMにプロンプトを送信
+                    if self.stream:
+                        message_id, response = self.stream_from_llm(
+                            prompt, cache_policy, persona
+                        )
+                    else:
+                        message_id = None
+                        response, _ = client.generate(
+                            prompt,
+                            context=context,
+                            model_name=model_name,
+                            cache_policy=cache_policy,
+                        )
+                    self.deliver_response(
+                        prompt, label, message_id, response, persona, retry
+                    )
+                finally:
+                    with self.lock:
+                        self.last_api_response_time = time.time()
+                        self.api_in_progress -= 1
+                    if persona is not None:
+                        persona.release()
+
+        def on_cancel():
+            # 実行されなかったリクエストの人物の枠を空ける
+            if persona is not None:
+                persona.release()
+
+        # 待機中のランダムなプロンプトは最新のものだけを残す（人物ごと）
+        key = None
+        if priority == PRIORITY_RANDOM:
+            key = (id(self), "random", persona.name if persona else None)
+        submitted = self.scheduler.submit(
+            task, priority, key, on_cancel=on_cancel, runtime=self.runtime
+        )
+        if not submitted:
+            on_cancel()
+        return submitted
 
-        def task():
-            try:
-                # LLMにプロンプトを送信
-                response, _ = get_comment_from_llm(
-                    prompt, context=self.context, model_name=self.model_name
+    def broadcast(self, prompt, label, priority=PRIORITY_RANDOM):
+        # 決まったプロンプトをすべての人物に送る
+        if not self.personas:
+            return self.send_to_llm(prompt, label, priority)
+        for persona in self.personas:
+            self.send_to_llm(prompt, label, priority, persona)
+
+    def target(self, persona, use_async=False):
+        # (クライアント, context, モデル名) を返す
+        if persona is None:
+            client = self.async_client if use_async else self.client
+            return client, self.context, self.model_name
+        client = persona.async_client if use_async else persona.client
+        return client, persona.context, persona.model_name
+
+    async def send_to_llm_async(
+        self, prompt, label, cache_policy=CACHE_OFF, persona=None, retry=False
+    ):
+        client, context, model_name = self.target(persona, use_async=True)
+        with self.lock:
+            self.api_in_progress += 1
+        try:
+            if self.stream:
+                message_id, response = await self.stream_from_llm_async(
+                    prompt, cache_policy, persona
                 )
-                print(f"LLMからのレスポンス: {response}")
-                # ログに追加し、レスポンスを加工
-                processed_response = self.logger.add_log(
-                    f"ラベル:{label}\n{prompt}", response
+            else:
+                message_id = None
+                response, _ = await client.generate(
+                    prompt,
+                    context=context,
+                    model_name=model_name,
+                    cache_policy=cache_policy,
+                )
+            self.deliver_response(prompt, label, message_id, response, persona, retry)
+        finally:
+            with self.lock:
+                self.last_api_response_time = time.time()
+                self.api_in_progress -= 1
+            if persona is not None:
+                persona.release()
+
+    def deliver_response(
+        self, prompt, label, message_id, response, persona=None, retry=False
+    ):
+        if response == ERROR_COMMENT:
+            self.report_failure(label, message_id)
+            return
+        self.backend_down = False
+        processed_response = self.logger.process_response(response)
+        cached = isinstance(response, CachedResponse)
+        if self.suppress_duplicate(
+            processed_response, prompt, label, message_id, persona, retry, cached
+        ):
+            return
+        if persona is not None:
+            label = f"{persona.name}/{label}"
+        log_event("llm_response", f"LLMからのレスポンス: {response}", label=label)
+        with self.metrics.timer("delivery_seconds"):
+            # ログに追加
+            processed_response = self.logger.add_log(
+                f"ラベル:{label}\n{prompt}", processed_response, processed=True
+            )
+            if persona is not None:
+                # 複数の人物のコメントは誰のものか分かるように送る
+                self.message_queue.put(
+                    {
+                        "id": message_id or next(_message_ids),
+                        "text": processed_response,
+                        "partial": False,
+                        "persona": persona.name,
+                    }
                 )
+            elif message_id is None:
                 self.message_queue.put(processed_response)
-                print(f"LLMからのレスポンス: {processed_response}")
-            finally:
-                with self.lock:
-                    self.last_api_response_time = time.time()
-                    self.api_in_progress = False
+            else:
+                # 途中経過を加工済みの最終テキストで置き換える
+                self.message_queue.put(
+                    {"id": message_id, "text": processed_response, "partial": False}
+                )
+        self.metrics.inc("messages_delivered_total", label=label)
+        log_event(
+            "message_delivered",
+            f"LLMからのレスポンス: {processed_response}",
+            label=label,
+        )
+
+    def suppress_duplicate(
+        self, text, prompt, label, message_id, persona, retry=False, cached=False
+    ):
+        """
+        ランダムなプロンプトへの応答が最近のコメントとほぼ同じなら、表示せずに True を返す
+        キャッシュの応答（cached=True）なら、同じプロンプトをキャッシュを使わずに送り直す
+        それ以外は、言い直しの応答（retry=True）でなければ別のテンプレートで一度だけ言い直させる
+        """
+        if self.duplicate_filter is None or label not in self.random_labels:
+            return False
+        duplicate, similarity = self.duplicate_filter.check(text)
+        if not duplicate:
+            return False
+        self.metrics.inc("duplicate_suppressed_total", label=label)
+        log_event(
+            "duplicate_suppressed",
+            f"最近のコメントと似ているため表示しません（類似度 {similarity:.2f}）: {text}",
+            label=label,
+            similarity=round(similarity, 3),
+        )
+        if message_id is not None:
+            # ストリーミングの途中経過を消す
+            self.message_queue.put({"id": message_id, "removed": True})
+        if cached:
+            # 以前の応答を繰り返さないよう、LLM に新しく生成させる
+            self.metrics.inc("duplicate_cache_bypass_total", label=label)
+            if not self.paused:
+                self.send_to_llm(
+                    prompt, label, persona=persona, retry=retry, use_cache=False
+                )
+        elif not retry and not self.paused:
+            if self.runtime is not None:
+                # asyncio モードではイベントループ上にいるので、組み立てはループの外で行う
+                self.runtime.executor.submit(self.reroll, label, persona)
+            else:
+                self.reroll(label, persona)
+        return True
+
+    @property
+    def random_labels(self):
+        return {p[1] for p in self.prompts_with_weights}
+
+    def reroll(self, label, persona=None):
+        # 重複したものとは別のテンプレートで言い直させる
+        prompts = [p for p in self.random_prompts() if p[1] != label]
+        if persona is not None:
+            prompts = persona.weighted_prompts(prompts)
+        selected = self.select_prompt(prompts) if prompts else None
+        if not selected:
+            return
+        new_label, template, needs_text = selected
+        # 差分の基準は重複した応答のときに更新済みなので、ここでは変えない
+        final_prompt, _ = self.build_prompt(template, needs_text, remember=False)
+        self.metrics.inc("duplicate_rerolls_total", label=new_label)
+        self.send_to_llm(final_prompt, new_label, persona=persona, retry=True)
 
-        threading.Thread(target=task).start()
+    def report_failure(self, label, message_id):
+        # 失敗時の定型文はコメントとしてログにも画面にも出さない
+        self.metrics.inc("llm_failed_comments_total", label=label)
+        log_event("llm_failed", f"コメントを取得できませんでした: {label}", label=label)
+        if message_id is not None:
+            self.message_queue.put({"id": message_id, "removed": True})
+        if not self.backend_down:
+            self.backend_down = True
+            self.message_queue.put(
+                {
+                    "id": f"notice-{next(_message_ids)}",
+                    "text": BACKEND_DOWN_NOTICE,
+                    "partial": False,
+                    "notice": True,
+                }
+            )
+
+    def partial_message(self, message_id, text, persona):
+        message = {"id": message_id, "text": text, "partial": True}
+        if persona is not None:
+            message["persona"] = persona.name
+        return message
+
+    def stream_from_llm(self, prompt, cache_policy=CACHE_OFF, persona=None):
+        # 生成途中のテキストを stream_interval ごとにキューへ流す
+        client, context, model_name = self.target(persona)
+        message_id = next(_message_ids)
+        parts = []
+        cached = False
+        last_push = 0.0
+        for chunk in client.generate_stream(
+            prompt,
+            context=context,
+            model_name=model_name,
+            cache_policy=cache_policy,
+        ):
+            if chunk.get("error"):
+                parts = [chunk.get("response", "")]
+                break
+            cached = cached or chunk.get("cached", False)
+            parts.append(chunk.get("response", ""))
+            now = time.monotonic()
+            if now - last_push >= self.stream_interval:
+                self.message_queue.put(
+                    self.partial_message(message_id, "".join(parts), persona)
+                )
+                last_push = now
+        response = "".join(parts).strip()
+        return message_id, CachedResponse(response) if cached else response
+
+    async def stream_from_llm_async(self, prompt, cache_policy=CACHE_OFF, persona=None):
+        # stream_from_llm の asyncio 版
+        client, context, model_name = self.target(persona, use_async=True)
+        message_id = next(_message_ids)
+        parts = []
+        cached = False
+        last_push = 0.0
+        async for chunk in client.generate_stream(
+            prompt,
+            context=context,
+            model_name=model_name,
+            cache_policy=cache_policy,
+        ):
+            if chunk.get("error"):
+                parts = [chunk.get("response", "")]
+                break
+            cached = cached or chunk.get("cached", False)
+            parts.append(chunk.get("response", ""))
+            now = time.monotonic()
+            if now - last_push >= self.stream_interval:
+                self.message_queue.put(
+                    self.partial_message(message_id, "".join(parts), persona)
+                )
+                last_push = now
+        response = "".join(parts).strip()
+        return message_id, CachedResponse(response) if cached else response
 
     def save_log(self, log_type="auto"):
         self.logger.save_log(log_type)